@@ -0,0 +1,485 @@
+"""
+Coordinate conversion through the alignments written by fasta_diff
+
+An alignment is [old_id, old_start, old_end, new_id, new_start, new_end] in the 0-based half-open coordinate system,
+optionally followed by the strand ('+' or '-'). On the '-' strand old_seq[old_start:old_end] is the reverse
+complement of new_seq[new_start:new_end], so the old_start end of the region maps to new_end and coordinates run
+backwards.
+
+AlignmentIndex finds the alignments holding a position of an old sequence with a binary search over the alignments of
+the sequence sorted by start, instead of comparing the position to every alignment of the sequence.
+
+An alignment file can be compiled with write_compiled_alignments into columns of little-endian integers sorted by
+old_id and old_start, with a table of the sequence ids, and loaded by memory-mapping it with MappedAlignmentIndex,
+so it is used without being parsed. open_alignment_index opens either kind of file.
+
+Features of coordinate-sorted inputs are looked up in increasing positions along each sequence. An AlignmentCursor
+keeps the alignments holding the last position and only moves forward over the sorted alignments, so a lookup costs
+amortized constant time. A position before the last one is looked up in the index and the cursor carries on from it.
+
+NewSequenceSummary collects the region of each new sequence covered by the alignments in one pass, for the headers of
+the converted files (GFF3 ##sequence-region, VCF ##contig and BAM @SQ), so they are not regrouped for every file.
+
+fasta_diff --stream writes the alignments of every stage as soon as it finishes, between a STREAM_BEGIN and a
+STREAM_END comment line, so a reader of a truncated stream can tell that fasta_diff did not finish.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, OrderedDict
+import json
+import logging
+import mmap
+import struct
+import sys
+
+STREAM_BEGIN = '#fasta_diff alignment stream'
+STREAM_END = '#end of alignment stream'
+
+MAGIC = b'CCALIGN\x01'
+# number of alignments, number of old ids, byte offset of the JSON table
+_FOOTER = struct.Struct('<QQQ')
+_STRANDS = [None, '+', '-']
+
+
+def alignment_lines(alignment_file_f):
+    """
+    Iterate over the alignment lines of a fasta_diff output file or stream, as they are read
+    :param alignment_file_f: a file object opened in binary mode
+    :return: a generator of str lines, the comment lines starting with '#' are skipped
+    :raises ValueError: if the file is a stream ending before its STREAM_END line
+    """
+    streamed, ended = False, False
+    for line in alignment_file_f:
+        line = str(line, 'utf-8')
+        if line.startswith('#'):
+            if line.rstrip('\r\n') == STREAM_BEGIN:
+                streamed = True
+            elif line.rstrip('\r\n') == STREAM_END:
+                ended = True
+            continue
+        yield line
+    if streamed and not ended:
+        raise ValueError('The alignment stream of %s ended before its last line, fasta_diff did not finish' % getattr(alignment_file_f, 'name', 'the alignment file'))
+
+
+def alignment_strand(alignment):
+    """
+    :param alignment: [old_id, old_start, old_end, new_id, new_start, new_end] and an optional strand
+    :return: '+' or '-'
+    """
+    return alignment[6] if len(alignment) > 6 else '+'
+
+
+def convert_boundary(alignment, boundary):
+    """
+    Convert a 0-based boundary between two bases, such as a BED start or end, from the old to the new sequence
+    :param alignment: the alignment holding the boundary, alignment[1] <= boundary <= alignment[2]
+    :param int boundary: the old boundary
+    :return: the new boundary
+    """
+    if alignment_strand(alignment) == '-':
+        return alignment[4] + alignment[2] - boundary
+    return boundary - alignment[1] + alignment[4]
+
+
+def convert_position(alignment, position):
+    """
+    Convert the 1-based position of a base, such as a GFF3 start or end, from the old to the new sequence
+    :param alignment: the alignment holding the base, alignment[1] < position <= alignment[2]
+    :param int position: the old position
+    :return: the new position
+    """
+    if alignment_strand(alignment) == '-':
+        return alignment[4] + alignment[2] - position + 1
+    return position - alignment[1] + alignment[4]
+
+
+def flip_strand(strand):
+    """
+    :param str strand: a feature strand
+    :return: the opposite strand, or strand itself if it is not '+' or '-'
+    """
+    return {'+': '-', '-': '+'}.get(strand, strand)
+
+
+def read_alignment_list_tsv(alignment_list_tsv_file):
+    """
+    Parse an alignment_list_tsv and returns a list
+    :param alignment_list_tsv_file: The output alignment file of fasta_diff
+    :type alignment_list_tsv_file: string or file
+    :return: a list of [old_id, old_start, old_end, new_id, new_start, new_end], followed by the strand
+        if the file has a seventh column
+    """
+    tsv_format = [str, int, int, str, int, int, str]
+    alignment_list_tsv_file_f = alignment_list_tsv_file
+    if isinstance(alignment_list_tsv_file, str):
+        alignment_list_tsv_file_f = open(alignment_list_tsv_file, 'rb')
+    logging.info('Reading alignment data from: %s...', alignment_list_tsv_file_f.name)
+
+    alignment_list = []
+    for line in alignment_lines(alignment_list_tsv_file_f):
+        alignment_list.append([f(t) for f, t in zip(tsv_format, line.rstrip('\r\n').split('\t'))])
+
+    if isinstance(alignment_list_tsv_file, str):
+        alignment_list_tsv_file_f.close()
+    logging.info('  Alignments: %d', len(alignment_list))
+
+    return alignment_list
+
+
+class AlignmentIndex(object):
+    """
+    Initialize an AlignmentIndex instance with a list of alignments
+    alignment_index = AlignmentIndex(alignment_list)
+    The alignments of an old sequence, in the order of alignment_list
+    old_id in alignment_index
+    alignment_index[old_id]
+    Find the alignments holding a base or a boundary of an old sequence
+    alignment_index.position_mappings(old_id, position)
+    alignment_index.boundary_mappings(old_id, boundary)
+    The same lookups for positions that usually increase, such as the starts of the features of a sorted file
+    cursor = alignment_index.position_cursor()
+    cursor.mappings(old_id, position)
+    """
+
+    def __init__(self, alignment_list):
+        self.alignment_list = alignment_list
+        self.alignment_dict = defaultdict(list)
+        for a in alignment_list:
+            self.alignment_dict[a[0]].append(a)
+        # {old_id: (old_start of each alignment sorted by old_start, the alignments in the same order,
+        #           the largest old_end of the alignments up to each one, old_end of each alignment)}
+        self._sorted = dict()
+        for old_id, mappings in self.alignment_dict.items():
+            order = sorted(range(len(mappings)), key=lambda i: mappings[i][1])
+            max_ends = []
+            for i in order:
+                max_ends.append(max(mappings[i][2], max_ends[-1]) if max_ends else mappings[i][2])
+            self._sorted[old_id] = ([mappings[i][1] for i in order], order, max_ends, [mappings[i][2] for i in order])
+
+    def __contains__(self, old_id):
+        return old_id in self.alignment_dict
+
+    def __getitem__(self, old_id):
+        return self.alignment_dict[old_id]
+
+    def __iter__(self):
+        return iter(self.alignment_dict)
+
+    def __len__(self):
+        return len(self.alignment_dict)
+
+    def alignments(self):
+        """
+        :return: the list of all the alignments, in the order of the alignment file
+        """
+        return self.alignment_list
+
+    def _lookup(self, old_id, position, search):
+        # the alignments of old_id starting before the insertion point of position returned by search (bisect_left or
+        # bisect_right) in the sorted starts that end at or after position, in the order of alignment_list
+        if old_id not in self._sorted:
+            return []
+        starts, order, max_ends, ends = self._sorted[old_id]
+        mappings = self.alignment_dict[old_id]
+        found = []
+        i = search(starts, position) - 1
+        # the alignments before i can only hold position if one of them ends at or after it
+        while i >= 0 and max_ends[i] >= position:
+            if mappings[order[i]][2] >= position:
+                found.append(order[i])
+            i -= 1
+        return [mappings[i] for i in sorted(found)]
+
+    def position_mappings(self, old_id, position):
+        """
+        :param str old_id: the old sequence id
+        :param int position: a 1-based position, such as a GFF3 start or end
+        :return: the alignments a of old_id with a[1] < position <= a[2]
+        """
+        return self._lookup(old_id, position, bisect_left)
+
+    def boundary_mappings(self, old_id, boundary):
+        """
+        :param str old_id: the old sequence id
+        :param int boundary: a 0-based boundary between two bases, such as a BED start or end
+        :return: the alignments a of old_id with a[1] <= boundary <= a[2]
+        """
+        return self._lookup(old_id, boundary, bisect_right)
+
+    def _group(self, old_id):
+        # (old_start, old_end, largest old_end up to each one, file order, alignment) of the alignments of old_id by
+        # index in the order of old_start, and the range of indexes of old_id
+        starts, order, max_ends, ends = self._sorted[old_id]
+        mappings = self.alignment_dict[old_id]
+        return starts, ends, max_ends, order, lambda i: mappings[order[i]], 0, len(starts)
+
+    def position_cursor(self):
+        """
+        :return: an AlignmentCursor finding the alignments a with a[1] < position <= a[2], like position_mappings
+        """
+        return AlignmentCursor(self, bisect_left)
+
+    def boundary_cursor(self):
+        """
+        :return: an AlignmentCursor finding the alignments a with a[1] <= boundary <= a[2], like boundary_mappings
+        """
+        return AlignmentCursor(self, bisect_right)
+
+
+class AlignmentCursor(object):
+    """
+    Initialize an AlignmentCursor instance with an AlignmentIndex and bisect_left (positions) or bisect_right
+    (boundaries), or get one from AlignmentIndex.position_cursor or AlignmentIndex.boundary_cursor
+    cursor = AlignmentCursor(alignment_index, bisect_left)
+    Find the alignments holding a position, in the order of the alignment file
+    cursor.mappings(old_id, position)
+    """
+
+    def __init__(self, alignment_index, search):
+        self.alignment_index = alignment_index
+        self.search = search
+        # a bisect_left cursor takes the alignments starting before a position, a bisect_right one the alignments
+        # starting at or before it
+        self._inclusive = search is bisect_right
+        self.old_id = None
+        self.position = None
+        self._group = None
+        self._next = 0
+        self._active = []
+        # number of lookups of a position before the previous one, looked up in the index
+        self.out_of_order = 0
+
+    def mappings(self, old_id, position):
+        """
+        :param str old_id: the old sequence id
+        :param int position: a position (AlignmentIndex.position_cursor) or boundary (AlignmentIndex.boundary_cursor)
+        :return: the alignments of old_id holding position, in the order of the alignment file
+        """
+        if old_id != self.old_id:
+            self.old_id = old_id
+            self._group = self.alignment_index._group(old_id) if old_id in self.alignment_index else None
+            self.position = None
+            self._active = []
+            if self._group is not None:
+                self._next = self._group[5]
+        if self._group is None:
+            return []
+        starts, ends, max_ends, records, row, lo, hi = self._group
+        if self.position is not None and position < self.position:
+            # out of order, start again from the alignments found in the index
+            self.out_of_order += 1
+            self._next = self.search(starts, position, lo, hi)
+            active = []
+            i = self._next - 1
+            while i >= lo and max_ends[i] >= position:
+                if ends[i] >= position:
+                    active.append(i)
+                i -= 1
+            self._active = active
+        else:
+            active = [i for i in self._active if ends[i] >= position]
+            i = self._next
+            while i < hi and (starts[i] < position or self._inclusive and starts[i] == position):
+                if ends[i] >= position:
+                    active.append(i)
+                i += 1
+            self._next = i
+            self._active = active
+        self.position = position
+        if len(active) > 1:
+            active = sorted(active, key=lambda i: records[i])
+        return [row(i) for i in active]
+
+
+class NewSequenceSummary(object):
+    """
+    Initialize a NewSequenceSummary instance with the alignments, in the order of the alignment file
+    summary = NewSequenceSummary(alignment_index.alignments())
+    The region of each new sequence covered by all the alignments, or by the alignments of an old sequence
+    summary.regions[new_id]
+    summary.regions_of(old_id)[new_id]
+    A region is a dict with the smallest new_start ('start'), the largest new_end ('end'), end - start ('length') and
+    the number of alignments ('segments')
+    """
+
+    def __init__(self, alignments):
+        self.regions = OrderedDict()
+        self._old_regions = dict()
+        for a in alignments:
+            NewSequenceSummary._add(self.regions, a)
+            NewSequenceSummary._add(self._old_regions.setdefault(a[0], OrderedDict()), a)
+
+    @staticmethod
+    def _add(regions, alignment):
+        region = regions.get(alignment[3])
+        if region is None:
+            regions[alignment[3]] = {'start': alignment[4], 'end': alignment[5], 'length': alignment[5] - alignment[4],
+                                     'segments': 1}
+        else:
+            region['start'] = min(region['start'], alignment[4])
+            region['end'] = max(region['end'], alignment[5])
+            region['length'] = region['end'] - region['start']
+            region['segments'] += 1
+
+    def regions_of(self, old_id):
+        """
+        :param str old_id: the old sequence id
+        :return: an OrderedDict of new_id: region covered by the alignments of old_id, in the order of the alignment
+            file, empty if old_id has no alignment
+        """
+        return self._old_regions.get(old_id, OrderedDict())
+
+
+def write_compiled_alignments(alignment_list, compiled_file):
+    """
+    Save a list of alignments so it can be loaded with MappedAlignmentIndex
+    :param alignment_list: a list of [old_id, old_start, old_end, new_id, new_start, new_end] and an optional strand
+    :param str compiled_file: the output path
+    """
+    if sys.byteorder != 'little':
+        raise ValueError('compiled alignment files can only be saved on little-endian machines')
+    ids = []
+    id_ordinals = dict()
+    def id_ordinal(seq_id):
+        if seq_id not in id_ordinals:
+            id_ordinals[seq_id] = len(ids)
+            ids.append(seq_id)
+        return id_ordinals[seq_id]
+    # sorted by old_id then old_start, alignments with the same old_id and old_start keep the order of the file
+    order = sorted(range(len(alignment_list)), key=lambda r: (alignment_list[r][0], alignment_list[r][1]))
+    old_ids, group_starts, max_ends = [], [], []
+    for i, r in enumerate(order):
+        a = alignment_list[r]
+        if not old_ids or old_ids[-1] != id_ordinal(a[0]):
+            old_ids.append(id_ordinal(a[0]))
+            group_starts.append(i)
+            max_ends.append(a[2])
+        else:
+            max_ends.append(max(a[2], max_ends[-1]))
+    group_starts.append(len(order))
+    strands = []
+    for r in order:
+        strand = alignment_list[r][6] if len(alignment_list[r]) > 6 else None
+        if strand not in _STRANDS:
+            raise ValueError('Unknown strand %s in alignment %s' % (strand, alignment_list[r]))
+        strands.append(_STRANDS.index(strand))
+    with open(compiled_file, 'wb') as compiled_f:
+        compiled_f.write(MAGIC)
+        for column in [1, 2, 4, 5]:
+            compiled_f.write(array('q', [alignment_list[r][column] for r in order]).tobytes())
+        compiled_f.write(array('q', max_ends).tobytes())
+        compiled_f.write(array('Q', group_starts).tobytes())
+        compiled_f.write(array('I', order).tobytes())
+        compiled_f.write(array('I', [id_ordinal(alignment_list[r][3]) for r in order]).tobytes())
+        compiled_f.write(array('B', strands).tobytes())
+        table_offset = compiled_f.tell()
+        compiled_f.write(json.dumps({'ids': ids, 'old_ids': old_ids}).encode('utf-8'))
+        compiled_f.write(_FOOTER.pack(len(order), len(old_ids), table_offset))
+
+
+class MappedAlignmentIndex(AlignmentIndex):
+    """
+    Initialize a MappedAlignmentIndex instance with a file written by write_compiled_alignments, the file is
+    memory-mapped and an alignment is only created when it is looked up
+    alignment_index = MappedAlignmentIndex(compiled_file)
+    alignment_index.position_mappings(old_id, position)
+    """
+
+    def __init__(self, compiled_file):
+        """
+        :param compiled_file: a path, or a file object opened in binary mode
+        """
+        if isinstance(compiled_file, str):
+            with open(compiled_file, 'rb') as compiled_f:
+                self._mm = mmap.mmap(compiled_f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            try:
+                self._mm = mmap.mmap(compiled_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # a pipe can not be memory-mapped
+                self._mm = compiled_file.read()
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a compiled alignment file' % getattr(compiled_file, 'name', compiled_file))
+        if sys.byteorder != 'little':
+            raise ValueError('compiled alignment files can only be loaded on little-endian machines')
+        count, group_count, table_offset = _FOOTER.unpack(self._mm[-_FOOTER.size:])
+        table = json.loads(bytes(self._mm[table_offset:-_FOOTER.size]).decode('utf-8'))
+        self._ids = table['ids']
+        self._group_old_ids = [self._ids[o] for o in table['old_ids']]
+        self._groups = OrderedDict((old_id, g) for g, old_id in enumerate(self._group_old_ids))
+        view = memoryview(self._mm)
+        offset = len(MAGIC)
+        columns = []
+        for typecode, size, length in [('q', 8, count)] * 5 + [('Q', 8, group_count + 1), ('I', 4, count), ('I', 4, count), ('B', 1, count)]:
+            columns.append(view[offset:offset + size * length].cast(typecode))
+            offset += size * length
+        (self._old_start, self._old_end, self._new_start, self._new_end, self._max_end,
+         self._group_starts, self._record, self._new_id, self._strand) = columns
+        self._rows = dict()
+        logging.info('  Alignments: %d', count)
+
+    def __contains__(self, old_id):
+        return old_id in self._groups
+
+    def __getitem__(self, old_id):
+        g = self._groups[old_id]
+        rows = range(self._group_starts[g], self._group_starts[g + 1])
+        return [self._row(i) for i in sorted(rows, key=lambda i: self._record[i])]
+
+    def __iter__(self):
+        return iter(self._groups)
+
+    def __len__(self):
+        return len(self._groups)
+
+    def _row(self, i):
+        # the same list is returned for every lookup of an alignment
+        if i not in self._rows:
+            old_id = self._group_old_ids[bisect_right(self._group_starts, i) - 1]
+            row = [old_id, self._old_start[i], self._old_end[i],
+                   self._ids[self._new_id[i]], self._new_start[i], self._new_end[i]]
+            if self._strand[i]:
+                row.append(_STRANDS[self._strand[i]])
+            self._rows[i] = row
+        return self._rows[i]
+
+    def alignments(self):
+        return [self._row(i) for i in sorted(range(len(self._record)), key=lambda i: self._record[i])]
+
+    def _lookup(self, old_id, position, search):
+        if old_id not in self._groups:
+            return []
+        g = self._groups[old_id]
+        start = self._group_starts[g]
+        found = []
+        i = search(self._old_start, position, start, self._group_starts[g + 1]) - 1
+        # the alignments before i can only hold position if one of them ends at or after it
+        while i >= start and self._max_end[i] >= position:
+            if self._old_end[i] >= position:
+                found.append(i)
+            i -= 1
+        return [self._row(i) for i in sorted(found, key=lambda i: self._record[i])]
+
+    def _group(self, old_id):
+        g = self._groups[old_id]
+        return (self._old_start, self._old_end, self._max_end, self._record, self._row,
+                self._group_starts[g], self._group_starts[g + 1])
+
+
+def open_alignment_index(alignment_file):
+    """
+    Open the output alignment file of fasta_diff, a TSV file or a compiled file written by write_compiled_alignments
+    :param alignment_file: a path, or a file object opened in binary mode
+    :return: an AlignmentIndex, a MappedAlignmentIndex for a compiled file
+    """
+    if isinstance(alignment_file, str):
+        with open(alignment_file, 'rb') as alignment_f:
+            magic = alignment_f.read(len(MAGIC))
+    else:
+        magic = alignment_file.peek(len(MAGIC))[:len(MAGIC)] if hasattr(alignment_file, 'peek') else b''
+    if magic == MAGIC:
+        logging.info('Reading compiled alignment data from: %s...', getattr(alignment_file, 'name', alignment_file))
+        return MappedAlignmentIndex(alignment_file)
+    return AlignmentIndex(read_alignment_list_tsv(alignment_file))
@@ -6,17 +6,24 @@ Compare two very similar FASTA files and output coordinate mappings
 
 __version__ = '1.1'
 
-try:
-   import cPickle as pickle
-except:
-   import pickle
-from os.path import isfile
+from os.path import getmtime, getsize, isfile
 from os import remove
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+import hashlib
+import json
 import logging
 import sys
 import argparse
 from textwrap import dedent
+from multiprocessing import get_context
+from coordinates_conversion.alignment import STREAM_BEGIN, STREAM_END, read_alignment_list_tsv, write_compiled_alignments
+from coordinates_conversion.checkpoint import StageCheckpoint
+from coordinates_conversion.fasta import read_fasta, reverse_complement, sequence_digest
+from coordinates_conversion.kmer_index import KmerIndex, MappedKmerIndex, write_kmer_index
+from coordinates_conversion.packed_store import open_packed_store
+from coordinates_conversion.seed_extend import gapless_blocks
+from coordinates_conversion.seq_compare import masked_match_runs, match_length, regions_equal
+from coordinates_conversion.stage_stats import StageStats
 
 logging.basicConfig(level=logging.DEBUG, format='%(levelname)-8s %(message)s')
 
@@ -29,44 +36,50 @@ def fasta_file_to_dict(fasta_file, id=True, header=False, seq=False):
     Duplicate keys are checked and a warning is logged if found.
     The value of fasta_dict is a python dict with 3 keys: header, id and seq
     """
-
-    fasta_file_f = fasta_file
-    if isinstance(fasta_file, str):
-        fasta_file_f = open(fasta_file, 'r',encoding="UTF-8")
-    
     fasta_dict = {}
     flags = OrderedDict([('id', id), ('header', header), ('seq', seq)])
-    entry = dict([('id', ''), ('header', ''), ('seq', '')])
     count = 0
-    line_num = 0    
-    for line in fasta_file_f:
-        line = str(line.strip())
-        if not line:
-            continue
-        if line[0] == '>':
-            count += 1
-            key = '||'.join([entry[i] for i in flags if flags[i]])
-            if key: # key != ''
-                if key in fasta_dict: # check for duplicate key
-                    logging.warning('%s : Line %d : Duplicate %s [%s] : ID = [%s].', fasta_file_f.name, line_num, '||'.join([i for i in flags if flags[i]]), key[:25] + (key[25:] and '..'), entry['id'])
-                fasta_dict[key] = entry
-                entry = dict()
-            entry['header'] = line
-            entry['id'] = line.split()[0][1:]
-            entry['seq'] = ''
-        else:
-            entry['seq'] += line.upper()
-        line_num += 1
-    if isinstance(fasta_file, str):
-        fasta_file_f.close()
+    for entry_header, entry_seq in read_fasta(fasta_file):
+        count += 1
+        entry = {'header': entry_header, 'id': entry_header.split()[0][1:] if entry_header[1:].split() else '', 'seq': entry_seq.upper()}
+        key = '||'.join([entry[i] for i in flags if flags[i]])
+        if key: # key != ''
+            if key in fasta_dict: # check for duplicate key
+                logging.warning('%s : Record %d : Duplicate %s [%s] : ID = [%s].', getattr(fasta_file, 'name', fasta_file), count, '||'.join([i for i in flags if flags[i]]), key[:25] + (key[25:] and '..'), entry['id'])
+            fasta_dict[key] = entry
+    return fasta_dict, count
 
-    key = '||'.join([entry[i] for i in flags if flags[i]])
-    if key: # key != ''
+def fasta_file_to_digest_dict(fasta_file):
+    """Returns a dict from a fasta file and the number of sequences as the second return value.
+    The key of fasta_dict is the digest of the sequence, computed while reading, the sequences are not kept.
+    Duplicate keys are checked and a warning is logged if found.
+    The value of fasta_dict is a python dict with 4 keys: header, id, length and record (the position in the file),
+    load_fasta_dict_sequences adds the sequences of the remaining entries
+    """
+    fasta_dict = {}
+    count = 0
+    for entry_header, entry_seq in read_fasta(fasta_file):
+        entry_seq = entry_seq.upper()
+        key = sequence_digest(entry_seq)
+        entry = {'header': entry_header, 'id': entry_header.split()[0][1:] if entry_header[1:].split() else '', 'length': len(entry_seq), 'record': count}
         if key in fasta_dict:
-            logging.warning('%s : Line %d : Duplicate %s [%s] : ID = [%s].', fasta_file_f.name, line_num, '||'.join([i for i in flags if flags[i]]), key[:25] + (key[25:] and '..'), entry['id'])
+            logging.warning('%s : Record %d : Duplicate seq [%s] : ID = [%s].', fasta_file, count + 1, key, entry['id'])
         fasta_dict[key] = entry
+        count += 1
     return fasta_dict, count
 
+def load_fasta_dict_sequences(fasta_dict, fasta_file):
+    """Read the sequences of the entries of a fasta_dict created by fasta_file_to_digest_dict that don't have one yet
+    Returns the number of sequences read
+    """
+    entries = dict((entry['record'], entry) for entry in fasta_dict.values() if 'seq' not in entry and 'store' not in entry)
+    if not entries:
+        return 0
+    for record, (entry_header, entry_seq) in enumerate(read_fasta(fasta_file)):
+        if record in entries:
+            entries[record]['seq'] = entry_seq.upper()
+    return len(entries)
+
 def fasta_dict_to_file(fasta_dict, fasta_file):
     """Write fasta_dict to a fasta_file
     fasta_file can be a string path or a file object
@@ -77,10 +90,170 @@ def fasta_dict_to_file(fasta_dict, fasta_file):
         fasta_file = open(fasta_file, 'w',encoding="UTF-8")
 
     for key in fasta_dict:
-        fasta_file.write(fasta_dict[key]['header'] + '\n' + fasta_dict[key]['seq'] + '\n')
+        fasta_file.write(fasta_dict[key]['header'] + '\n' + entry_sequence(fasta_dict[key]) + '\n')
 
     fasta_file.close()
 
+def packed_store_to_dict(store):
+    """Returns a dict from a PackedSequenceStore and the number of sequences as the second return value.
+    The key of fasta_dict is the digest of the sequence, duplicate keys are checked and a warning is logged if found.
+    The value of fasta_dict is a python dict with 5 keys: header, id, length, store and record,
+    the sequence is read from the store when needed
+    """
+    fasta_dict = {}
+    for record, r in enumerate(store.records):
+        if r['digest'] in fasta_dict:
+            logging.warning('%s : Record %d : Duplicate seq [%s] : ID = [%s].', store.store_file, record, r['digest'], r['id'])
+        fasta_dict[r['digest']] = {'header': r['header'], 'id': r['id'], 'length': r['length'], 'store': store, 'record': record}
+    return fasta_dict, len(store.records)
+
+def shard_facts_to_dict(shards):
+    """Returns a dict from the results of fasta_diff_shard for every shard of a new FASTA file, the number of sequences
+    as the second return value and the shard facts of every record of the FASTA file as the third.
+    The key of fasta_dict is the digest of the sequence, duplicate keys are checked and a warning is logged if found.
+    The value of fasta_dict is a python dict with 4 keys: header, id, length and record, the sequences are not kept
+    """
+    shard_facts = sorted((facts for shard in shards for facts in shard['records']), key=lambda facts: facts['record'])
+    fasta_dict = {}
+    for record, facts in enumerate(shard_facts):
+        if facts['digest'] in fasta_dict:
+            logging.warning('%s : Record %d : Duplicate seq [%s] : ID = [%s].', shards[0]['new_fasta'], record + 1, facts['digest'], facts['id'])
+        fasta_dict[facts['digest']] = {'header': facts['header'], 'id': facts['id'], 'length': facts['length'], 'record': record}
+    return fasta_dict, len(shard_facts), shard_facts
+
+def read_shard_files(shard_files):
+    """Read the results of fasta_diff_shard saved by "fasta_diff shard", one file per shard
+    Checks that every shard of the same new FASTA file is present once and that they were run with the same options
+    Returns a list of the results sorted by shard
+    """
+    shards = []
+    for shard_file in shard_files:
+        with open(shard_file, 'r', encoding='utf-8') as shard_f:
+            shards.append(json.load(shard_f))
+    shards.sort(key=lambda shard: shard['shard'])
+    if not shards:
+        raise ValueError('No shard files')
+    for key in ['version', 'shards', 'old_store_digest', 'new_fasta_size', 'new_sequences', 'both_strands']:
+        if len(set(shard[key] for shard in shards)) != 1:
+            raise ValueError('The shard files were not made from the same FASTA files with the same options (%s)' % key)
+    if [shard['shard'] for shard in shards] != list(range(shards[0]['shards'])):
+        raise ValueError('Expected one file for each of the %d shards, got shards %s' % (shards[0]['shards'], ','.join(str(shard['shard']) for shard in shards)))
+    if shards[0]['version'] != __version__:
+        raise ValueError('The shard files were made by fasta_diff %s' % shards[0]['version'])
+    if sum(len(shard['records']) for shard in shards) != shards[0]['new_sequences']:
+        raise ValueError('The shard files do not hold every sequence of the new FASTA file')
+    return shards
+
+def write_sequence_digests(digest_file, old_digests, new_digests, matched_old_ids):
+    """Write the digest of every old and new sequence of a run, read by read_sequence_digests
+    old_digests and new_digests are dicts of {sequence id: digest}, matched_old_ids is a dict of
+    {new sequence id: the ids of the old sequences it matched in any stage}
+    """
+    with open(digest_file, 'w', encoding='utf-8') as digest_f:
+        digest_f.write('#Sequence_file\tSequence_ID\tDigest\tMatched_old_IDs\n')
+        for seq_id, digest in old_digests.items():
+            digest_f.write('\t'.join(['old', seq_id, digest, '']) + '\n')
+        for seq_id, digest in new_digests.items():
+            digest_f.write('\t'.join(['new', seq_id, digest, ','.join(sorted(matched_old_ids.get(seq_id, ())))]) + '\n')
+
+def read_sequence_digests(digest_file):
+    """Returns the dicts of {sequence id: digest} of the old and of the new sequences written by write_sequence_digests,
+    and the dict of {new sequence id: the ids of the old sequences it matched}
+    """
+    digests = {'old': dict(), 'new': dict()}
+    matched_old_ids = dict()
+    with open(digest_file, 'r', encoding='utf-8') as digest_f:
+        for line in digest_f:
+            if line.startswith('#') or not line.strip():
+                continue
+            fasta, seq_id, digest, matched = line.rstrip('\r\n').split('\t')
+            digests[fasta][seq_id] = digest
+            if matched:
+                matched_old_ids[seq_id] = matched.split(',')
+    return digests['old'], digests['new'], matched_old_ids
+
+def unchanged_alignment_groups(alignments, matched_old_ids, previous_old_digests, previous_new_digests, old_digests, new_digests, both_strands=False):
+    """Group the alignments of a previous run with the sequences they depend on and keep the unchanged groups.
+    Two sequences are in the same group if they are aligned or if the new sequence matched the old one in any stage
+    (matched_old_ids), even if the mapping was not kept, so the stages resolve a group the same way as long as its
+    sequences are unchanged and no other sequence matches them.
+    A group is kept if all its sequences have the same digest as in the previous run, the groups with reverse strand
+    alignments are only kept if both_strands is True
+    :return: a list of dicts with the alignments, old_ids and new_ids of the kept groups, in the order of their first
+        alignment
+    """
+    # union-find over ('old', id) and ('new', id)
+    parent = dict()
+    def find(node):
+        while parent.setdefault(node, node) != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+    for a in alignments:
+        parent[find(('old', a[0]))] = find(('new', a[3]))
+    for new_id, old_ids in matched_old_ids.items():
+        for old_id in old_ids:
+            parent[find(('old', old_id))] = find(('new', new_id))
+    groups = OrderedDict()
+    for a in alignments:
+        groups.setdefault(find(('old', a[0])), {'alignments': [], 'old_ids': set(), 'new_ids': set()})['alignments'].append(a)
+    for node in list(parent):
+        root = find(node)
+        if root in groups:
+            groups[root][node[0] + '_ids'].add(node[1])
+    unchanged = lambda ids, previous, current: all(previous.get(i) is not None and previous.get(i) == current.get(i) for i in ids)
+    kept = []
+    for group in groups.values():
+        if not unchanged(group['old_ids'], previous_old_digests, old_digests) or not unchanged(group['new_ids'], previous_new_digests, new_digests):
+            continue
+        if not both_strands:
+            if any(a[6:7] == ['-'] for a in group['alignments']):
+                continue
+            group['alignments'] = [a[:6] for a in group['alignments']]
+        kept.append(group)
+    return kept
+
+def store_digest(store):
+    """Returns a digest of the sequence digests of a PackedSequenceStore, identifying the sequences it holds"""
+    return hashlib.blake2b(''.join(r['digest'] for r in store.records).encode('utf-8'), digest_size=16).hexdigest()
+
+def open_old_index(fasta_file, rebuild=False, canonical=False):
+    """Open the persisted index of an old FASTA file, made of a packed store (FASTA_FILE.pack) holding the sequences,
+    their digests and lengths, and a k-mer index (FASTA_FILE.kmi, or FASTA_FILE.ckmi if canonical is True) of the
+    sequences in the order of the store.
+    Both files are memory-mapped, they are (re)built if missing, outdated or if rebuild is True.
+    Returns the PackedSequenceStore and the MappedKmerIndex
+    """
+    store_file, index_file = fasta_file + '.pack', fasta_file + ('.ckmi' if canonical else '.kmi')
+    if rebuild and isfile(store_file):
+        remove(store_file)
+    store = open_packed_store(fasta_file)
+    digest = store_digest(store)
+    if not rebuild and isfile(index_file) and getmtime(index_file) >= getmtime(fasta_file):
+        kmer_index = MappedKmerIndex(index_file)
+        if kmer_index.table.get('store_digest') == digest and len(kmer_index) == len(store) and kmer_index.canonical == canonical:
+            return store, kmer_index
+        logging.info('  K-mer index (%s) does not match the packed store', index_file)
+    logging.info('  Writing k-mer index (%s)...', index_file)
+    write_kmer_index(KmerIndex((store.fetch(record) for record in range(len(store))), canonical=canonical), index_file, {'store_digest': digest})
+    return store, MappedKmerIndex(index_file)
+
+def entry_sequence(entry, start=0, end=None):
+    """Returns the sequence of a fasta_dict entry, or the slice [start, end) of it
+    The sequence is read from the packed store of the entry if it was not loaded into memory
+    """
+    if 'seq' in entry:
+        if start == 0 and end is None:
+            return entry['seq']
+        return entry['seq'][start:end]
+    return entry['store'].fetch(entry['record'], start, end)
+
+def entry_length(entry):
+    """Returns the sequence length of a fasta_dict entry"""
+    if 'seq' in entry:
+        return len(entry['seq'])
+    return entry['length']
+
 def query_yes_no(question, default='yes'):
     """Ask a yes/no question via input() and return their answer.
 
@@ -113,49 +286,612 @@ def query_yes_no(question, default='yes'):
         else:
             sys.stderr.write('Please respond with "y" or "n".\n')
 
-def fasta_diff(old_fasta_file, new_fasta_file, debug=True, header_check=False, report=None):
+def extend_split_alignment(seg_matches, old_seq, new_seq):
+    """
+    Join the segment alignments of a new sequence split by Ns into one alignment per contiguous region,
+    extending each region over the masked bases that still match the old sequence.
+    The regions are compared block-wise (see coordinates_conversion.seq_compare)
+    :param seg_matches: a list of [old_id, old_start, old_end, new_id, new_start, new_end] for each segment, in order
+    :param str old_seq: the old sequence matching all the segments
+    :param str new_seq: the new sequence
+    :return: a list of [old_id, old_start, old_end, new_id, new_start, new_end]
+    """
+    new_matches = []
+    tmp_oldstart = 0
+    tmp_oldend = 0
+    tmp_newstart = 0
+    tmp_newend = 0
+
+    for match in seg_matches:
+        if match == seg_matches[0]:
+            tmp_oldstart = match[1]
+            tmp_oldend = match[2]
+            tmp_newstart = match[4]
+            tmp_newend = match[5]
+        elif regions_equal(old_seq, tmp_oldstart, match[2], new_seq, tmp_newstart, match[5]):
+            tmp_oldend = match[2]
+            tmp_newend = match[5]
+        else:
+            extension = match_length(old_seq, tmp_oldend, new_seq, tmp_newend)
+            tmp_oldend += extension
+            tmp_newend += extension
+            new_matches.append([match[0], tmp_oldstart, tmp_oldend, match[3], tmp_newstart, tmp_newend])
+            tmp_oldstart = match[1]
+            tmp_oldend = match[2]
+            tmp_newstart = match[4]
+            tmp_newend = match[5]
+    #check if the new sequence end with N
+    extension = match_length(old_seq, tmp_oldend, new_seq, tmp_newend)
+    tmp_oldend += extension
+    tmp_newend += extension
+
+    new_matches.append([match[0], tmp_oldstart, tmp_oldend, match[3], tmp_newstart, tmp_newend])
+    return new_matches
+
+# the smallest fraction of the bases of a new sequence, not counting Ns, covered by the blocks of stage 5
+EDIT_MIN_COVERAGE = 0.9
+
+# read-only state of the running stage, set before the worker processes are forked
+_stage_state = dict()
+
+def _candidate_ordinals(query):
+    # ordinals of the unmatched old sequences that may contain query
+    kmer_index = _stage_state['old_kmer_index']
+    old_keys = _stage_state['old_keys']
+    old_fasta_dict = _stage_state['old_fasta_dict']
+    ordinals = kmer_index.candidate_ordinals(query)
+    if ordinals is None:
+        ordinals = range(len(kmer_index))
+    # a persisted index holds every old sequence, duplicate sequences share a key and only the first one is kept
+    keys = set()
+    candidates = []
+    for o in ordinals:
+        if old_keys[o] in old_fasta_dict and old_keys[o] not in keys:
+            keys.add(old_keys[o])
+            candidates.append(o)
+    return candidates
+
+# the most recently decoded old sequences of packed stores, kept by each process up to DECODED_CACHE_SIZE bases, the
+# last decoded sequence is always kept
+DECODED_CACHE_SIZE = 1 << 28
+_decoded_cache = {'sequences': OrderedDict(), 'bases': 0}
+
+def _old_sequence(ordinal):
+    entry = _stage_state['old_fasta_dict'][_stage_state['old_keys'][ordinal]]
+    if 'seq' in entry:
+        return entry['seq']
+    # a packed sequence is compared with several new sequences in a row, it is only decoded once
+    sequences = _decoded_cache['sequences']
+    key = (entry['store'].store_file, entry['record'])
+    if key in sequences:
+        sequences.move_to_end(key)
+        return sequences[key]
+    seq = entry_sequence(entry)
+    sequences[key] = seq
+    _decoded_cache['bases'] += len(seq)
+    while len(sequences) > 1 and _decoded_cache['bases'] > DECODED_CACHE_SIZE:
+        _decoded_cache['bases'] -= len(sequences.popitem(last=False)[1])
+    return seq
+
+def _match_truncated_sequence(new_index):
+    """
+    Stage 2 work for a single new sequence
+    :param int new_index: the index of the new sequence in _stage_state['new_keys']
+    :return: the ordinals of the old sequences containing the new sequence, its start in the old sequence if
+        there is exactly one, the strand of the match, the number of candidate comparisons and the number of old
+        sequence bytes scanned. The reverse complement of the new sequence is only searched if both_strands is set
+        and the new sequence is not found
+    """
+    new_seq = entry_sequence(_stage_state['new_fasta_dict'][_stage_state['new_keys'][new_index]])
+    candidates = _candidate_ordinals(new_seq)
+    strands = [('+', new_seq)]
+    if _stage_state['both_strands']:
+        strands.append(('-', reverse_complement(new_seq)))
+    comparisons, scanned = 0, 0
+    for strand, query in strands:
+        matches = []
+        for o in candidates:
+            old_seq = _old_sequence(o)
+            comparisons += 1
+            scanned += len(old_seq)
+            if query in old_seq:
+                matches.append(o)
+        if matches:
+            break
+    start = None
+    if len(matches) == 1:
+        start = _old_sequence(matches[0]).find(query)
+    return matches, start, strand, comparisons, scanned
+
+def _match_masked_sequence(new_entry, new_seq, candidates):
+    """
+    Stage 3 fast path for a new sequence that is an old sequence of the same length with some bases converted to N.
+    The segments are aligned at the same positions in both sequences, where the search of _split_segment_matches
+    aligns each segment to its first occurrence after the previous one, which can be before its true position.
+    The caller still has to check that no other old sequence holds the segments of the new sequence
+    :param candidates: the ordinals of the old sequences that may hold the new sequence, see _candidate_ordinals
+    :return: the ordinal of the first matching old sequence or None, its alignments, the number of candidate
+        comparisons and the number of old sequence bytes scanned
+    """
+    old_fasta_dict, old_keys = _stage_state['old_fasta_dict'], _stage_state['old_keys']
+    comparisons = 0
+    for o in candidates:
+        if entry_length(old_fasta_dict[old_keys[o]]) != len(new_seq):
+            continue
+        comparisons += 1
+        regions = masked_match_runs(_old_sequence(o), new_seq)
+        if regions is not None:
+            old_id = old_fasta_dict[old_keys[o]]['id']
+            return o, [[old_id, start, end, new_entry['id'], start, end] for start, end in regions], comparisons, comparisons * len(new_seq)
+    return None, None, comparisons, comparisons * len(new_seq)
+
+def _split_segment_matches(query, candidates, new_id):
+    """
+    Find the candidate old sequences holding all N separated segments of query in order
+    :return: a list of (seg_matches, ordinal), the number of candidate comparisons and the number of old sequence
+        bytes scanned
+    """
+    old_id = lambda o: _stage_state['old_fasta_dict'][_stage_state['old_keys'][o]]['id']
+    segments = query.replace('N', ' ').split()
+    matches = []
+    comparisons, scanned = 0, 0
+    for o in candidates:
+        old_seq = _old_sequence(o)
+        comparisons += 1
+        scanned += len(old_seq)
+        start_original = 0
+        start_new = 0
+        seg_matches = []
+        for segment in segments:
+            pos = old_seq.find(segment, start_original)
+            if pos == -1:
+                break
+            else:
+                start_original = pos + len(segment)
+                pos_new = query.find(segment, start_new)
+                start_new = pos_new + len(segment)
+                seg_matches.append([old_id(o), pos, pos + len(segment), new_id, pos_new, pos_new + len(segment)])
+        if len(segments) == len(seg_matches):
+            matches.append((seg_matches, o))
+    return matches, comparisons, scanned
+
+def _split_alignments(seg_matches, ordinal, query, strand):
+    # the alignments of a new sequence (or of its reverse complement if strand is '-') found by _split_segment_matches
+    new_matches = extend_split_alignment(seg_matches, _old_sequence(ordinal), query)
+    if strand == '-':
+        # convert the coordinates on the reverse complement to the new sequence
+        length = len(query)
+        new_matches = [[m[0], m[1], m[2], m[3], length - m[5], length - m[4], '-'] for m in new_matches]
+    return new_matches
+
+def _match_split_subsequence(new_index):
+    """
+    Stage 3 work for a single new sequence
+    :param int new_index: the index of the new sequence in _stage_state['new_keys']
+    :return: the ordinals of the old sequences containing all N separated segments of the new sequence in order,
+        the alignments if there is exactly one, the number of candidate comparisons and the number of old sequence
+        bytes scanned
+    """
+    new_entry = _stage_state['new_fasta_dict'][_stage_state['new_keys'][new_index]]
+    new_seq = entry_sequence(new_entry)
+    segments = new_seq.replace('N', ' ').split()
+    if not segments:
+        # a sequence of only Ns can not be placed
+        return [], None, 0, 0
+    masked_comparisons, masked_scanned = 0, 0
+    candidates = _candidate_ordinals(max(segments, key=len))
+    if 'N' in new_seq:
+        o, new_matches, masked_comparisons, masked_scanned = _match_masked_sequence(new_entry, new_seq, candidates)
+        if o is not None:
+            # the masked match is only used if the search below would find it alone, another old sequence holding
+            # every segment (another masked match included) makes the new sequence ambiguous
+            others, other_comparisons, other_scanned = _split_segment_matches(new_seq, [c for c in candidates if c != o], new_entry['id'])
+            masked_comparisons += other_comparisons
+            masked_scanned += other_scanned
+            if not others:
+                return [o], new_matches, masked_comparisons, masked_scanned
+    comparisons, scanned = masked_comparisons, masked_scanned
+    strands = [('+', new_seq)]
+    if _stage_state['both_strands']:
+        # the reverse complement is only searched if the new sequence is not found
+        strands.append(('-', reverse_complement(new_seq)))
+    for strand, query in strands:
+        matches, strand_comparisons, strand_scanned = _split_segment_matches(query, candidates, new_entry['id'])
+        comparisons += strand_comparisons
+        scanned += strand_scanned
+        if matches:
+            break
+    new_matches = None
+    if len(matches) == 1:
+        new_matches = _split_alignments(matches[0][0], matches[0][1], query, strand)
+    return [o for seg_matches, o in matches], new_matches, comparisons, scanned
+
+def _match_edited_sequence(new_index):
+    """
+    Stage 5 work for a single new sequence
+    :param int new_index: the index of the new sequence in _stage_state['new_keys']
+    :return: the ordinals of the old sequences sharing the most k-mers with the new sequence, the gapless alignment
+        blocks if there is exactly one and the blocks cover enough of the new sequence, the number of candidate
+        comparisons and the number of old sequence bytes scanned
+    """
+    kmer_index = _stage_state['old_kmer_index']
+    old_keys = _stage_state['old_keys']
+    old_fasta_dict = _stage_state['old_fasta_dict']
+    new_entry = _stage_state['new_fasta_dict'][_stage_state['new_keys'][new_index]]
+    new_seq = entry_sequence(new_entry)
+    k = kmer_index.k
+    votes = Counter()
+    for pos in range(len(new_seq) - k + 1):
+        votes.update(kmer_index.lookup(new_seq[pos:pos + k]))
+    # duplicate sequences of a persisted index share a key, only the first one is kept
+    first = dict()
+    for o in sorted(votes):
+        if old_keys[o] in old_fasta_dict and old_keys[o] not in first:
+            first[old_keys[o]] = o
+    ranked = sorted(first.values(), key=lambda o: -votes[o])
+    if not ranked:
+        return [], None, 0, 0
+    best = [o for o in ranked if votes[o] == votes[ranked[0]]]
+    if len(best) > 1:
+        return best, None, 0, 0
+    old_seq = _old_sequence(best[0])
+    old_id = old_fasta_dict[old_keys[best[0]]]['id']
+    strands = [('+', new_seq)]
+    if _stage_state['both_strands']:
+        # the reverse complement is only aligned if the new sequence is not covered enough
+        strands.append(('-', reverse_complement(new_seq)))
+    for comparisons, (strand, query) in enumerate(strands, 1):
+        blocks = gapless_blocks(old_seq, query, k=k, step=kmer_index.step)
+        covered = sum(n_end - n_start - query.count('N', n_start, n_end) for o_start, o_end, n_start, n_end in blocks)
+        if covered >= EDIT_MIN_COVERAGE * (len(query) - query.count('N')):
+            break
+    else:
+        return [], None, comparisons, comparisons * len(old_seq)
+    if strand == '-':
+        # convert the coordinates on the reverse complement to the new sequence
+        length = len(new_seq)
+        return best, [[old_id, o_start, o_end, new_entry['id'], length - n_end, length - n_start, '-'] for o_start, o_end, n_start, n_end in blocks], comparisons, comparisons * len(old_seq)
+    return best, [[old_id, o_start, o_end, new_entry['id'], n_start, n_end] for o_start, o_end, n_start, n_end in blocks], comparisons, comparisons * len(old_seq)
+
+def _shard_sequence_facts(new_index):
+    """
+    Shard work for a single new sequence: its stage 2 and 3 matches against every old sequence, on both strands if
+    both_strands is set. The stages only keep the matches to the old sequences left unmatched by the previous stages,
+    which depend on the other shards, so fasta_diff replays them from these matches (see _replay_truncated_sequence
+    and _replay_split_subsequence)
+    :param int new_index: the index of the new sequence in _stage_state['new_keys']
+    :return: a JSON serializable dict with the record number, header, id, length and digest of the new sequence,
+        and unless the digest is the digest of an old sequence (always matched in stage 1), its stage 2 matches
+        ('truncated'), its same length masked matches ('masked') and its stage 3 matches ('split')
+    """
+    new_entry = _stage_state['new_fasta_dict'][_stage_state['new_keys'][new_index]]
+    new_seq = entry_sequence(new_entry)
+    facts = {'record': new_entry['record'], 'header': new_entry['header'], 'id': new_entry['id'],
+             'length': len(new_seq), 'digest': sequence_digest(new_seq)}
+    strands = [('+', new_seq)]
+    if _stage_state['both_strands']:
+        strands.append(('-', reverse_complement(new_seq)))
+        facts['rc_digest'] = sequence_digest(strands[1][1])
+    if facts['digest'] in _stage_state['old_fasta_dict']:
+        return facts
+    # [[strand, [[old ordinal, start], ...]], ...]
+    facts['truncated'] = []
+    candidates = _candidate_ordinals(new_seq)
+    for strand, query in strands:
+        matches = []
+        for o in candidates:
+            start = _old_sequence(o).find(query)
+            if start != -1:
+                matches.append([o, start])
+        facts['truncated'].append([strand, matches])
+    # [[old ordinal, [[start, end], ...]], ...]
+    facts['masked'] = []
+    # [[strand, [[old ordinal, alignments], ...]], ...]
+    facts['split'] = []
+    segments = new_seq.replace('N', ' ').split()
+    if not segments:
+        return facts
+    candidates = _candidate_ordinals(max(segments, key=len))
+    if 'N' in new_seq:
+        for o in candidates:
+            if entry_length(_stage_state['old_fasta_dict'][_stage_state['old_keys'][o]]) == len(new_seq):
+                regions = masked_match_runs(_old_sequence(o), new_seq)
+                if regions is not None:
+                    facts['masked'].append([o, regions])
+    for strand, query in strands:
+        matches, comparisons, scanned = _split_segment_matches(query, candidates, new_entry['id'])
+        facts['split'].append([strand, [[o, _split_alignments(seg_matches, o, query, strand)] for seg_matches, o in matches]])
+    return facts
+
+def _replayed_facts(new_index):
+    # the shard facts of a new sequence and a filter keeping the matches to the unmatched old sequences
+    old_keys, old_fasta_dict = _stage_state['old_keys'], _stage_state['old_fasta_dict']
+    new_entry = _stage_state['new_fasta_dict'][_stage_state['new_keys'][new_index]]
+    unmatched = lambda matches: [m for m in matches if old_keys[m[0]] in old_fasta_dict]
+    return _stage_state['shard_facts'][new_entry['record']], unmatched
+
+def _replay_truncated_sequence(new_index):
+    """
+    Stage 2 work for a single new sequence, replayed from its shard facts, see _match_truncated_sequence
+    """
+    facts, unmatched = _replayed_facts(new_index)
+    matches, strand = [], '+'
+    for strand, strand_matches in facts['truncated']:
+        matches = unmatched(strand_matches)
+        if matches:
+            break
+    start = matches[0][1] if len(matches) == 1 else None
+    return [o for o, pos in matches], start, strand, 0, 0
+
+def _replay_split_subsequence(new_index):
+    """
+    Stage 3 work for a single new sequence, replayed from its shard facts, see _match_split_subsequence
+    """
+    facts, unmatched = _replayed_facts(new_index)
+    old_id = lambda o: _stage_state['old_fasta_dict'][_stage_state['old_keys'][o]]['id']
+    masked = unmatched(facts['masked'])
+    if masked:
+        o, regions = masked[0]
+        # as in _match_split_subsequence, only if no other old sequence holds every segment
+        if [m[0] for m in unmatched(facts['split'][0][1])] == [o]:
+            return [o], [[old_id(o), start, end, facts['id'], start, end] for start, end in regions], 0, 0
+    matches = []
+    for strand, strand_matches in facts['split']:
+        matches = unmatched(strand_matches)
+        if matches:
+            break
+    return [o for o, alignments in matches], matches[0][1] if len(matches) == 1 else None, 0, 0
+
+# the stage workers of a run replayed from shard facts
+_replay_workers = {_match_truncated_sequence: _replay_truncated_sequence, _match_split_subsequence: _replay_split_subsequence}
+
+def _map_stage_worker(worker, count, jobs):
+    # run worker on range(count), the results are in order
+    # the worker processes are forked after _stage_state is set, so they share the sequences copy-on-write
+    if jobs > 1:
+        try:
+            context = get_context('fork')
+        except ValueError:
+            logging.warning('  Process pool requires fork, running on a single process')
+        else:
+            with context.Pool(jobs) as pool:
+                return pool.map(worker, range(count), chunksize=max(1, count // (jobs * 64)))
+    return [worker(i) for i in range(count)]
+
+def find_overlapping_pairs(alignments):
+    """
+    Find the (old_id, new_id) pairs whose old regions overlap the old region of another pair with the same old_id.
+    The old region of a pair spans from the smallest old_start to the largest old_end of its alignments, the regions
+    are treated as closed intervals. Uses a sweep over the regions sorted by start, O(n log n).
+    :param alignments: a list of [old_id, old_start, old_end, new_id, new_start, new_end]
+    :return: a set of (old_id, new_id) tuples
+    """
+    regions = dict()
+    for a in alignments:
+        pair = (a[0], a[3])
+        if pair not in regions:
+            regions[pair] = [min(a[1], a[2]), max(a[1], a[2])]
+        else:
+            regions[pair][0] = min(regions[pair][0], a[1], a[2])
+            regions[pair][1] = max(regions[pair][1], a[1], a[2])
+
+    overlapping_pairs = set()
+    cluster = []
+    cluster_old_id, cluster_end = None, None
+    for pair, (start, end) in sorted(regions.items(), key=lambda r: (r[0][0], r[1][0])):
+        if pair[0] == cluster_old_id and start <= cluster_end:
+            # every region after the first one in a cluster overlaps the region holding cluster_end
+            cluster.append(pair)
+            cluster_end = max(cluster_end, end)
+        else:
+            if len(cluster) > 1:
+                overlapping_pairs.update(cluster)
+            cluster = [pair]
+            cluster_old_id, cluster_end = pair[0], end
+    if len(cluster) > 1:
+        overlapping_pairs.update(cluster)
+    return overlapping_pairs
+
+def fasta_diff(old_fasta_file, new_fasta_file, debug=True, header_check=False, report=None, jobs=1, packed=False, digest=False, checkpoint_dir=None, old_index=False, stats=None, edits=False, both_strands=False, shards=None, previous=None, digests=None, stream=None, unmatched=False):
     """
     Compares two very similar FASTA files and outputs coordinate mappings using a multi stage algorithm:
     Stage 1: Find 100% matches
     Stage 2: Find 100% substrings, where the full length of a new sequence can be found as a substring of a old sequence
     Stage 3: Find cases where part of the sequence was converted into Ns
+    Stage 4: Find cases where a old sequence is split into two or more new sequences
+    Stage 5 (optional): Find near-identical sequences with small edits, aligned as gapless blocks
+    Stage 2 and 3 only verify the old sequences returned by a sparse k-mer index of the old sequences
     Originally created to compare the NCBI version to the original reference of Diaphorina citri
     :param old_fasta_file: a string path
     :param new_fasta_file: a string path
-    :param debug: If True, partial results are saved in a *_stage_i_pickle file after each stage, unmatched sequences after each stage are saved in a *_stage_i_unmatched file for both FASTA files
-    :return: a list of [old_id, old_start, old_end, new_id, new_start, new_end], 0-based coordinate system
+    :param debug: If True, checkpoints are saved after each stage (in checkpoint_dir, default: fasta_diff_checkpoint)
+    :param unmatched: If True, the sequences left unmatched after each stage are saved in a *_stage_i_unmatched file for both FASTA files
+    :param jobs: The number of processes matching new sequences in stage 2, 3 and 5, the output does not depend on it
+    :param packed: If True, sequences are read from memory-mapped 2-bit packed stores (FASTA_FILE.pack, built when
+        missing or outdated) instead of being loaded into memory
+    :param digest: If True, stage 1 matches sequence digests computed while reading the FASTA files, only the
+        sequences left unmatched after stage 1 are loaded into memory
+    :param checkpoint_dir: If set, the changes made by each stage are saved in a subdirectory named after the content
+        of the FASTA files and the program version, a later run with the same inputs resumes after the last saved stage
+    :param old_index: If True, the old sequences and their k-mer index are memory-mapped from the persisted index of
+        the old FASTA file (see open_old_index), stage 1 matches digests as if digest were True
+    :param edits: If True, stage 5 matches each remaining new sequence to the old sequence sharing the most k-mers
+        and outputs an alignment for each exact block between small edits (substitutions and indels up to 16 bases),
+        if the blocks cover at least EDIT_MIN_COVERAGE of the new sequence
+    :param both_strands: If True, a new sequence not found in stage 1, 2, 3 or 5 is searched again as its reverse
+        complement, these alignments have a seventh column '-' and all the others '+'. The k-mer index is built on
+        canonical k-mers so the candidates of both strands are found with a single lookup
+    :param stats: If set, a JSON report of the wall time, CPU time, peak memory, candidate comparisons and bytes
+        scanned of each stage is written to this path
+    :param previous: If set, a (match_tsv, digests_tsv) tuple of the output and of the digests file of a previous run
+        with the same old or new FASTA file. The alignments of the groups of sequences whose digests did not change
+        and that share no segment with the other sequences are carried forward (see unchanged_alignment_groups), only
+        the other sequences go through the stages. The alignments of stages 1 to 4 are the same as a full run, the
+        sequences of the carried groups are not in the report and not compared in stage 5
+    :param digests: If set, the digest of every old and new sequence and the old sequences matched by every new
+        sequence are written to this path, to be used as the digests_tsv of a later incremental run
+    :param stream: If set, a file object opened in binary mode, the alignments are written to it and flushed as soon
+        as each stage finishes (alignments are never removed by a later stage), between a STREAM_BEGIN and a
+        STREAM_END line (see coordinates_conversion.alignment), so the conversion scripts reading the stream can
+        start before the last stage
+    :param shards: If set, the results of fasta_diff_shard for every shard of the new FASTA file (see
+        read_shard_files), the stages are replayed from the matches of the shards instead of comparing the sequences,
+        new_fasta_file is not read and the old sequences are read from the packed store of the persisted index.
+        both_strands has to be the one of the shards, debug, checkpoint_dir and edits can not be used
+    :return: a list of [old_id, old_start, old_end, new_id, new_start, new_end], 0-based coordinate system,
+        followed by the strand if both_strands is True
     """
     alignment_list = []
+    streamed_count = 0 # the number of alignments written to stream
+    match_links = [] # (new_id, old_id) of every match found by a stage
     onetomultiple=dict()
     #for stage4 dictionary
-    old_fasta_dict, new_fasta_dict = None, None
+    old_kmer_index, old_keys = None, None
+    shard_facts = None
+    stage_stats = StageStats()
+    if shards is not None and (debug or checkpoint_dir is not None or edits):
+        raise ValueError('debug, checkpoint_dir and edits can not be used with shards')
 
     def match_identical_sequence():
         # find 100% matches
         #[old_id, old_start, old_end, new_id, new_start, new_end]
         old_seqs = list(old_fasta_dict.keys())
-       
+        stage_stats.count(comparisons=len(old_seqs))
         for seq in old_seqs:
             if seq in new_fasta_dict:
-                alignment = [old_fasta_dict[seq]['id'], 0, len(seq), new_fasta_dict[seq]['id'], 0, len(seq)]
+                length = entry_length(old_fasta_dict[seq])
+                alignment = [old_fasta_dict[seq]['id'], 0, length, new_fasta_dict[seq]['id'], 0, length]
                 if header_check and not old_fasta_dict[seq]['id'].split('.')[0] in new_fasta_dict[seq]['header']:
                     logging.warning('Failed header check (match_identical_sequence): %s -> %s', old_fasta_dict[seq]['id'], new_fasta_dict[seq]['id'])
                 alignment_list.append(alignment)
                 del old_fasta_dict[seq]
                 del new_fasta_dict[seq]
+        if both_strands:
+            # the remaining new sequences identical to the reverse complement of an old sequence
+            if digest:
+                load_fasta_dict_sequences(new_fasta_dict, new_fasta_file)
+            new_seqs = list(new_fasta_dict.keys())
+            stage_stats.count(comparisons=len(new_seqs))
+            for seq in new_seqs:
+                if shard_facts is not None:
+                    old_seq = shard_facts[new_fasta_dict[seq]['record']]['rc_digest']
+                else:
+                    rc_seq = reverse_complement(entry_sequence(new_fasta_dict[seq]))
+                    old_seq = sequence_digest(rc_seq) if packed or digest else rc_seq
+                if old_seq in old_fasta_dict:
+                    length = entry_length(old_fasta_dict[old_seq])
+                    alignment = [old_fasta_dict[old_seq]['id'], 0, length, new_fasta_dict[seq]['id'], 0, length, '-']
+                    if header_check and not old_fasta_dict[old_seq]['id'].split('.')[0] in new_fasta_dict[seq]['header']:
+                        logging.warning('Failed header check (match_identical_sequence): %s -> %s', old_fasta_dict[old_seq]['id'], new_fasta_dict[seq]['id'])
+                    alignment_list.append(alignment)
+                    del old_fasta_dict[old_seq]
+                    del new_fasta_dict[seq]
+
+    def index_old_sequences():
+        # build the k-mer index of the unmatched old sequences, unless a persisted index is used
+        nonlocal old_kmer_index, old_keys
+        if old_kmer_index is None and shard_facts is None:
+            old_keys = list(old_fasta_dict.keys())
+            old_kmer_index = KmerIndex((entry_sequence(old_fasta_dict[k]) for k in old_keys), canonical=both_strands)
+
+    def carry_forward_alignments():
+        # carry forward the unchanged alignment groups of the previous run and remove their sequences from the stages
+        # a group is compared again if a longest N separated segment of a new sequence outside the group is found in
+        # an old sequence of the group, or the other way around, since the stages could then resolve it differently
+        previous_old_digests, previous_new_digests, previous_matched = read_sequence_digests(previous[1])
+        groups = unchanged_alignment_groups(read_alignment_list_tsv(previous[0]), previous_matched, previous_old_digests, previous_new_digests, old_digests, new_digests, both_strands)
+        if digest:
+            load_fasta_dict_sequences(old_fasta_dict, old_fasta_file)
+            load_fasta_dict_sequences(new_fasta_dict, new_fasta_file)
+        old_key = dict((entry['id'], key) for key, entry in old_fasta_dict.items())
+        new_key = dict((entry['id'], key) for key, entry in new_fasta_dict.items())
+        group_of_old = dict((old_key[i], g) for g, group in enumerate(groups) for i in group['old_ids'])
+        group_of_new = dict((new_key[i], g) for g, group in enumerate(groups) for i in group['new_ids'])
+
+        def queries(key):
+            # the longest segment of a new sequence, and its reverse complement if both_strands is set
+            segments = entry_sequence(new_fasta_dict[key]).replace('N', ' ').split()
+            if not segments:
+                return []
+            longest = max(segments, key=len)
+            return [longest, reverse_complement(longest)] if both_strands else [longest]
+
+        def holding(query, old_keys, kmer_index):
+            # the old sequences holding query
+            ordinals = kmer_index.candidate_ordinals(query)
+            return [old_keys[o] for o in (range(len(old_keys)) if ordinals is None else ordinals) if query in entry_sequence(old_fasta_dict[old_keys[o]])]
+
+        carried = set(range(len(groups)))
+        carried_old = list(group_of_old)
+        carried_index = KmerIndex(entry_sequence(old_fasta_dict[k]) for k in carried_old)
+        pending_new = [k for k in new_fasta_dict if k not in group_of_new]
+        pending_old = [k for k in old_fasta_dict if k not in group_of_old]
+        while pending_new or pending_old:
+            reopened = set()
+            for key in pending_new:
+                for query in queries(key):
+                    reopened.update(group_of_old[k] for k in holding(query, carried_old, carried_index) if group_of_old[k] in carried)
+            if pending_old:
+                pending_index = KmerIndex(entry_sequence(old_fasta_dict[k]) for k in pending_old)
+                for key, g in group_of_new.items():
+                    if g in carried and g not in reopened and any(holding(query, pending_old, pending_index) for query in queries(key)):
+                        reopened.add(g)
+            carried -= reopened
+            pending_new = [new_key[i] for g in reopened for i in groups[g]['new_ids']]
+            pending_old = [old_key[i] for g in reopened for i in groups[g]['old_ids']]
+
+        for g in sorted(carried):
+            alignment_list.extend(groups[g]['alignments'])
+            for i in groups[g]['new_ids']:
+                match_links.extend((i, old_id) for old_id in previous_matched.get(i, ()))
+                del new_fasta_dict[new_key[i]]
+            for i in groups[g]['old_ids']:
+                del old_fasta_dict[old_key[i]]
+        logging.info('  Carried forward alignments: %d (%d of %d unchanged groups)', len(alignment_list), len(carried), len(groups))
+        return len(alignment_list)
+
+    def stream_alignments():
+        # write the alignments added since the last call to stream
+        nonlocal streamed_count
+        for alignment in alignment_list[streamed_count:]:
+            if both_strands and len(alignment) == 6:
+                alignment = alignment + ['+']
+            stream.write(('\t'.join(str(a) for a in alignment) + '\n').encode('utf-8'))
+        stream.flush()
+        streamed_count = len(alignment_list)
+
+    def link_matches(new_seq, matches):
+        # remember the old sequences matched by a new sequence, saved with the digests for a later incremental run
+        if digests is not None:
+            match_links.extend((new_fasta_dict[new_seq]['id'], old_fasta_dict[m]['id']) for m in matches)
+
+    def map_new_sequences(worker, new_seqs):
+        # run worker on the index of every new sequence, the results are in the same order as new_seqs
+        # the worker processes are forked after _stage_state is set, so they share the sequences copy-on-write
+        _stage_state.update(new_keys=new_seqs, old_keys=old_keys, old_fasta_dict=old_fasta_dict, new_fasta_dict=new_fasta_dict, old_kmer_index=old_kmer_index, both_strands=both_strands, shard_facts=shard_facts)
+        if shard_facts is not None:
+            worker = _replay_workers[worker]
+        try:
+            return _map_stage_worker(worker, len(new_seqs), jobs)
+        finally:
+            _stage_state.clear()
 
     def match_truncated_sequence():
         # Find 100% substrings, where the full length of a new sequence can be found as a substring of a old sequence
-        old_seqs = old_fasta_dict.keys()
-        new_seqs = new_fasta_dict.keys()
+        # only the old sequences sharing a sampled k-mer with the new sequence can contain it
+        index_old_sequences()
+        new_seqs = list(new_fasta_dict.keys())
         match_truncated = dict() # {matches[0]: {'matches': {new_seq}, 'alignment': [oldid, oldstart, oldend, newid, newstart, newend]}
         match_truncated_order = list()
-        for new_seq in new_seqs:
-            #matches = filter(lambda old_seq: new_seq in old_seq, old_seqs) 
-            matches = [old_seq for old_seq in old_seqs if new_seq in old_seq]
+        for new_seq, (matches, start, strand, comparisons, scanned) in zip(new_seqs, map_new_sequences(_match_truncated_sequence, new_seqs)):
+            stage_stats.count(comparisons, scanned)
+            matches = [old_keys[o] for o in matches]
+            link_matches(new_seq, matches)
             if len(matches) == 1:
-                start = matches[0].find(new_seq)
-                alignment = [old_fasta_dict[matches[0]]['id'], start, start + len(new_seq), new_fasta_dict[new_seq]['id'], 0, len(new_seq)]
+                length = entry_length(new_fasta_dict[new_seq])
+                alignment = [old_fasta_dict[matches[0]]['id'], start, start + length, new_fasta_dict[new_seq]['id'], 0, length]
+                if strand == '-':
+                    alignment.append(strand)
                 if header_check and not old_fasta_dict[matches[0]]['id'].split('.')[0] in new_fasta_dict[new_seq]['header']:
                     logging.warning('Failed header check (match_truncated_sequence): %s -> %s', old_fasta_dict[matches[0]]['id'], new_fasta_dict[new_seq]['id'])
                 # need to check if this match is not a one to multiple mapping
@@ -182,86 +918,34 @@ def fasta_diff(old_fasta_file, new_fasta_file, debug=True, header_check=False, r
         # 1. split new seq by Ns into multiple substrings
         # 2. find an old seq with all substrings and also in order
         # 3. if found, write an alignment line for every substring
-        old_seqs = old_fasta_dict.keys()
-        new_seqs = new_fasta_dict.keys()
+        # an old seq with all substrings must contain the longest one, so only the old seqs returned by the
+        # k-mer index for the longest substring are checked
+        # a new seq that is an old seq of the same length with bases converted to Ns is first compared to the
+        # checked old seqs of the same length, its alignments are the regions where both are equal, at the same
+        # positions in both seqs
+        index_old_sequences()
+        new_seqs = list(new_fasta_dict.keys())
         match_split = dict() # {matches[0]: {'matches': {new_seq}, 'alignment': [oldid, oldstart, oldend, newid, newstart, newend]}
 
         match_split_order = list()
-        for new_seq in new_seqs:
-            segments = new_seq.replace('N', ' ').split()
-            matches = []
-
-            for old_seq in old_seqs:
-                start_original = 0
-                start_new = 0
-                seg_matches = []
-                for segment in segments:
-                    pos = old_seq.find(segment, start_original)
-                    if pos == -1:
-                        break
-                    else:
-                        start_original = pos + len(segment)
-                        pos_new = new_seq.find(segment, start_new)
-                        start_new = pos_new + len(segment)
-                        seg_matches.append([old_fasta_dict[old_seq]['id'], pos, pos + len(segment), new_fasta_dict[new_seq]['id'], pos_new, pos_new + len(segment)])
-                if len(segments) == len(seg_matches):
-                    matches.append((seg_matches, old_seq))
+        for new_seq, (matches, new_matches, comparisons, scanned) in zip(new_seqs, map_new_sequences(_match_split_subsequence, new_seqs)):
+            stage_stats.count(comparisons, scanned)
+            matches = [old_keys[o] for o in matches]
+            link_matches(new_seq, matches)
             if len(matches) == 1:
-                if header_check and not matches[0][0][0][0].split('.')[0] in new_fasta_dict[new_seq]['header']:
-                    logging.warning('Failed header check (match_split_subsequence): %s -> %s', matches[0][0][0][0], matches[0][0][0][3])
-                new_matches = []
-                tmp_oldstart = 0
-                tmp_oldend = 0
-                tmp_newstart = 0
-                tmp_newend = 0
-
-                for match in matches[0][0]:
-                    if match == matches[0][0][0]:
-                        tmp_oldstart = match[1]
-                        tmp_oldend = match[2]
-                        tmp_newstart = match[4]
-                        tmp_newend = match[5]
-                    elif matches[0][1][tmp_oldstart:match[2]] == new_seq[tmp_newstart:match[5]]:
-                        tmp_oldend = match[2]
-                        tmp_newend = match[5]
-                    else:
-                        for nucl in matches[0][1][tmp_oldend:]:
-                            try:
-                                if new_seq[tmp_newend] == nucl:
-                                    tmp_oldend += 1
-                                    tmp_newend += 1
-                                else:
-                                    break
-                            except:
-                                break
-                        new_matches.append([match[0], tmp_oldstart, tmp_oldend, match[3], tmp_newstart, tmp_newend])
-                        tmp_oldstart = match[1]
-                        tmp_oldend = match[2]
-                        tmp_newstart = match[4]
-                        tmp_newend = match[5]
-                #check if the new sequence end with N
-                for nucl in matches[0][1][tmp_oldend:]:
-                    try:
-                        if new_seq[tmp_newend] == nucl:
-                            tmp_oldend += 1
-                            tmp_newend += 1
-                        else:
-                            break
-                    except:
-                        break
-
-                new_matches.append([match[0], tmp_oldstart, tmp_oldend, match[3], tmp_newstart, tmp_newend])
-                if matches[0][1] not in match_split:
-                    match_split_order.append(matches[0][1])
-                    match_split[matches[0][1]] = {
+                if header_check and not old_fasta_dict[matches[0]]['id'].split('.')[0] in new_fasta_dict[new_seq]['header']:
+                    logging.warning('Failed header check (match_split_subsequence): %s -> %s', old_fasta_dict[matches[0]]['id'], new_fasta_dict[new_seq]['id'])
+                if matches[0] not in match_split:
+                    match_split_order.append(matches[0])
+                    match_split[matches[0]] = {
                         'matches': list(),
                         'alignment': list()
                     }
-                match_split[matches[0][1]]['matches'].append(new_seq)
-                match_split[matches[0][1]]['alignment'].extend(new_matches)
+                match_split[matches[0]]['matches'].append(new_seq)
+                match_split[matches[0]]['alignment'].extend(new_matches)
 
             elif len(matches) > 1:
-                logging.warning('Failed one to one mapping: %s has %d matches: %s\n' % (new_fasta_dict[new_seq]['id'], len(matches), ','.join([x[0][0][0].split('.')[0] for x in matches])))
+                logging.warning('Failed one to one mapping: %s has %d matches: %s\n' % (new_fasta_dict[new_seq]['id'], len(matches), ','.join([old_fasta_dict[x]['id'].split('.')[0] for x in matches])))
 
         onetomultiple.update(match_split)
         for match in match_split_order:
@@ -273,41 +957,14 @@ def fasta_diff(old_fasta_file, new_fasta_file, debug=True, header_check=False, r
                 del match_split[match]
 
     def one_to_multiple_match():
-        stagelist=list()
         stage_four_result=list()
         for match in onetomultiple:
             # one to mutiple
             if len(onetomultiple[match]['matches']) > 1:
-                stagelist.extend(onetomultiple[match]['alignment'])
-
-                overlap=dict()
-                #Fetch old_id and new_id
-                for tmp in stagelist:
-                    pair=((tmp[0]),(tmp[3]))
-                    if pair not in overlap:
-                       overlap[pair]=set()
-                    overlap[pair].update((tmp[1],tmp[2]))
-                pairs=overlap.keys()
-                pairs_sort=sorted(pairs, key=lambda aaa:aaa[0])
-                run_sort=set()
-                #Record the pair that has been run
-                delete_pairs=set()
-
-                for pair1 in pairs_sort:
-                    for pair2 in pairs_sort:
-                        if pair1==pair2:
-                            continue
-                        else:
-                            if (pair1,pair2) in run_sort:
-                                continue
-                            run_sort.update([(pair1,pair2),(pair2,pair1)])
-                            if pair1[0]==pair2[0]:
-                                # find overlap pair
-                                if (min(overlap[pair1])<=min(overlap[pair2]) and min(overlap[pair2])<=max(overlap[pair1]))\
-                                or (min(overlap[pair1])<=max(overlap[pair2]) and max(overlap[pair2])<=max(overlap[pair1])):
-
-                                    delete_pairs.update((pair1,pair2))
-                                    # add overlap pair to delete_pairs
+                stagelist = onetomultiple[match]['alignment']
+                stage_stats.count(comparisons=len(stagelist))
+                # drop every new sequence whose old region overlaps the region of another new sequence
+                delete_pairs = find_overlapping_pairs(stagelist)
 
                 for delete in stagelist:
                    if (delete[0],delete[3]) not in delete_pairs:
@@ -324,52 +981,174 @@ def fasta_diff(old_fasta_file, new_fasta_file, debug=True, header_check=False, r
             alignment_list.extend(stage_four_result)
         # add empty to final result
 
+    def match_edited_sequence():
+        # Find near-identical sequences with small edits, seeded by the k-mers shared with the old sequences
+        index_old_sequences()
+        new_seqs = list(new_fasta_dict.keys())
+        match_edited = dict() # {matches[0]: {'matches': [new_seq], 'alignment': [[oldid, oldstart, oldend, newid, newstart, newend], ...]}
+        match_edited_order = list()
+        for new_seq, (matches, new_matches, comparisons, scanned) in zip(new_seqs, map_new_sequences(_match_edited_sequence, new_seqs)):
+            stage_stats.count(comparisons, scanned)
+            matches = [old_keys[o] for o in matches]
+            link_matches(new_seq, matches)
+            if len(matches) == 1 and new_matches is not None:
+                if header_check and not old_fasta_dict[matches[0]]['id'].split('.')[0] in new_fasta_dict[new_seq]['header']:
+                    logging.warning('Failed header check (match_edited_sequence): %s -> %s', old_fasta_dict[matches[0]]['id'], new_fasta_dict[new_seq]['id'])
+                if matches[0] not in match_edited:
+                    match_edited_order.append(matches[0])
+                    match_edited[matches[0]] = {
+                        'matches': list(),
+                        'alignment': None
+                    }
+                match_edited[matches[0]]['matches'].append(new_seq)
+                match_edited[matches[0]]['alignment'] = new_matches
+            elif len(matches) > 1:
+                logging.warning('Failed one to one mapping: %s has %d matches: %s\n' % (new_fasta_dict[new_seq]['id'], len(matches), ','.join([old_fasta_dict[x]['id'].split('.')[0] for x in matches])))
+        for match in match_edited_order:
+            if len(match_edited[match]['matches']) == 1:
+                # one to one
+                alignment_list.extend(match_edited[match]['alignment'])
+                del old_fasta_dict[match] # matches[0]
+                del new_fasta_dict[match_edited[match]['matches'][0]] # new_seq
+
     stages = [match_identical_sequence, match_truncated_sequence, match_split_subsequence,one_to_multiple_match]
+    if edits:
+        stages.append(match_edited_sequence)
+    checkpoint = None
+    if debug and checkpoint_dir is None:
+        checkpoint_dir = 'fasta_diff_checkpoint'
+    if checkpoint_dir is not None:
+        # the checkpoints of a run matching both strands can not be used by a run that doesn't
+        checkpoint = StageCheckpoint(checkpoint_dir, [old_fasta_file, new_fasta_file] + list(previous or []), __version__ + ('+both_strands' if both_strands else ''))
+        logging.info('Checkpoint directory: %s', checkpoint.directory)
+
+    if stream is not None:
+        stream.write((STREAM_BEGIN + '\n').encode('utf-8'))
+        stream.flush()
+
+    # use sequence as dict key
+    #163023 unique sequences in original fasta file
+    #161988 unique sequences in new fasta file
+    stage_stats.start(0, 'read_fasta_files')
+    logging.info('Reading old FASTA file (%s)...', old_fasta_file)
+    if shards is not None:
+        # the shards refer to the old sequences by their position in the packed store
+        old_store = open_packed_store(old_fasta_file)
+        if any(shard['old_store_digest'] != store_digest(old_store) for shard in shards):
+            raise ValueError('The shards were not run against the sequences of %s' % old_fasta_file)
+        old_keys = [r['digest'] for r in old_store.records]
+        old_fasta_dict, old_fasta_count = packed_store_to_dict(old_store)
+    elif old_index:
+        # the old sequences are keyed by digest, so the new ones are too
+        old_store, old_kmer_index = open_old_index(old_fasta_file, canonical=both_strands)
+        old_keys = [r['digest'] for r in old_store.records]
+        old_fasta_dict, old_fasta_count = packed_store_to_dict(old_store)
+        digest = digest or not packed
+    elif packed:
+        # use sequence digest as dict key
+        old_fasta_dict, old_fasta_count = packed_store_to_dict(open_packed_store(old_fasta_file))
+    elif digest:
+        old_fasta_dict, old_fasta_count = fasta_file_to_digest_dict(old_fasta_file)
+        stage_stats.count(scanned=getsize(old_fasta_file))
+    else:
+        old_fasta_dict, old_fasta_count = fasta_file_to_dict(old_fasta_file, id=False, header=False, seq=True)
+        stage_stats.count(scanned=getsize(old_fasta_file))
+
+    if not len(old_fasta_dict) == old_fasta_count:
+        logging.warning('  Duplicate sequences detected in old FASTA file, %d unique sequences out of a total of %d sequences', len(old_fasta_dict), old_fasta_count)
+        if not query_yes_no('Ignore and continue?'):
+            sys.exit(1)
+    else:
+        logging.info('  Unique sequences: %d', len(old_fasta_dict))
+
+    logging.info('Reading new FASTA file (%s)...', new_fasta_file)
+    if shards is not None:
+        # the new sequences are not read, their shards hold everything the stages need
+        new_fasta_dict, new_fasta_count, shard_facts = shard_facts_to_dict(shards)
+    elif packed:
+        new_fasta_dict, new_fasta_count = packed_store_to_dict(open_packed_store(new_fasta_file))
+    elif digest:
+        new_fasta_dict, new_fasta_count = fasta_file_to_digest_dict(new_fasta_file)
+        stage_stats.count(scanned=getsize(new_fasta_file))
+    else:
+        new_fasta_dict, new_fasta_count = fasta_file_to_dict(new_fasta_file, id=False, header=False, seq=True)
+        stage_stats.count(scanned=getsize(new_fasta_file))
+    if not len(new_fasta_dict) == new_fasta_count:
+        logging.warning('Duplicate sequences detected in new FASTA file, %d unique sequences out of a total of %d sequences', len(new_fasta_dict), new_fasta_count)
+        if not query_yes_no('Ignore and continue?'):
+            sys.exit(1)
+    else:
+        logging.info('  Unique sequences: %d', len(new_fasta_dict))
+
+    if previous is not None or digests is not None:
+        # the dict keys are the sequences unless they are digests already
+        key_digest = (lambda key: key) if packed or digest or shards is not None else sequence_digest
+        old_digests = dict((entry['id'], key_digest(key)) for key, entry in old_fasta_dict.items())
+        new_digests = dict((entry['id'], key_digest(key)) for key, entry in new_fasta_dict.items())
+    carried_alignments = None
+    if previous is not None:
+        logging.info('Reading previous run (%s, %s)...', previous[0], previous[1])
+        carried_alignments = carry_forward_alignments()
+    stage_stats.stop(old_sequences=old_fasta_count, new_sequences=new_fasta_count, carried_alignments=carried_alignments)
+    if stream is not None:
+        stream_alignments()
+
+    # checkpoints refer to the sequences by their position in the dicts as read
+    old_initial_keys, new_initial_keys = list(old_fasta_dict), list(new_fasta_dict)
+    old_ordinal = dict((key, i) for i, key in enumerate(old_initial_keys))
+    new_ordinal = dict((key, i) for i, key in enumerate(new_initial_keys))
+
     matched_sequence_count = 0
+    resuming = checkpoint is not None
     for stage in range(len(stages)):
-        temp_file_name = ''
-        if debug:
-            temp_file_name = old_fasta_file.split("/")[-1] + '_' + new_fasta_file.split("/")[-1] + '_stage_' + str(stage + 1) + '_pickle'        
-        if isfile(temp_file_name): 
-            (alignment_list, old_fasta_dict, new_fasta_dict) = pickle.load(open(temp_file_name, 'rb'))
+        stage_stats.start(stage + 1, stages[stage].__name__)
+        delta = checkpoint.load(stage + 1) if resuming else None
+        if delta is not None:
+            logging.info('Stage %d - %s: resumed from checkpoint', stage + 1, stages[stage].__name__)
+            alignment_list.extend(delta['alignments'])
+            match_links.extend(tuple(link) for link in delta.get('links', []))
+            for o in delta['old_removed']:
+                del old_fasta_dict[old_initial_keys[o]]
+            for o in delta['new_removed']:
+                del new_fasta_dict[new_initial_keys[o]]
+            onetomultiple.clear()
+            for o, matches, alignments in delta['onetomultiple']:
+                onetomultiple[old_initial_keys[o]] = {'matches': [new_initial_keys[n] for n in matches], 'alignment': alignments}
         else:
-            if old_fasta_dict == None and new_fasta_dict == None:
-                # use sequence as dict key
-                #163023 unique sequences in original fasta file
-                #161988 unique sequences in new fasta file
-                logging.info('Reading old FASTA file (%s)...', old_fasta_file)
-                old_fasta_dict, old_fasta_count = fasta_file_to_dict(old_fasta_file, id=False, header=False, seq=True)
-                
-                if not len(old_fasta_dict) == old_fasta_count:
-                    logging.warning('  Duplicate sequences detected in old FASTA file, %d unique sequences out of a total of %d sequences', len(old_fasta_dict), old_fasta_count)
-                    if not query_yes_no('Ignore and continue?'):
-                        sys.exit(1)
-                else:
-                    logging.info('  Unique sequences: %d', len(old_fasta_dict))
-
-                logging.info('Reading new FASTA file (%s)...', new_fasta_file)
-                new_fasta_dict, new_fasta_count = fasta_file_to_dict(new_fasta_file, id=False, header=False, seq=True)
-                if not len(new_fasta_dict) == new_fasta_count:
-                    logging.warning('Duplicate sequences detected in new FASTA file, %d unique sequences out of a total of %d sequences', len(new_fasta_dict), new_fasta_count)
-                    if not query_yes_no('Ignore and continue?'):
-                        sys.exit(1)
-                else:
-                    logging.info('  Unique sequences: %d', len(new_fasta_dict))
-
+            # a stage depends on all previous stages, later checkpoints can not be used once a stage is run
+            resuming = False
+            old_before, new_before, alignment_count, link_count = set(old_fasta_dict), set(new_fasta_dict), len(alignment_list), len(match_links)
             logging.info('Stage %d - %s:', stage + 1, stages[stage].__name__)
             stages[stage]()
 
-            if debug:
-                pickle.dump((alignment_list, old_fasta_dict, new_fasta_dict), open(temp_file_name, 'wb'))
+            if checkpoint is not None:
+                checkpoint.save(stage + 1, {
+                    'alignments': alignment_list[alignment_count:],
+                    'links': match_links[link_count:],
+                    'old_removed': sorted(old_ordinal[k] for k in old_before if k not in old_fasta_dict),
+                    'new_removed': sorted(new_ordinal[k] for k in new_before if k not in new_fasta_dict),
+                    'onetomultiple': [[old_ordinal[k], [new_ordinal[n] for n in v['matches']], v['alignment']] for k, v in onetomultiple.items()]
+                })
 
+        if digest:
+            # the stages after stage 1 compare the sequences, load the unmatched ones
+            if load_fasta_dict_sequences(old_fasta_dict, old_fasta_file):
+                stage_stats.count(scanned=getsize(old_fasta_file))
+            if load_fasta_dict_sequences(new_fasta_dict, new_fasta_file):
+                stage_stats.count(scanned=getsize(new_fasta_file))
+
+        if stream is not None:
+            stream_alignments()
         new_matched_sequence_count = len(set([a[0] for a in alignment_list]))
+        stage_stats.stop(resumed=delta is not None, matched_sequences=new_matched_sequence_count,
+                         unmatched_old=len(old_fasta_dict), unmatched_new=len(new_fasta_dict))
         logging.info('  Matched sequences: %d (New : %d)', new_matched_sequence_count, new_matched_sequence_count - matched_sequence_count)
         logging.info('  Unmatched sequences in old FASTA: %d', len(old_fasta_dict))
         logging.info('  Unmatched sequences in new FASTA: %d', len(new_fasta_dict))
 
 
         matched_sequence_count = new_matched_sequence_count
-        if debug:
+        if unmatched:
             fasta_dict_to_file(old_fasta_dict, old_fasta_file + '_stage_' + str(stage + 1) + '_unmatched')
             fasta_dict_to_file(new_fasta_dict, new_fasta_file + '_stage_' + str(stage + 1) + '_unmatched')
         if report is not None:
@@ -379,59 +1158,226 @@ def fasta_diff(old_fasta_file, new_fasta_file, debug=True, header_check=False, r
             with open(report, 'a') as out_report:
                 if report_header:
                     out_report.write('#Sequence_ID\tSequence_length\tUnmatched_stage\n')
-                for unmatched in new_fasta_dict:
-                    out_report.write('\t'.join([new_fasta_dict[unmatched]['id'], str(len(new_fasta_dict[unmatched]['seq'])), 'Stage %d' % (stage + 1)]) + '\n')
+                for new_key in new_fasta_dict:
+                    out_report.write('\t'.join([new_fasta_dict[new_key]['id'], str(entry_length(new_fasta_dict[new_key])), 'Stage %d' % (stage + 1)]) + '\n')
 
+    if both_strands:
+        for alignment in alignment_list:
+            if len(alignment) == 6:
+                alignment.append('+')
+    if stream is not None:
+        stream.write((STREAM_END + '\n').encode('utf-8'))
+        stream.flush()
+    if digests is not None:
+        matched_old_ids = dict()
+        for new_id, old_id in match_links + [(a[3], a[0]) for a in alignment_list]:
+            matched_old_ids.setdefault(new_id, set()).add(old_id)
+        write_sequence_digests(digests, old_digests, new_digests, matched_old_ids)
+    if stats is not None:
+        stage_stats.write(stats, version=__version__, old_fasta=old_fasta_file, new_fasta=new_fasta_file, jobs=jobs,
+                          packed=packed, digest=digest, old_index=old_index, edits=edits,
+                          both_strands=both_strands, shards=len(shards) if shards is not None else None,
+                          previous=previous[0] if previous is not None else None,
+                          alignments=len(alignment_list))
     return alignment_list, old_fasta_dict, new_fasta_dict
 
+def fasta_diff_shard(old_fasta_file, new_fasta_file, shard, shards, jobs=1, both_strands=False):
+    """
+    Run the sequence comparisons of fasta_diff for one shard of the new FASTA file, the sequences whose record number
+    (0-based) modulo shards is shard, against the persisted index of the old FASTA file (see open_old_index).
+    Every shard is an independent job, fasta_diff with the results of all the shards replays the stages and outputs
+    the same alignments as a single run, except for stage 5 which is not run.
+    :param old_fasta_file: a string path
+    :param new_fasta_file: a string path
+    :param int shard: the shard, 0 <= shard < shards
+    :param int shards: the number of shards
+    :param jobs: The number of processes matching the new sequences of the shard
+    :param both_strands: If True, the reverse complements of the new sequences are matched as well, the shards
+        are merged by fasta_diff with both_strands set
+    :return: a JSON serializable dict
+    """
+    if not 0 <= shard < shards:
+        raise ValueError('The shard has to be in [0, %d)' % shards)
+    logging.info('Reading old FASTA file (%s)...', old_fasta_file)
+    old_store, old_kmer_index = open_old_index(old_fasta_file, canonical=both_strands)
+    old_keys = [r['digest'] for r in old_store.records]
+    old_fasta_dict, old_fasta_count = packed_store_to_dict(old_store)
+    logging.info('Reading new FASTA file (%s), shard %d of %d...', new_fasta_file, shard + 1, shards)
+    new_fasta_dict = dict()
+    new_fasta_count = 0
+    for record, (entry_header, entry_seq) in enumerate(read_fasta(new_fasta_file)):
+        new_fasta_count += 1
+        if record % shards == shard:
+            new_fasta_dict[record] = {'header': entry_header, 'id': entry_header.split()[0][1:] if entry_header[1:].split() else '', 'seq': entry_seq.upper(), 'record': record}
+    logging.info('  Sequences in shard: %d', len(new_fasta_dict))
+    new_keys = list(new_fasta_dict)
+    _stage_state.update(new_keys=new_keys, old_keys=old_keys, old_fasta_dict=old_fasta_dict, new_fasta_dict=new_fasta_dict, old_kmer_index=old_kmer_index, both_strands=both_strands)
+    try:
+        records = _map_stage_worker(_shard_sequence_facts, len(new_keys), jobs)
+    finally:
+        _stage_state.clear()
+    return {'version': __version__, 'shard': shard, 'shards': shards, 'both_strands': both_strands,
+            'old_store_digest': store_digest(old_store), 'new_fasta': new_fasta_file,
+            'new_fasta_size': getsize(new_fasta_file), 'new_sequences': new_fasta_count, 'records': records}
+
+def shard_main(argv):
+    parser = argparse.ArgumentParser(prog='fasta_diff shard', description=dedent("""\
+    Runs the sequence comparisons of fasta_diff for one shard of the new FASTA file, the sequences whose record number
+    (0-based) modulo SHARDS is SHARD, against the persisted index of the old FASTA file (built when missing, see
+    "fasta_diff index"). The shards are independent jobs that can run on different nodes, "fasta_diff merge" combines
+    their results into the same alignments as a single fasta_diff run.
+    """))
+    parser.add_argument('old_fasta', type=str, help='The original FASTA file')
+    parser.add_argument('new_fasta', type=str, help='The new FASTA file')
+    parser.add_argument('-n', '--shards', type=int, required=True, help='The number of shards')
+    parser.add_argument('-k', '--shard', type=int, required=True, help='The shard run by this job, from 0 to SHARDS - 1')
+    parser.add_argument('-o', '--out', type=str, required=True, help='The output shard file (JSON)')
+    parser.add_argument('-b', '--both_strands', action='store_true',
+                        help='If set, the reverse complements of the new sequences are matched as well, as fasta_diff --both_strands')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes used to match the new sequences of the shard (default: 1)')
+    parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
+    args = parser.parse_args(argv)
+    result = fasta_diff_shard(args.old_fasta, args.new_fasta, args.shard, args.shards, jobs=args.jobs, both_strands=args.both_strands)
+    with open(args.out, 'w', encoding='utf-8') as out_f:
+        json.dump(result, out_f)
+
+def merge_main(argv):
+    parser = argparse.ArgumentParser(prog='fasta_diff merge', description=dedent("""\
+    Combines the shard files written by "fasta_diff shard" for every shard of a new FASTA file: stages 1 to 4 are
+    replayed from the matches of the shards, resolving the one to one and one to multiple mappings over all the
+    shards, and the alignments are the same as the ones of a single fasta_diff run.
+    """))
+    parser.add_argument('old_fasta', type=str, help='The original FASTA file')
+    parser.add_argument('shard_files', type=str, nargs='+', help='The shard files, one for each shard')
+    parser.add_argument('-o', '--out', nargs='?', type=argparse.FileType('wb'), default=sys.stdout.buffer, help='The output alignment file (default: STDOUT)')
+    parser.add_argument('-r', '--report', type=str, help='Generate a report for the unmatched sequences in new FASTA file.')
+    parser.add_argument('-s', '--stats', type=str, help='Write a JSON report of each stage, see fasta_diff --stats.')
+    parser.add_argument('-hc', '--header_check', action='store_true',
+                        help='If set, confirm the detected mapping by checking the header of the new sequence for the id of the mapped old sequence.')
+    parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
+    args = parser.parse_args(argv)
+    if args.report and isfile(args.report):
+        remove(args.report)
+    shards = read_shard_files(args.shard_files)
+    alignment_list, old_fasta_dict, new_fasta_dict = fasta_diff(args.old_fasta, shards[0]['new_fasta'], debug=False, header_check=args.header_check, report=args.report, stats=args.stats, both_strands=shards[0]['both_strands'], shards=shards)
+    for alignment in alignment_list:
+        args.out.write(('\t'.join(str(a) for a in alignment) + '\n').encode('utf-8'))
+    args.out.close()
+
+def compile_main(argv):
+    parser = argparse.ArgumentParser(prog='fasta_diff compile', description=dedent("""\
+    Compiles an alignment file written by fasta_diff into a binary file of sorted integer columns and a sequence id
+    table. The conversion scripts memory-map a compiled file given to -a instead of parsing the TSV file.
+    """))
+    parser.add_argument('alignment_file', type=str, help='The alignment file generated by fasta_diff')
+    parser.add_argument('-o', '--out', type=str, required=True, help='The output compiled alignment file')
+    parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
+    args = parser.parse_args(argv)
+    write_compiled_alignments(read_alignment_list_tsv(args.alignment_file), args.out)
+    logging.info('Compiled alignment file: %s', args.out)
+
+def index_main(argv):
+    parser = argparse.ArgumentParser(prog='fasta_diff index', description=dedent("""\
+    Builds the persisted index of an old FASTA file: a packed store of the sequences with their digests and lengths
+    (OLD_FASTA.pack) and a k-mer index of the sequences (OLD_FASTA.kmi, or OLD_FASTA.ckmi for --both_strands).
+    fasta_diff -i memory-maps them instead of reading and indexing the old FASTA file on every run.
+    """))
+    parser.add_argument('old_fasta', type=str, help='The original FASTA file')
+    parser.add_argument('-b', '--both_strands', action='store_true',
+                        help='If set, build the canonical k-mer index used by fasta_diff -i --both_strands')
+    parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
+    args = parser.parse_args(argv)
+    store, kmer_index = open_old_index(args.old_fasta, rebuild=True, canonical=args.both_strands)
+    logging.info('Indexed %d sequences (%s, %s)', len(store), store.store_file, kmer_index.index_file)
+
 def main():
+    if sys.argv[1:2] == ['index']:
+        return index_main(sys.argv[2:])
+    if sys.argv[1:2] == ['compile']:
+        return compile_main(sys.argv[2:])
+    if sys.argv[1:2] == ['shard']:
+        return shard_main(sys.argv[2:])
+    if sys.argv[1:2] == ['merge']:
+        return merge_main(sys.argv[2:])
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=dedent("""\
     Compares two very similar FASTA files and outputs coordinate mappings using a multi stage algorithm:
     Stage 1: Find 100% matches
     Stage 2: Find 100% substrings, where the full length of a new sequence can be found as a substring of a old sequence
     Stage 3: Find cases where part of the sequence was converted into Ns
+    Stage 4: Find cases where a old sequence is split into two or more new sequences
+    Stage 5 (with --edits): Find near-identical sequences with small edits, output as one line per gapless block
     Outputs the 6 columns as tab-separated values: old_id, old_start, old_end, new_id, new_start, new_end
     Originally created to compare the NCBI version to the original reference of Diaphorina citri
 
     Example:
         fasta_diff example_file/old.fa example_file/new.fa -o match.tsv -r report.txt
+
+    Build the persisted index of an old FASTA file compared to many new ones, then use it with -i:
+        fasta_diff index example_file/old.fa
+        fasta_diff example_file/old.fa example_file/new.fa -i -o match.tsv
+
+    Write a compiled alignment file memory-mapped by the conversion scripts, or compile an existing one:
+        fasta_diff example_file/old.fa example_file/new.fa -o match.tsv --compiled match.cca
+        fasta_diff compile match.tsv -o match.cca
+
+    Save the sequence digests of a run, then only compare the sequences changed in the next version:
+        fasta_diff example_file/old.fa example_file/new.fa -o match.tsv --digests digests.tsv
+        fasta_diff example_file/old.fa new_v2.fa -o match_v2.tsv --previous match.tsv digests.tsv
+
+    Split the new FASTA file into shards run as independent jobs, then merge them:
+        fasta_diff shard example_file/old.fa example_file/new.fa -n 2 -k 0 -o shard_0.json
+        fasta_diff shard example_file/old.fa example_file/new.fa -n 2 -k 1 -o shard_1.json
+        fasta_diff merge example_file/old.fa shard_0.json shard_1.json -o match.tsv
     """))
     parser.add_argument('old_fasta', type=str, help='The original FASTA file')
     parser.add_argument('new_fasta', type=str, help='The new FASTA file')
-    parser.add_argument('-o', '--out', nargs='?', type=argparse.FileType('wb'), default=sys.stdout, help='The output alignment file (default: STDOUT)')
+    parser.add_argument('-o', '--out', nargs='?', type=argparse.FileType('wb'), default=sys.stdout.buffer, help='The output alignment file (default: STDOUT)')
     parser.add_argument('-r', '--report', type=str, help='Generate a report for the unmatched sequences in new FASTA file.')
+    parser.add_argument('-s', '--stats', type=str,
+                        help='Write a JSON report of the wall time, CPU time, peak memory, number of candidate comparisons and bytes scanned of each stage, to compare assembly pairs or releases.')
     parser.add_argument('-d', '--debug', action='store_true',
-                        help='If set, partial results are saved in a *_stage_i_pickle file after each stage, unmatched sequences after each stage are saved in a *_stage_i_unmatched file for both FASTA files.')
+                        help='If set, checkpoints are saved after each stage (in CHECKPOINT_DIR, default: fasta_diff_checkpoint).')
+    parser.add_argument('-u', '--unmatched', action='store_true',
+                        help='If set, the sequences left unmatched after each stage are saved in a *_stage_i_unmatched file for both FASTA files.')
+    parser.add_argument('-c', '--checkpoint_dir', type=str,
+                        help='If set, the changes made by each stage are saved in this directory, keyed on the content of the FASTA files and the program version. An interrupted run with the same inputs resumes after the last saved stage.')
     parser.add_argument('-hc', '--header_check', action='store_true',
                         help='If set, confirm the detected mapping by checking the header of the new sequence for the id of the mapped old sequence.')
+    parser.add_argument('-p', '--packed', action='store_true',
+                        help='If set, sequences are read from memory-mapped 2-bit packed stores (FASTA_FILE.pack, built when missing or outdated) instead of being loaded into memory.')
+    parser.add_argument('-g', '--digest', action='store_true',
+                        help='If set, identical sequences are found by comparing digests computed while reading the FASTA files, only the sequences unmatched after stage 1 are loaded into memory.')
+    parser.add_argument('-i', '--old_index', action='store_true',
+                        help='If set, the old sequences and their k-mer index are memory-mapped from the persisted index of the old FASTA file (OLD_FASTA.pack and OLD_FASTA.kmi, built by "fasta_diff index OLD_FASTA" or when missing or outdated).')
+    parser.add_argument('-b', '--both_strands', action='store_true',
+                        help='If set, new sequences not found are searched again as their reverse complement and a seventh column is written with the strand of each alignment, "+" or "-".')
+    parser.add_argument('-e', '--edits', action='store_true',
+                        help='If set, run stage 5: match each remaining new sequence to the old sequence sharing the most k-mers, allowing substitutions and indels up to 16 bases, and output a line for each gapless block.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of processes used to match new sequences in stage 2, 3 and 5 (default: 1)')
+    parser.add_argument('--stream', action='store_true',
+                        help='If set, the alignments of each stage are written to the output as soon as the stage finishes, between two comment lines marking the start and the end of the stream, so a conversion script reading the output from a pipe can start early and detect an incomplete run.')
+    parser.add_argument('--compiled', type=str,
+                        help='Also write the alignments to this compiled file, memory-mapped by the conversion scripts instead of parsing the output (see "fasta_diff compile").')
+    parser.add_argument('--digests', type=str,
+                        help='Write the digest of every old and new sequence to this file, for a later incremental run with --previous.')
+    parser.add_argument('--previous', type=str, nargs=2, metavar=('MATCH_TSV', 'DIGESTS_TSV'),
+                        help='The output and the --digests file of a previous run with the same old or new FASTA file: the alignments of the sequences that did not change are carried forward and only the other sequences are compared.')
     parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
 
-    test_lv = 0 # debug
-    if test_lv == 1:
-        args = parser.parse_args(['diaci1.1.fa', '121845_ref_Diaci_psyllid_genome_assembly_version_1.1_chrUn.fa'])
-        alignment_list, old_fasta_dict, new_fasta_dict = fasta_diff(args.old_fasta, args.new_fasta, debug=True)
-
-        # Looks like we're done! Output alignment_list
-        pickle.dump(alignment_list, open('alignment_list.pickle', 'wb'))
-        with open('alignment_list.tsv', 'wb') as f:
-            for alignment in alignment_list:
-                f.write('\t'.join([str(a) for a in alignment]) + '\n')
-    else:
-        args = parser.parse_args()
-        # remove existing report
-        if args.report:
-            if isfile(args.report):
-                remove(args.report)
-        alignment_list, old_fasta_dict, new_fasta_dict = fasta_diff(args.old_fasta, args.new_fasta, debug=args.debug, header_check=args.header_check, report=args.report)
-        
-        if args.debug:
-            alignment_list_pickle_file = args.out.name + '_pickle'
-            if args.out.name == '<stdout>':
-                alignment_list_pickle_file = 'alignment_list_pickle'
-            pickle.dump(alignment_list, open(alignment_list_pickle_file, 'wb'))
+    args = parser.parse_args()
+    # remove existing report
+    if args.report:
+        if isfile(args.report):
+            remove(args.report)
+    alignment_list, old_fasta_dict, new_fasta_dict = fasta_diff(args.old_fasta, args.new_fasta, debug=args.debug, header_check=args.header_check, report=args.report, jobs=args.jobs, packed=args.packed, digest=args.digest, checkpoint_dir=args.checkpoint_dir, old_index=args.old_index, stats=args.stats, edits=args.edits, both_strands=args.both_strands, previous=args.previous, digests=args.digests, stream=args.out if args.stream else None, unmatched=args.unmatched)
+    if args.compiled:
+        write_compiled_alignments(alignment_list, args.compiled)
+    if not args.stream:
         for alignment in alignment_list:
             args.out.write(('\t'.join(str(a) for a in alignment) + '\n').encode('utf-8'))
-        args.out.close()
+    args.out.close()
 
 if __name__ == '__main__':
     main()
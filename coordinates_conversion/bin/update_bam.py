@@ -7,23 +7,24 @@ Update the sequence id and coordinates of a Bam file using an alignment file gen
 
 __version__ = '2.0'
 
-from collections import defaultdict
 import logging
 import pysam
+import re
 import sys
 import argparse
 from textwrap import dedent
+from coordinates_conversion.alignment import NewSequenceSummary, alignment_strand, convert_boundary, open_alignment_index, read_alignment_list_tsv
+from coordinates_conversion.fasta import reverse_complement
 
 logging.basicConfig(level=logging.DEBUG, format='%(levelname)-8s %(message)s')
 
 class BamUpdater(object):
 
     def __init__(self, alignment_list_tsv_file, updated_postfix, removed_postfix):
-        self.alignment_list = BamUpdater.read_alignment_list_tsv(alignment_list_tsv_file)
-        # create a dictionary to lookup alignments using old_id as key
-        self.alignment_dict = defaultdict(list)
-        for a in self.alignment_list:
-            self.alignment_dict[a[0]].append(a)
+        # lookup the alignments of an old_id, and the ones holding a coordinate, a compiled alignment file is memory-mapped
+        self.alignment_dict = open_alignment_index(alignment_list_tsv_file)
+        # the region of each new sequence covered by the alignments of each old sequence, for the @SQ lines
+        self.sequence_summary = NewSequenceSummary(self.alignment_dict.alignments())
         self.updated_postfix = updated_postfix
         self.removed_postfix = removed_postfix
 
@@ -38,32 +39,58 @@ class BamUpdater(object):
         self._update_features()
 
 
+    # kept for the callers of the former per-class parser
+    read_alignment_list_tsv = staticmethod(read_alignment_list_tsv)
+
     @staticmethod
-    def read_alignment_list_tsv(alignment_list_tsv_file):
+    def _mate_end(read):
         """
-        Parse an alignment_list_tsv and returns a list
-        :param alignment_list_tsv_file: The output alignment file of fasta_diff
-        :type alignment_list_tsv_file: string or file
-        :return: a list of [old_id, old_start, old_end, new_id, new_start, new_end]
+        Returns the 0-based end of the mate of a read computed from its MC (mate CIGAR) tag, or None without the tag
         """
-        tsv_format = [str, int, int, str, int, int]
-        alignment_list_tsv_file_f = alignment_list_tsv_file
-        if isinstance(alignment_list_tsv_file, str):
-            logging.info('  Reading alignment data from: %s...', alignment_list_tsv_file_f.name)
-            alignment_list_tsv_file_f = open(alignment_list_tsv_file, 'rb')
+        if not read.has_tag('MC'):
+            return None
+        return read.next_reference_start + sum(int(n) for n, op in re.findall(r'(\d+)([MDN=X])', read.get_tag('MC')))
 
-        alignment_list = []
-        for line in alignment_list_tsv_file_f:
-            line = str(line,'utf-8')
-            alignment_list.append([f(t) for f, t in zip(tsv_format, line.split('\t'))])
+    @staticmethod
+    def _reverse_cigar(cigar):
+        """
+        Returns a CIGAR string, such as the MC (mate CIGAR) tag, for the reverse strand
+        """
+        return ''.join(reversed(re.findall(r'\d+[^\d]', cigar)))
 
-        if isinstance(alignment_list_tsv_file, str):
-            alignment_list_tsv_file_f.close()
-        else:
-            logging.info('  Reading alignment data from: %s...', alignment_list_tsv_file_f.name)
-        logging.info('  Alignments: %d', len(alignment_list))
+    @staticmethod
+    def _reverse_md(md):
+        """
+        Returns an MD tag for the reverse strand: the matching runs, mismatched bases and deleted bases in reverse
+        order, with the bases complemented
+        """
+        tokens = []
+        for token in reversed(re.findall(r'\d+|\^[A-Za-z]+|[A-Za-z]', md)):
+            if token[0] == '^':
+                token = '^' + reverse_complement(token[1:])
+            elif not token.isdigit():
+                token = reverse_complement(token)
+            tokens.append(token)
+        return ''.join(tokens)
 
-        return alignment_list
+    @staticmethod
+    def _copy_read(read, header):
+        """
+        Copies a read to a new record of header, without its reference ids and positions
+        :param read: a pysam.AlignedSegment
+        :param header: the pysam.AlignmentHeader of the new record
+        :return: a pysam.AlignedSegment
+        """
+        read_out = pysam.AlignedSegment(header)
+        read_out.query_name = read.query_name
+        read_out.flag = read.flag
+        read_out.mapping_quality = read.mapping_quality
+        read_out.cigartuples = read.cigartuples
+        read_out.template_length = read.template_length
+        read_out.query_sequence = read.query_sequence
+        read_out.query_qualities = read.query_qualities
+        read_out.tags = read.tags
+        return read_out
 
     def _update_features(self):
         """
@@ -76,6 +103,8 @@ class BamUpdater(object):
         removed_file = bam_root + self.removed_postfix + bam_ext
         updated_count = 0
         removed_count = 0
+        # kept reads copied to a new record, as they move to a reference_id past the references of the input header
+        copied_count = 0
         Program_ID = ""
         Program_list = ["TopHat","STAR","Bowtie","BWA"]
         in_f = pysam.AlignmentFile(self.bam_file, 'rb')
@@ -91,18 +120,17 @@ class BamUpdater(object):
                 for reference_sequence_dict in v:
                     if 'SN' in reference_sequence_dict:
                         if reference_sequence_dict['SN'] in self.alignment_dict:
-                            mappings = sorted(self.alignment_dict[reference_sequence_dict['SN']], key=lambda x: (x[3], x[4]))
-                            for mapping in mappings:
-                                if mapping[3] not in written_ID:
-                                    header_new_ID_dict[(mapping[0], mapping[3])] = header_num_count
+                            regions = self.sequence_summary.regions_of(reference_sequence_dict['SN'])
+                            for new_id in sorted(regions):
+                                if new_id not in written_ID:
+                                    header_new_ID_dict[(reference_sequence_dict['SN'], new_id)] = header_num_count
                                     updated_reference_sequence_dict = dict(reference_sequence_dict)
-                                    updated_reference_sequence_dict['SN'] = mapping[3]
+                                    updated_reference_sequence_dict['SN'] = new_id
                                     if 'LN' in updated_reference_sequence_dict:
-                                        filter_mappings = [m for m in mappings if m[3] == mapping[3]]
-                                        updated_reference_sequence_dict['LN'] = filter_mappings[len(filter_mappings)-1][5] - filter_mappings[0][4]
+                                        updated_reference_sequence_dict['LN'] = regions[new_id]['length']
                                     bam_header_new[k].append(updated_reference_sequence_dict)
                                     header_num_count += 1
-                                    written_ID.add(mapping[3])
+                                    written_ID.add(new_id)
             elif k =='PG':
                 bam_header_new[k] = v
                 if v[0]['ID'] in Program_list:
@@ -124,69 +152,109 @@ class BamUpdater(object):
         updated_file_f = pysam.AlignmentFile(updated_file,'wb',header = bam_header_new)
         removed_file_f = pysam.AlignmentFile(removed_file,'wb',header = in_f.header)
         bam_update_list = []
+        # reads sorted by coordinate are converted by moving a cursor along each reference, the mates are not sorted
+        # and are looked up in the index
+        start_cursor = self.alignment_dict.boundary_cursor()
+        end_cursor = self.alignment_dict.boundary_cursor()
+
+        # per-reference translation table: the old reference name of each reference_id, and the new reference_id of
+        # each (old reference_id, new sequence id)
+        old_references = in_f.references
+        old_reference_count = len(old_references)
+        new_reference_ids = dict(((in_f.get_tid(old_id), new_id), reference_id)
+                                 for (old_id, new_id), reference_id in header_new_ID_dict.items())
 
         for read in in_f.fetch(until_eof=True):
             #If a alignment doesn't have reference name, it will directly add to updated bam file.
             if read.reference_id == -1:
                 updated_count+=1
                 updated_file_f.write(read)
+                continue
+            old_id = old_references[read.reference_id]
+            if old_id not in self.alignment_dict:
+                removed_count+=1
+                removed_file_f.write(read)
+                continue
+            start, end = read.reference_start, read.reference_end # positive 0-based integer coordinates
+            start_mapping = start_cursor.mappings(old_id, start)
+            end_mapping = end_cursor.mappings(old_id, end)
+            # we got a bad annotation if start or end pos is N
+            if len(start_mapping) != 1 or len(end_mapping) != 1 or start_mapping[0][3] != end_mapping[0][3] or alignment_strand(start_mapping[0]) != alignment_strand(end_mapping[0]):
+                removed_count+=1
+                removed_file_f.write(read)
+                continue
+            reverse = alignment_strand(start_mapping[0]) == '-'
+            reference_id = new_reference_ids[(read.reference_id, start_mapping[0][3])]
+            if reverse:
+                # the read is reverse complemented, the old end becomes the new start
+                reference_start = convert_boundary(end_mapping[0], end)
             else:
-                if read.reference_name in self.alignment_dict:
-                    start, end = int(read.reference_start), int(read.reference_end) # positive 0-based integer coordinates
-                    mappings = self.alignment_dict[read.reference_name]
-                    start_mapping = [m for m in mappings if m[1] <= start and start <= m[2]]
-                    end_mapping = [m for m in mappings if m[1] <= end and end <= m[2]]
-                        # we got a bad annotation if start or end pos is N
-                    if len(start_mapping) != 1 or len(end_mapping) != 1:
+                reference_start = convert_boundary(start_mapping[0], start)
+            next_reference_id, next_reference_start, mate_reverse = read.next_reference_id, read.next_reference_start, False
+            if read.next_reference_id != -1:
+                next_old_id = old_references[read.next_reference_id]
+                if next_old_id not in self.alignment_dict:
+                    removed_count+=1
+                    removed_file_f.write(read)
+                    continue
+                next_start = read.next_reference_start
+                start_next_mapping = self.alignment_dict.boundary_mappings(next_old_id, next_start)
+                if len(start_next_mapping)!=1:
+                    removed_count+=1
+                    removed_file_f.write(read)
+                    continue
+                next_reference_id = new_reference_ids[(read.next_reference_id, start_next_mapping[0][3])]
+                if alignment_strand(start_next_mapping[0]) == '-':
+                    # the mate starts at its old end, which is only known from its CIGAR
+                    next_end = BamUpdater._mate_end(read)
+                    end_next_mapping = self.alignment_dict.boundary_mappings(next_old_id, next_end) if next_end is not None else []
+                    if len(end_next_mapping) != 1 or end_next_mapping[0] is not start_next_mapping[0]:
                         removed_count+=1
                         removed_file_f.write(read)
-                    else:
-                        if start_mapping[0][3] != end_mapping[0][3]:
-                            removed_count+=1
-                            removed_file_f.write(read)
-                            continue
-                        read_out = pysam.AlignedSegment()
-                        read_out.query_name = read.query_name
-                        read_out.flag = read.flag
-                        read_out.reference_id = header_new_ID_dict[(read.reference_name, start_mapping[0][3])]
-                        read_out.reference_start = int(start - start_mapping[0][1] + start_mapping[0][4])
-                        read_out.mapping_quality = read.mapping_quality
-                        read_out.cigar = read.cigar
-                        read_out.template_length = read.template_length
-                        read_out.query_sequence = read.query_sequence
-                        read_out.query_qualities = read.query_qualities
-                        read_out.tags= read.tags
-                        if read.next_reference_id != -1:
-                            if read.next_reference_name in self.alignment_dict:
-                                next_mappings = self.alignment_dict[read.next_reference_name]
-                                next_start = int(read.next_reference_start)
-                                start_next_mapping = [m for m in next_mappings if m[1] <= next_start and next_start <= m[2]]
-                                if len(start_next_mapping)!=1:
-                                    removed_count+=1
-                                    removed_file_f.write(read)
-                                    continue
-                                else:
-                                    read_out.next_reference_id = header_new_ID_dict[(read.next_reference_name,start_next_mapping[0][3])]
-                                    read_out.next_reference_start = int(next_start - start_next_mapping[0][1] + start_next_mapping[0][4])
-                            else:
-                                removed_count+=1
-                                removed_file_f.write(read)
-                                continue
-                        elif read.next_reference_id == -1:
-                            read_out.next_reference_id = read.next_reference_id
-                            read_out.next_reference_start = read.next_reference_start
-
-                    updated_count +=1
-                    updated_file_f.write(read_out)
+                        continue
+                    mate_reverse = True
+                    next_reference_start = convert_boundary(end_next_mapping[0], next_end)
                 else:
-                    removed_count+=1
-                    removed_file_f.write(read)
+                    next_reference_start = convert_boundary(start_next_mapping[0], next_start)
 
+            if reference_id >= old_reference_count or next_reference_id >= old_reference_count:
+                # pysam only accepts the reference ids of the header a record was read with, and the header of a
+                # record can not be replaced. The new @SQ lines are numbered from 0, so only the new sequences past
+                # the number of old ones, when sequences are split, take this path
+                read = BamUpdater._copy_read(read, updated_file_f.header)
+                copied_count += 1
+            # only the coordinates of the kept record are rewritten, its sequence, qualities and tags are left encoded
+            # unless the read or its mate moves to the reverse strand
+            read.reference_id = reference_id
+            read.reference_start = reference_start
+            read.next_reference_id = next_reference_id
+            read.next_reference_start = next_reference_start
+            if reverse:
+                read.flag = read.flag ^ 0x10
+                read.template_length = -read.template_length
+                query_qualities = read.query_qualities
+                read.cigartuples = read.cigartuples[::-1]
+                if read.query_sequence is not None:
+                    read.query_sequence = reverse_complement(read.query_sequence)
+                if query_qualities is not None:
+                    read.query_qualities = query_qualities[::-1]
+                if read.has_tag('MD'):
+                    read.set_tag('MD', BamUpdater._reverse_md(read.get_tag('MD')), 'Z')
+            if mate_reverse:
+                read.flag = read.flag ^ 0x20
+                if read.has_tag('MC'):
+                    read.set_tag('MC', BamUpdater._reverse_cigar(read.get_tag('MC')), 'Z')
+            updated_count +=1
+            updated_file_f.write(read)
         in_f.close()
         updated_file_f.close()
         removed_file_f.close()
         logging.info('  Updated Alignments: %d', updated_count)
         logging.info('  Removed Alignments: %d', removed_count)
+        if copied_count:
+            logging.info('  Alignments copied to new records: %d (reference ids past the %d references of the input header)',
+                         copied_count, old_reference_count)
+        logging.debug('  Out of order starts: %d', start_cursor.out_of_order)
 
 
 def main():
@@ -200,8 +268,8 @@ def main():
         fasta_diff example_file/old.fa example_file/new.fa | %(prog)s example_file/example.bam
     """))
     parser.add_argument('bam_files', metavar='bam_FILE', nargs='+', type=str, help='List one or more bam files to be updated')
-    parser.add_argument('-a', '--alignment_file', type=argparse.FileType('rb'), default=sys.stdin,
-                        help='The alignment file generated by fasta_diff, a TSV file with 6 columns: old_id, old_start, old_end, new_id, new_start, new_end (default: STDIN)')
+    parser.add_argument('-a', '--alignment_file', type=argparse.FileType('rb'), default=sys.stdin.buffer,
+                        help='The alignment file generated by fasta_diff, a TSV file with 6 columns: old_id, old_start, old_end, new_id, new_start, new_end, and an optional strand column (default: STDIN)')
     parser.add_argument('-u', '--updated_postfix', default='_updated',
                         help='The filename postfix for updated features (default: "_updated")')
     parser.add_argument('-r', '--removed_postfix', default='_removed',
@@ -7,22 +7,19 @@ Update the sequence id and coordinates of a BedGraph file using an alignment fil
 
 __version__ = '1.1'
 
-from collections import defaultdict
 import logging
 import sys
 import argparse
 from textwrap import dedent
+from coordinates_conversion.alignment import alignment_strand, convert_boundary, open_alignment_index, read_alignment_list_tsv
 
 logging.basicConfig(level=logging.DEBUG, format='%(levelname)-8s %(message)s')
 
 class BedGraphUpdater(object):
 
     def __init__(self, alignment_list_tsv_file, updated_postfix, removed_postfix):
-        self.alignment_list = BedGraphUpdater.read_alignment_list_tsv(alignment_list_tsv_file)
-        self.alignment_dict = defaultdict(list)
-
-        for a in self.alignment_list:
-            self.alignment_dict[a[0]].append(a)
+        # lookup the alignments of an old_id, and the ones holding a coordinate, a compiled alignment file is memory-mapped
+        self.alignment_dict = open_alignment_index(alignment_list_tsv_file)
         self.updated_postfix = updated_postfix
         self.removed_postfix = removed_postfix
 
@@ -35,29 +32,8 @@ class BedGraphUpdater(object):
         self.BedGraph_file = BedGraph_file
         self._update_features()
 
-    @staticmethod
-    def read_alignment_list_tsv(alignment_list_tsv_file):
-        """
-        Parse an alignment_list_tsv and returns a list
-        :param alignment_list_tsv_file: The output alignment file of fasta_diff
-        :type alignment_list_tsv_file: string or file
-        :return: a list of [old_id, old_start, old_end, new_id, new_start, new_end]
-        """
-        tsv_format = [str, int, int, str, int, int]
-        alignment_list_tsv_file_f = alignment_list_tsv_file
-        if isinstance(alignment_list_tsv_file, str):
-           logging.info('Reading alignment data from: %s...', alignment_list_tsv_file_f.name)
-           alignment_list_tsv_file_f = open(alignment_list_tsv_file, 'rb')
-        alignment_list = []
-        for line in alignment_list_tsv_file_f:
-            line=str(line,'utf-8')
-            alignment_list.append([f(t) for f, t in zip(tsv_format, line.split('\t'))])
-        if isinstance(alignment_list_tsv_file, str):
-            alignment_list_tsv_file_f.close()
-        else:
-            logging.info('Reading alignment data from: %s...', alignment_list_tsv_file_f.name)
-        logging.info('  Alignments: %d', len(alignment_list))
-        return alignment_list
+    # kept for the callers of the former per-class parser
+    read_alignment_list_tsv = staticmethod(read_alignment_list_tsv)
 
 
     def _update_features(self):
@@ -73,6 +49,9 @@ class BedGraphUpdater(object):
         removed_count = 0
         updated_file_f = open(updated_file, 'w')
         removed_file_f = open(removed_file, 'w')
+        # sorted files are converted by moving one cursor per column along each sequence
+        start_cursor = self.alignment_dict.boundary_cursor()
+        end_cursor = self.alignment_dict.boundary_cursor()
         with open(self.BedGraph_file, 'rb') as in_f:
             for line in in_f:
                 line = str(line,'utf-8')
@@ -81,20 +60,24 @@ class BedGraphUpdater(object):
                 #print(self.alignment_dict)
                 if tokens[0] in self.alignment_dict:
                     start, end = int(tokens[1]), int(tokens[2])
-                    mappings = self.alignment_dict[tokens[0]]
-                    start_mapping = [m for m in mappings if m[1] <= start and start <= m[2]]
-                    end_mapping = [m for m in mappings if m[1] <= end and end <= m[2]]
+                    start_mapping = start_cursor.mappings(tokens[0], start)
+                    end_mapping = end_cursor.mappings(tokens[0], end)
                     if len(start_mapping) != 1 or len(end_mapping) != 1:
                         removed_count+=1
                         removed_file_f.write(line)
                     else:
-                        if start_mapping[0][3] != end_mapping[0][3]:
+                        if start_mapping[0][3] != end_mapping[0][3] or alignment_strand(start_mapping[0]) != alignment_strand(end_mapping[0]):
                             removed_count+=1
                             removed_file_f.write(line)
                         else:
                             tokens[0] = start_mapping[0][3]# same with end_mapping[0][3]
-                            tokens[1] = str(start - start_mapping[0][1] + start_mapping[0][4])
-                            tokens[2] = str(end - end_mapping[0][1] + end_mapping[0][4])
+                            if alignment_strand(start_mapping[0]) == '-':
+                                # the old end becomes the new start on the reverse strand
+                                tokens[1] = str(convert_boundary(end_mapping[0], end))
+                                tokens[2] = str(convert_boundary(start_mapping[0], start))
+                            else:
+                                tokens[1] = str(convert_boundary(start_mapping[0], start))
+                                tokens[2] = str(convert_boundary(end_mapping[0], end))
                             keep = '\t'.join(tokens)
                             updated_count +=1
                             updated_file_f.write(keep+"\n")
@@ -106,6 +89,7 @@ class BedGraphUpdater(object):
         removed_file_f.close()
         logging.info('  Updated lines: %d', updated_count)
         logging.info('  Removed lines: %d', removed_count)
+        logging.debug('  Out of order starts: %d', start_cursor.out_of_order)
 
 
 def main():
@@ -120,7 +104,7 @@ def main():
     """))
     parser.add_argument('BedGraph_files', metavar='BedGraph_FILE', nargs='+', type=str,
     help='List one or more BedGraph files to be updated')
-    parser.add_argument('-a', '--alignment_file', type=argparse.FileType('rb'), default=sys.stdin,help='The alignment file generated by fasta_diff, a TSV file with 6 columns: old_id, old_start, old_end, new_id, new_start, new_end (default: STDIN)')
+    parser.add_argument('-a', '--alignment_file', type=argparse.FileType('rb'), default=sys.stdin.buffer,help='The alignment file generated by fasta_diff, a TSV file with 6 columns: old_id, old_start, old_end, new_id, new_start, new_end, and an optional strand column (default: STDIN)')
 
     parser.add_argument('-u', '--updated_postfix', default='_updated',
                         help='The filename postfix for updated features (default: "_updated")')
@@ -10,11 +10,12 @@ Changelog:
 
 __version__ = '1.1'
 
-from collections import defaultdict
+from collections import defaultdict, deque
 import logging
 import sys
 import argparse
 from textwrap import dedent
+from coordinates_conversion.alignment import NewSequenceSummary, alignment_strand, convert_position, flip_strand, open_alignment_index, read_alignment_list_tsv
 
 
 logging.basicConfig(level=logging.DEBUG, format='%(levelname)-8s %(message)s')
@@ -26,6 +27,13 @@ class GffUpdater(object):
     gff_updater = GffUpdater(alignment_file)
     Update a gff_file with the update method
     gff_updater.update(gff_file)
+    With streaming=True, each GFF3 file is read once and a root feature group is written as soon as it is complete,
+    at a ### directive or a change of seqid, instead of holding the whole file in memory. A file with a Parent
+    before the last ### directive or change of seqid is updated again as with spill_dir
+    gff_updater = GffUpdater(alignment_file, '_updated', '_removed', streaming=True)
+    With spill_dir, the root feature group of every feature and the removed groups are kept in a temporary SQLite
+    database in spill_dir instead of in memory, for large files whose groups are not closed by ### directives
+    gff_updater = GffUpdater(alignment_file, '_updated', '_removed', spill_dir='/tmp')
     """
     HEADER = 0
     KEEP = 1
@@ -33,14 +41,18 @@ class GffUpdater(object):
     POSITION_REMOVED = 3
     SEQUENCE_REGION = 4
 
-    def __init__(self, alignment_list_tsv_file, updated_postfix, removed_postfix):
-        self.alignment_list = GffUpdater.read_alignment_list_tsv(alignment_list_tsv_file)
-        # create a dictionary to lookup alignments using old_id as key
-        self.alignment_dict = defaultdict(list)
-        for a in self.alignment_list:
-            self.alignment_dict[a[0]].append(a)
+    def __init__(self, alignment_list_tsv_file, updated_postfix, removed_postfix, streaming=False, spill_dir=None):
+        if streaming and spill_dir is not None:
+            raise ValueError('streaming and spill_dir can not be used together')
+        # lookup the alignments of an old_id, and the ones holding a coordinate, a compiled alignment file is memory-mapped
+        self.alignment_dict = open_alignment_index(alignment_list_tsv_file)
+        # the ##sequence-region line of each new sequence, shared by all the GFF3 files
+        self.sequence_summary = NewSequenceSummary(self.alignment_dict.alignments())
+        self._output_sequence_region()
         self.updated_postfix = updated_postfix
         self.removed_postfix = removed_postfix
+        self.streaming = streaming
+        self.spill_dir = spill_dir
 
     def update(self, gff_file):
         """
@@ -50,44 +62,87 @@ class GffUpdater(object):
         logging.info('Processing GFF3 file: %s...', gff_file)
         self.gff_file = gff_file
         self.has_fasta = False
+        if self.streaming:
+            if self._stream_features():
+                return
+            logging.warning('  A Parent is not in the features read since the last ### directive or change of seqid, '
+                            'updating %s again with a temporary SQLite database', gff_file)
+            self._spill_features()
+            return
+        if self.spill_dir is not None:
+            self._spill_features()
+            return
         self._find_root_features()
         self._update_features()
         self._output_features()
 
+    # kept for the callers of the former per-class parser
+    read_alignment_list_tsv = staticmethod(read_alignment_list_tsv)
+
     @staticmethod
-    def read_alignment_list_tsv(alignment_list_tsv_file):
+    def _attribute_value(attributes, tag):
         """
-        Parse an alignment_list_tsv and returns a list
-        :param alignment_list_tsv_file: The output alignment file of fasta_diff
-        :type alignment_list_tsv_file: string or file
-        :return: a list of [old_id, old_start, old_end, new_id, new_start, new_end]
+        Finds a tag in the attributes column without splitting the other attributes
+        :param str attributes: the 9th column of a feature line
+        :param str tag: the tag followed by '=', such as 'ID='
+        :return: the value of the last attribute with the tag and a value, None if there is none
         """
-        tsv_format = [str, int, int, str, int, int]
-        alignment_list_tsv_file_f = alignment_list_tsv_file
-        if isinstance(alignment_list_tsv_file, str):
-            logging.info('Reading alignment data from: %s...', alignment_list_tsv_file_f.name)
-            alignment_list_tsv_file_f = open(alignment_list_tsv_file, 'rb')
-
-        alignment_list = []
-        for line in alignment_list_tsv_file_f:
-            line = str(line,'utf-8')
-            alignment_list.append([f(t) for f, t in zip(tsv_format, line.split('\t'))])
-
-        if isinstance(alignment_list_tsv_file, str):
-            alignment_list_tsv_file_f.close()
-        else:
-            logging.info('Reading alignment data from: %s...', alignment_list_tsv_file_f.name)
-        logging.info('  Alignments: %d', len(alignment_list))
+        # the attributes are scanned backward, a repeated tag takes its last value as in a dict of the attributes
+        start = attributes.rfind(tag)
+        while start != -1:
+            if start == 0 or attributes[start - 1] == ';':
+                end = attributes.find(';', start)
+                value = attributes[start + len(tag):end if end != -1 else len(attributes)]
+                if value:
+                    return value
+            start = attributes.rfind(tag, 0, start)
+        return None
 
-        return alignment_list
+    @staticmethod
+    def _feature_id_parents(line):
+        """
+        :param str line: a feature line
+        :return: the ID of the feature, None if it has none, and the list of its Parent ids, None if it has none
+        """
+        attributes = line.split('\t', 9)[8].rstrip('\r\n')
+        parent = GffUpdater._attribute_value(attributes, 'Parent=')
+        return GffUpdater._attribute_value(attributes, 'ID='), parent.split(',') if parent is not None else None
+
+    def _convert_feature(self, line):
+        """
+        Update the sequence id and coordinates of a feature line
+        :param str line: a feature line
+        :return: (KEEP, the updated line, the new sequence id), or (SEQUENCE_REMOVED or POSITION_REMOVED, None, None)
+        """
+        tokens = line.split('\t')
+        if tokens[0] not in self.alignment_dict:
+            return GffUpdater.SEQUENCE_REMOVED, None, None
+        start, end = int(tokens[3]), int(tokens[4]) # positive 1-based integer coordinates
+        start_mapping = self.alignment_dict.position_mappings(tokens[0], start)
+        end_mapping = self.alignment_dict.position_mappings(tokens[0], end)
+        # we got a bad annotation if start or end pos is N
+        if len(start_mapping) != 1 or len(end_mapping) != 1:
+            return GffUpdater.POSITION_REMOVED, None, None
+        if start_mapping[0][3] != end_mapping[0][3] or alignment_strand(start_mapping[0]) != alignment_strand(end_mapping[0]):
+            return GffUpdater.POSITION_REMOVED, None, None
+        tokens[0] = start_mapping[0][3]# should same with end_mapping[0][3]
+        if alignment_strand(start_mapping[0]) == '-':
+            # the old end becomes the new start on the reverse strand
+            tokens[3] = str(convert_position(end_mapping[0], end))
+            tokens[4] = str(convert_position(start_mapping[0], start))
+            tokens[6] = flip_strand(tokens[6])
+        else:
+            tokens[3] = str(convert_position(start_mapping[0], start))
+            tokens[4] = str(convert_position(end_mapping[0], end))
+        return GffUpdater.KEEP, '\t'.join(tokens), tokens[0]
 
     def _find_root_features(self):
         """
         Parses the GFF3 parent child relationship tree and records the information in two variables:
         * gff_line_root_list: the root feature line number of each line
         * gff_root_line_dict: the children feature line numbers of each root line
+        A feature with parents in several root groups joins them into the group of the first root line
         """
-        import re
         self.gff_line_root_list = []
         self.gff_root_line_dict = defaultdict(list)
         gff_id_line = {}
@@ -111,13 +166,17 @@ class GffUpdater(object):
                         break
                 else:
                     # parse id and parent
-                    attributes = line.split('\t')[8]
-                    attribute_dict = dict(re.findall('([^=;]+)=([^=;\n]+)', attributes))
-                    if 'ID' in attribute_dict:
-                        gff_id_line[attribute_dict['ID']] = current_line_num
-                    if 'Parent' in attribute_dict:
-                        self.gff_line_root_list.append(self.gff_line_root_list[gff_id_line[attribute_dict['Parent']]])
-                        self.gff_root_line_dict[self.gff_line_root_list[gff_id_line[attribute_dict['Parent']]]].append(current_line_num)
+                    feature_id, parents = GffUpdater._feature_id_parents(line)
+                    if feature_id is not None:
+                        gff_id_line[feature_id] = current_line_num
+                    if parents is not None:
+                        roots = sorted(set(self.gff_line_root_list[gff_id_line[parent]] for parent in parents))
+                        for root in roots[1:]:
+                            for lc in self.gff_root_line_dict.pop(root):
+                                self.gff_line_root_list[lc] = roots[0]
+                                self.gff_root_line_dict[roots[0]].append(lc)
+                        self.gff_line_root_list.append(roots[0])
+                        self.gff_root_line_dict[roots[0]].append(current_line_num)
                     else:
                         self.gff_line_root_list.append(current_line_num)
                         self.gff_root_line_dict[current_line_num].append(current_line_num)
@@ -138,10 +197,12 @@ class GffUpdater(object):
         * gff_line_status_dict: contains the assigned tags for each line
         * gff_line_list: unmodified text for each line in the GFF3 file
         * gff_converted_line_dict: updated text for each un-removed line in the GFF3 file
+        * gff_line_sequence_dict: the new sequence id of each un-removed line in the GFF3 file
         """
         self.gff_line_status_dict = {}
         self.gff_line_list = []
         self.gff_converted_line_dict = {}
+        self.gff_line_sequence_dict = {}
         with open(self.gff_file, 'rb') as in_f:
             current_line_num = 0
             for line in in_f:
@@ -161,47 +222,28 @@ class GffUpdater(object):
                     else:
                         self.gff_line_status_dict[current_line_num] = GffUpdater.HEADER
                 elif current_line_num not in self.gff_line_status_dict or self.gff_line_status_dict[current_line_num] == GffUpdater.KEEP:
-                    tokens = line.split('\t')
-                    if tokens[0] in self.alignment_dict:
-                        start, end = int(tokens[3]), int(tokens[4]) # positive 1-based integer coordinates
-                        mappings = self.alignment_dict[tokens[0]]
-                        start_mapping = [m for m in mappings if m[1] < start and start <= m[2]]
-                        end_mapping = [m for m in mappings if m[1] < end and end <= m[2]]
-                        # we got a bad annotation if start or end pos is N
-                        if len(start_mapping) != 1 or len(end_mapping) != 1:
-                            for lc in self.gff_root_line_dict[self.gff_line_root_list[current_line_num]]:
-                                self.gff_line_status_dict[lc] = GffUpdater.POSITION_REMOVED
-                        else:
-                            if start_mapping[0][3] != end_mapping[0][3]:
-                                for lc in self.gff_root_line_dict[self.gff_line_root_list[current_line_num]]:
-                                    self.gff_line_status_dict[lc] = GffUpdater.POSITION_REMOVED
-                            else:
-                                tokens[0] = start_mapping[0][3]# should same with end_mapping[0][3]
-                                tokens[3] = str(start - start_mapping[0][1] + start_mapping[0][4])
-                                tokens[4] = str(end - end_mapping[0][1] + end_mapping[0][4])
-                                self.gff_line_status_dict[current_line_num] = GffUpdater.KEEP
-                                self.gff_converted_line_dict[current_line_num] = '\t'.join(tokens)
+                    status, converted_line, new_id = self._convert_feature(line)
+                    if status == GffUpdater.KEEP:
+                        self.gff_line_status_dict[current_line_num] = GffUpdater.KEEP
+                        self.gff_converted_line_dict[current_line_num] = converted_line
+                        self.gff_line_sequence_dict[current_line_num] = new_id
                     else:
                         for lc in self.gff_root_line_dict[self.gff_line_root_list[current_line_num]]:
-                            self.gff_line_status_dict[lc] = GffUpdater.SEQUENCE_REMOVED
+                            self.gff_line_status_dict[lc] = status
                 self.gff_line_list.append(line)
                 current_line_num += 1
 
     def _output_sequence_region(self):
     #def _output_sequence_region(self, updated_file_f):
         """
-        Write new "##sequence-region seqid start end" lines to updated_file_f
-        :param updated_file_f: write to this file object
+        Build the new "##sequence-region seqid start end" line of each new sequence from the sequence summary, once
+        for all the GFF3 files
         :return: None
         """
-        from itertools import groupby
-        from itertools import chain
         self.sequence_regions = dict()
-        for new_id, alignments in groupby(sorted(self.alignment_list, key=lambda a: a[3]), key=lambda a: a[3]):
-            pos = list(chain(*[(a[4], a[5]) for a in alignments]))
+        for new_id, region in self.sequence_summary.regions.items():
             # convert from 0-based to 1-based coordinate system
-            #updated_file_f.write('##sequence-region %s %d %d\n' % (new_id, min(pos) + 1, max(pos)))
-            self.sequence_regions[new_id] = '##sequence-region %s %d %d\n' % (new_id, min(pos) + 1, max(pos))
+            self.sequence_regions[new_id] = '##sequence-region %s %d %d\n' % (new_id, region['start'] + 1, region['end'])
 
     def _output_features(self):
         """
@@ -217,7 +259,6 @@ class GffUpdater(object):
         removed_count = 0
         #sequence_region_written = False
         wrote_sequence_region = set()
-        self._output_sequence_region()
         
         try:
             updated_file_f = open(updated_file,'w')
@@ -225,7 +266,7 @@ class GffUpdater(object):
             for lc, line in enumerate(self.gff_line_list):
                 line = str(line)
                 if self.gff_line_status_dict[lc] == GffUpdater.KEEP:
-                    Scaffold = self.gff_converted_line_dict[lc].split("\t")[0]
+                    Scaffold = self.gff_line_sequence_dict[lc]
                     if Scaffold not in wrote_sequence_region:
                         updated_file_f.write(self.sequence_regions[Scaffold])
                         wrote_sequence_region.add(Scaffold)
@@ -250,6 +291,242 @@ class GffUpdater(object):
         logging.info('  Updated features: %d', updated_count)
         logging.info('  Removed features: %d', removed_count)
 
+    def _stream_features(self):
+        """
+        Reads the GFF3 file once, updating the features and writing them to the updated and removed files in the same
+        order as _output_features. The lines are held from the first feature of a root feature group that is not yet
+        removed, since a later child can still remove it, until a ### directive tells that every group read so far is
+        complete, or the end of the file. A feature with a seqid other than the one of the previous feature completes
+        the groups too, as a child is on the seqid of its parents. The features of removed groups and the comment lines
+        before that are written right away, so memory stays proportional to the groups of one seqid between two ###
+        directives.
+        :return: True, or False if a Parent was not read since then, the output is incomplete and the file has to be
+            updated with _spill_features
+        """
+        from os.path import splitext
+        gff_root, gff_ext = splitext(self.gff_file)
+        updated_file = gff_root + self.updated_postfix + gff_ext
+        removed_file = gff_root + self.removed_postfix + gff_ext
+        counts = {'feature': 0, 'updated': 0, 'removed': 0}
+        wrote_sequence_region = set()
+        # the root line number of the features read since the last ### directive or change of seqid, by ID
+        gff_id_root = {}
+        # {root line number: the root line number of the group it was joined to} by a feature with several parents
+        joined_roots = {}
+        # {root line number: SEQUENCE_REMOVED or POSITION_REMOVED} of the groups with a removed feature
+        removed_root_status = {}
+
+        def find_root(root):
+            while root in joined_roots:
+                root = joined_roots[root]
+            return root
+        # (root line number or None for a comment line, status, original line, updated line, new sequence id) not
+        # written yet
+        pending = deque()
+
+        def write_pending(complete):
+            # write the lines of the complete groups, or the lines up to the first group that can still be removed
+            while pending:
+                root, status, line, converted_line, scaffold = pending[0]
+                if status == GffUpdater.KEEP:
+                    root = find_root(root)
+                    if root in removed_root_status:
+                        status = removed_root_status[root]
+                    elif not complete:
+                        break
+                pending.popleft()
+                if status == GffUpdater.KEEP:
+                    if scaffold not in wrote_sequence_region:
+                        updated_file_f.write(self.sequence_regions[scaffold])
+                        wrote_sequence_region.add(scaffold)
+                    updated_file_f.write(converted_line)
+                    counts['updated'] += 1
+                elif status == GffUpdater.HEADER:
+                    updated_file_f.write(line)
+                elif status != GffUpdater.SEQUENCE_REGION:
+                    removed_file_f.write(line)
+                    counts['removed'] += 1
+
+        def close_groups():
+            # no feature after this point refers to a feature before it
+            write_pending(True)
+            gff_id_root.clear()
+            joined_roots.clear()
+            removed_root_status.clear()
+
+        with open(self.gff_file, 'rb') as in_f, open(updated_file, 'w') as updated_file_f, open(removed_file, 'w') as removed_file_f:
+            current_line_num = 0
+            seqid = None
+            for line in in_f:
+                line = str(line, 'utf-8')
+                line_strip = line.strip()
+                if len(line_strip) == 0:
+                    # ingore blank line
+                    continue
+                if line[0] == '#':
+                    if line_strip == '##FASTA':
+                        # This notation indicates that the annotation portion of the file is at an end and that the
+                        # remainder of the file contains one or more sequences (nucleotide or protein) in FASTA format.
+                        self.has_fasta = True
+                        break
+                    status = GffUpdater.SEQUENCE_REGION if line_strip.startswith('##sequence-region') else GffUpdater.HEADER
+                    pending.append((None, status, line, None, None))
+                    if line_strip == '###':
+                        close_groups()
+                else:
+                    if line[:line.find('\t')] != seqid:
+                        seqid = line[:line.find('\t')]
+                        close_groups()
+                    feature_id, parents = GffUpdater._feature_id_parents(line)
+                    root = current_line_num
+                    if parents is not None:
+                        for parent in parents:
+                            if parent not in gff_id_root:
+                                logging.debug('  Parent %s of feature %s is not in the features read since the last ### '
+                                              'directive or change of seqid', parent, feature_id)
+                                return False
+                        roots = sorted(set(find_root(gff_id_root[parent]) for parent in parents))
+                        root = roots[0]
+                        for joined_root in roots[1:]:
+                            joined_roots[joined_root] = root
+                            if joined_root in removed_root_status and root not in removed_root_status:
+                                removed_root_status[root] = removed_root_status[joined_root]
+                    if feature_id is not None:
+                        gff_id_root[feature_id] = root
+                    counts['feature'] += 1
+                    if root in removed_root_status:
+                        pending.append((root, removed_root_status[root], line, None, None))
+                    else:
+                        status, converted_line, new_id = self._convert_feature(line)
+                        if status != GffUpdater.KEEP:
+                            removed_root_status[root] = status
+                        pending.append((root, status, line, converted_line, new_id))
+                write_pending(False)
+                current_line_num += 1
+            write_pending(True)
+
+        logging.info('  Total features: %d', counts['feature'])
+        logging.info('  Updated features: %d', counts['updated'])
+        logging.info('  Removed features: %d', counts['removed'])
+        return True
+
+    def _spill_features(self):
+        """
+        Writes the same output as _output_features, keeping the tables in a temporary SQLite database in spill_dir:
+        * ids: the root line number of each feature ID
+        * lines: the root line number, the updated line and the new sequence id of each feature line
+        * removed_roots: the root line numbers of the groups with a removed feature
+        The first read of the GFF3 file fills the tables, every feature is converted once. The root groups joined by
+        features with several parents are kept in memory and merged in the tables after it. The second read walks
+        the feature lines joined with the removed groups in line order, writing the updated lines of the groups that
+        are kept and the original lines of the removed ones.
+        """
+        from os.path import splitext
+        import sqlite3
+        import tempfile
+        gff_root, gff_ext = splitext(self.gff_file)
+        updated_file = gff_root + self.updated_postfix + gff_ext
+        removed_file = gff_root + self.removed_postfix + gff_ext
+        updated_count = 0
+        removed_count = 0
+        feature_count = 0
+        wrote_sequence_region = set()
+        # {root line number: the root line number of the group it was joined to} by a feature with several parents
+        joined_roots = {}
+
+        def find_root(root):
+            while root in joined_roots:
+                root = joined_roots[root]
+            return root
+
+        with tempfile.NamedTemporaryFile(suffix='.sqlite', dir=self.spill_dir) as db_f:
+            db = sqlite3.connect(db_f.name)
+            try:
+                db.execute('PRAGMA journal_mode=OFF')
+                db.execute('PRAGMA synchronous=OFF')
+                db.execute('CREATE TABLE ids (id TEXT PRIMARY KEY, root INTEGER)')
+                db.execute('CREATE TABLE lines (num INTEGER PRIMARY KEY, root INTEGER, converted TEXT, scaffold TEXT)')
+                db.execute('CREATE TABLE removed_roots (root INTEGER PRIMARY KEY)')
+                line_rows = []
+                with open(self.gff_file, 'rb') as in_f:
+                    current_line_num = 0
+                    for line in in_f:
+                        line = str(line, 'utf-8')
+                        if len(line.strip()) == 0:
+                            # ingore blank line
+                            continue
+                        if line[0] == '#':
+                            if line.strip() == '##FASTA':
+                                self.has_fasta = True
+                                break
+                        else:
+                            feature_id, parents = GffUpdater._feature_id_parents(line)
+                            root = current_line_num
+                            if parents is not None:
+                                roots = set()
+                                for parent in parents:
+                                    row = db.execute('SELECT root FROM ids WHERE id = ?', (parent,)).fetchone()
+                                    if row is None:
+                                        raise ValueError('Parent %s of feature %s is not found before it in %s'
+                                                         % (parent, feature_id, self.gff_file))
+                                    roots.add(find_root(row[0]))
+                                roots = sorted(roots)
+                                root = roots[0]
+                                for joined_root in roots[1:]:
+                                    joined_roots[joined_root] = root
+                            if feature_id is not None:
+                                db.execute('INSERT OR REPLACE INTO ids VALUES (?, ?)', (feature_id, root))
+                            status, converted_line, new_id = self._convert_feature(line)
+                            line_rows.append((current_line_num, root, converted_line, new_id))
+                            if len(line_rows) >= 10000:
+                                db.executemany('INSERT INTO lines VALUES (?, ?, ?, ?)', line_rows)
+                                line_rows = []
+                            if status != GffUpdater.KEEP:
+                                db.execute('INSERT OR IGNORE INTO removed_roots VALUES (?)', (root,))
+                            feature_count += 1
+                        current_line_num += 1
+                db.executemany('INSERT INTO lines VALUES (?, ?, ?, ?)', line_rows)
+                db.execute('DROP TABLE ids')
+                if joined_roots:
+                    db.execute('CREATE INDEX lines_root ON lines (root)')
+                    for joined_root in joined_roots:
+                        root = find_root(joined_root)
+                        db.execute('UPDATE lines SET root = ? WHERE root = ?', (root, joined_root))
+                        if db.execute('SELECT 1 FROM removed_roots WHERE root = ?', (joined_root,)).fetchone():
+                            db.execute('INSERT OR IGNORE INTO removed_roots VALUES (?)', (root,))
+                logging.info('  Total features: %d', feature_count)
+
+                feature_rows = db.execute('SELECT lines.num, removed_roots.root IS NOT NULL, lines.converted, lines.scaffold '
+                                          'FROM lines LEFT JOIN removed_roots ON lines.root = removed_roots.root '
+                                          'ORDER BY lines.num')
+                with open(self.gff_file, 'rb') as in_f, open(updated_file, 'w') as updated_file_f, open(removed_file, 'w') as removed_file_f:
+                    for line in in_f:
+                        line = str(line, 'utf-8')
+                        line_strip = line.strip()
+                        if len(line_strip) == 0:
+                            continue
+                        if line[0] == '#':
+                            if line_strip == '##FASTA':
+                                break
+                            if not line_strip.startswith('##sequence-region'):
+                                updated_file_f.write(line)
+                            continue
+                        current_line_num, removed, converted_line, scaffold = next(feature_rows)
+                        if removed:
+                            removed_file_f.write(line)
+                            removed_count += 1
+                        else:
+                            if scaffold not in wrote_sequence_region:
+                                updated_file_f.write(self.sequence_regions[scaffold])
+                                wrote_sequence_region.add(scaffold)
+                            updated_file_f.write(converted_line)
+                            updated_count += 1
+            finally:
+                db.close()
+
+        logging.info('  Updated features: %d', updated_count)
+        logging.info('  Removed features: %d', removed_count)
+
 
 
 
@@ -264,16 +541,22 @@ def main():
         fasta_diff example_file/old.fa example_file/new.fa | %(prog)s example_file/example1.gff3 example_file/example2.gff3
     """))
     parser.add_argument('gff_files', metavar='GFF_FILE', nargs='+', type=str, help='List one or more GFF3 files to be updated')
-    parser.add_argument('-a', '--alignment_file', type=argparse.FileType('rb'), default=sys.stdin,
-                        help='The alignment file generated by fasta_diff, a TSV file with 6 columns: old_id, old_start, old_end, new_id, new_start, new_end (default: STDIN)')
+    parser.add_argument('-a', '--alignment_file', type=argparse.FileType('rb'), default=sys.stdin.buffer,
+                        help='The alignment file generated by fasta_diff, a TSV file with 6 columns: old_id, old_start, old_end, new_id, new_start, new_end, and an optional strand column (default: STDIN)')
     parser.add_argument('-u', '--updated_postfix', default='_updated',
                         help='The filename postfix for updated features (default: "_updated")')
     parser.add_argument('-r', '--removed_postfix', default='_removed',
                         help='The filename postfix for removed features (default: "_removed")')
+    parser.add_argument('-s', '--streaming', action='store_true',
+                        help='Read each GFF3 file once and write the root feature groups as they are completed by ### directives or a change of seqid, for files too large to hold in memory. A file with a Parent before the last ### directive or change of seqid is updated again with a temporary SQLite database, see --spill_dir')
+    parser.add_argument('--spill_dir', type=str,
+                        help='Keep the root feature groups of the features in a temporary SQLite database in this directory instead of in memory, for large files whose groups are not closed by ### directives')
     parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
 
     args = parser.parse_args()
-    gff_updater = GffUpdater(args.alignment_file, args.updated_postfix, args.removed_postfix)
+    if args.streaming and args.spill_dir is not None:
+        parser.error('--streaming and --spill_dir can not be used together')
+    gff_updater = GffUpdater(args.alignment_file, args.updated_postfix, args.removed_postfix, args.streaming, args.spill_dir)
     for gff_file in args.gff_files:
         gff_updater.update(gff_file)
 
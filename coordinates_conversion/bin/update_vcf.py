@@ -11,6 +11,8 @@ import re
 import sys
 import argparse
 from textwrap import dedent
+from coordinates_conversion.alignment import NewSequenceSummary, alignment_strand, convert_position, open_alignment_index, read_alignment_list_tsv
+from coordinates_conversion.fasta import read_sequence_lengths, reverse_complement
 
 logging.basicConfig(level=logging.DEBUG, format='%(levelname)-8s %(message)s')
 
@@ -24,11 +26,10 @@ class VCFUpdater(object):
     """
 
     def __init__(self, alignment_list_tsv_file, updated_postfix, removed_postfix):
-        self.alignment_list = VCFUpdater.read_alignment_list_tsv(alignment_list_tsv_file)
-        # create a dictionary to lookup alignments using old_id as key
-        self.alignment_dict = defaultdict(list)
-        for a in self.alignment_list:
-            self.alignment_dict[a[0]].append(a)
+        # lookup the alignments of an old_id, and the ones holding a coordinate, a compiled alignment file is memory-mapped
+        self.alignment_dict = open_alignment_index(alignment_list_tsv_file)
+        # the region of each new sequence covered by the alignments of each old sequence, for the ##contig lines
+        self.sequence_summary = NewSequenceSummary(self.alignment_dict.alignments())
         self.updated_postfix = updated_postfix
         self.removed_postfix = removed_postfix
 
@@ -42,61 +43,31 @@ class VCFUpdater(object):
         self.reference = reference
         self._update_features()
 
+    # kept for the callers of the former per-class parser
+    read_alignment_list_tsv = staticmethod(read_alignment_list_tsv)
+
     @staticmethod
-    def read_alignment_list_tsv(alignment_list_tsv_file):
+    def _reverse_alleles(tokens):
         """
-        Parse an alignment_list_tsv and returns a list
-        :param alignment_list_tsv_file: The output alignment file of fasta_diff
-        :type alignment_list_tsv_file: string or file
-        :return: a list of [old_id, old_start, old_end, new_id, new_start, new_end]
+        Replace the REF and ALT alleles of a VCF data line with their reverse complements
+        :param list tokens: the columns of the line
+        :return: False and leave tokens unchanged if an allele does not have the length of REF
         """
-        tsv_format = [str, int, int, str, int, int]
-        alignment_list_tsv_file_f = alignment_list_tsv_file
-        if isinstance(alignment_list_tsv_file, str):
-            logging.info('Reading alignment data from: %s...', alignment_list_tsv_file_f.name)
-            alignment_list_tsv_file_f = open(alignment_list_tsv_file, 'rb')
-
-        alignment_list = []
-        for line in alignment_list_tsv_file_f:
-            line = str(line,'utf-8')
-            alignment_list.append([f(t) for f, t in zip(tsv_format, line.split('\t'))])
-
-        if isinstance(alignment_list_tsv_file, str):
-            alignment_list_tsv_file_f.close()
-        else:
-            logging.info('Reading alignment data from: %s...', alignment_list_tsv_file_f.name)
-        logging.info('  Alignments: %d', len(alignment_list))
-
-        return alignment_list
+        alts = tokens[4].split(',')
+        if any(alt != '.' and len(alt) != len(tokens[3]) for alt in alts):
+            return False
+        tokens[3] = reverse_complement(tokens[3])
+        tokens[4] = ','.join(alt if alt == '.' else reverse_complement(alt) for alt in alts)
+        return True
 
     def fasta_file_sequence_length(self):
-        sequence_length = dict()
-        sequence_id = None
-        with open(self.reference, 'rb') as fasta_file_f:
-            for line in fasta_file_f:
-                line = str(line,'utf-8')
-                line = line.strip()
-                if len(line) != 0:
-                    if line[0] == '>':
-                        lines = line.split(' ')
-                        if sequence_id == None:
-                            # the first sequence
-                            sequence_id = lines[0][1:]
-                        elif sequence_id != lines[0][1:]:
-                            # next sequence
-                            sequence_length[sequence_id]['state'] = True
-                            sequence_id = lines[0][1:]
-                        if sequence_id not in sequence_length:
-                            sequence_length[sequence_id] = {
-                                'length': 0,
-                                'state': False
-                            }
-                        else:
-                            if sequence_length[sequence_id]['state'] == True:
-                                logging.warning('Duplicate ID found! %s' % (sequence_id))
-                    else:
-                        sequence_length[sequence_id]['length'] += len(line)
-        return sequence_length
+        """
+        Read the sequence lengths of the reference, from an up to date REFERENCE.fai if there is one, no index file is
+        written
+        :return: a dict of sequence id: length
+        """
+        return read_sequence_lengths(self.reference)
+
     def _update_features(self):
         """
         Goes through the VCF file, updating the ids and coordinates of each feature and
@@ -110,6 +81,9 @@ class VCFUpdater(object):
         removed_count = 0
         updated_file_f = open(updated_file, 'w')
         removed_file_f = open(removed_file, 'w')
+        # sorted files are converted by moving one cursor per column along each sequence
+        start_cursor = self.alignment_dict.position_cursor()
+        end_cursor = self.alignment_dict.position_cursor()
         contig_key = ['ID', 'length']
         contig_sort_map = defaultdict(int, zip(contig_key, range(len(contig_key), 0, -1)))
         if self.reference:
@@ -130,21 +104,13 @@ class VCFUpdater(object):
                         contig_dict = dict(re.findall('([^=,]+)=([^=,\n]+)', contig))
                         # update ID
                         if 'ID' in contig_dict and contig_dict['ID'] in self.alignment_dict:
-                            mappings = self.alignment_dict[contig_dict['ID']]
-                            mappings_dict = dict()
-                            for mapping in mappings:
-                                if mapping[3] not in mappings_dict:
-                                    mappings_dict[mapping[3]] = {'min':mapping[4],'max':mapping[5],'length':mapping[5]-mapping[4]}
-                                else:
-                                    mappings_dict[mapping[3]]['min'] = min(mappings_dict[mapping[3]]['min'], mapping[4])
-                                    mappings_dict[mapping[3]]['max'] = max(mappings_dict[mapping[3]]['max'], mapping[5])
-                                    mappings_dict[mapping[3]]['length'] = mappings_dict[mapping[3]]['max'] - mappings_dict[mapping[3]]['min']
+                            mappings_dict = self.sequence_summary.regions_of(contig_dict['ID'])
                             flag = False
                             for newid in mappings_dict:
                                 contig_dict['ID'] = newid
                                 if 'length' in contig_dict:
                                     if self.reference:
-                                        contig_dict['length'] = str(sequence_length[newid]['length'])
+                                        contig_dict['length'] = str(sequence_length[newid])
                                     else:
                                         contig_dict['length'] = mappings_dict[newid]['length']
                                 contig_list = []
@@ -171,20 +137,27 @@ class VCFUpdater(object):
                     
                     if tokens[0] in self.alignment_dict:
                         start, end = int(tokens[1]), int(tokens[1]) -1 + len(tokens[3])# positive 1-based integer coordinates
-                        mappings = self.alignment_dict[tokens[0]]
-                        start_mapping = [m for m in mappings if m[1] < start and start <= m[2]]
-                        end_mapping = [m for m in mappings if m[1] < end and end <= m[2]]
+                        start_mapping = start_cursor.mappings(tokens[0], start)
+                        end_mapping = end_cursor.mappings(tokens[0], end)
                         # we got a bad annotation if start or end pos is N
                         if len(start_mapping) != 1 or len(end_mapping) != 1:
                             removed_file_f.write(line_strip + '\n')
                             removed_count += 1
                         else:
-                            if start_mapping[0][3] != end_mapping[0][3]:
+                            if start_mapping[0][3] != end_mapping[0][3] or alignment_strand(start_mapping[0]) != alignment_strand(end_mapping[0]):
+                                removed_file_f.write(line_strip + '\n')
+                                removed_count += 1
+                            elif alignment_strand(start_mapping[0]) == '-' and not VCFUpdater._reverse_alleles(tokens):
+                                # an indel keeps its padding base on the left, it can not be moved to the reverse strand
                                 removed_file_f.write(line_strip + '\n')
                                 removed_count += 1
                             else:
                                 tokens[0] = start_mapping[0][3]
-                                tokens[1] = str(start - start_mapping[0][1] + start_mapping[0][4])
+                                if alignment_strand(start_mapping[0]) == '-':
+                                    # the old end becomes the new position on the reverse strand
+                                    tokens[1] = str(convert_position(end_mapping[0], end))
+                                else:
+                                    tokens[1] = str(convert_position(start_mapping[0], start))
                                 keep = '\t'.join(tokens)
                                 updated_file_f.write(keep + '\n')
                                 updated_count += 1
@@ -196,6 +169,7 @@ class VCFUpdater(object):
         removed_file_f.close()
         logging.info('  Updated lines: %d', updated_count)
         logging.info('  Removed lines: %d', removed_count)
+        logging.debug('  Out of order starts: %d', start_cursor.out_of_order)
 
 
 def main():
@@ -208,8 +182,8 @@ def main():
         fasta_diff example_file/old.fa example_file/new.fa | %(prog)s -ref example_file/new.fa example_file/example.vcf
     """))
     parser.add_argument('vcf_files', metavar='VCF_FILE', nargs='+', type=str, help='List one or more VCF files to be updated')
-    parser.add_argument('-a', '--alignment_file', type=argparse.FileType('rb'), default=sys.stdin,
-                        help='The alignment file generated by fasta_diff, a TSV file with 6 columns: old_id, old_start, old_end, new_id, new_start, new_end (default: STDIN)')
+    parser.add_argument('-a', '--alignment_file', type=argparse.FileType('rb'), default=sys.stdin.buffer,
+                        help='The alignment file generated by fasta_diff, a TSV file with 6 columns: old_id, old_start, old_end, new_id, new_start, new_end, and an optional strand column (default: STDIN)')
     parser.add_argument('-u', '--updated_postfix', default='_updated',
                         help='The filename postfix for updated features (default: "_updated")')
     parser.add_argument('-r', '--removed_postfix', default='_removed',
@@ -0,0 +1,80 @@
+"""
+Resumable per-stage checkpoints of a multi stage run
+
+Checkpoints are stored in a directory named after a digest of the content of the input files and the tool version,
+so a checkpoint is never reused after the inputs or the program changed. Every stage is saved as a small JSON file
+holding what the stage changed (the delta), written atomically so an interrupted run never leaves a partial
+checkpoint behind.
+"""
+
+from os import makedirs, replace
+from os.path import isfile, join
+import hashlib
+import json
+import logging
+
+CHUNK_SIZE = 1 << 22
+
+
+def file_digest(file_path):
+    """
+    Returns the blake2b digest of the content of a file
+    :param str file_path: the file path
+    :return: a hex string
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as in_f:
+        while True:
+            chunk = in_f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StageCheckpoint(object):
+    """
+    Initialize a StageCheckpoint instance with a checkpoint directory, the input files and the tool version
+    checkpoint = StageCheckpoint(checkpoint_dir, [old_fasta_file, new_fasta_file], __version__)
+    Save the delta of a finished stage and load it when the run is resumed
+    checkpoint.save(1, delta)
+    delta = checkpoint.load(1)
+    """
+
+    def __init__(self, checkpoint_dir, input_files, version):
+        key = hashlib.blake2b(digest_size=16)
+        key.update(version.encode('utf-8'))
+        for input_file in input_files:
+            key.update(file_digest(input_file).encode('utf-8'))
+        self.key = key.hexdigest()
+        self.version = version
+        self.directory = join(checkpoint_dir, self.key)
+
+    def _stage_file(self, stage):
+        return join(self.directory, 'stage_%d.json' % stage)
+
+    def load(self, stage):
+        """
+        :param int stage: the 1-based stage number
+        :return: the delta saved for the stage, or None if the stage has no checkpoint
+        """
+        stage_file = self._stage_file(stage)
+        if not isfile(stage_file):
+            return None
+        with open(stage_file, 'r') as stage_file_f:
+            checkpoint = json.load(stage_file_f)
+        if checkpoint.get('version') != self.version or checkpoint.get('stage') != stage:
+            logging.warning('  Ignoring checkpoint %s written by a different version', stage_file)
+            return None
+        return checkpoint['delta']
+
+    def save(self, stage, delta):
+        """
+        :param int stage: the 1-based stage number
+        :param delta: a JSON serializable object describing the changes made by the stage
+        """
+        makedirs(self.directory, exist_ok=True)
+        stage_file = self._stage_file(stage)
+        with open(stage_file + '.tmp', 'w') as stage_file_f:
+            json.dump({'version': self.version, 'stage': stage, 'delta': delta}, stage_file_f)
+        replace(stage_file + '.tmp', stage_file)
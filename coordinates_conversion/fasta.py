@@ -0,0 +1,135 @@
+"""
+Streaming FASTA reader shared by fasta_diff and the updaters
+
+read_fasta reads the file in large binary chunks and only joins the pieces of a sequence once, so reading is linear in
+the file size. read_sequence_lengths takes the lengths from an up to date samtools .fai index (FASTA_FILE.fai) when
+there is one, see http://www.htslib.org/doc/faidx.html, the index is never written
+"""
+
+from collections import OrderedDict
+from os.path import getmtime, isfile
+import hashlib
+import logging
+
+CHUNK_SIZE = 1 << 22
+_WHITESPACE = b' \t\r\n'
+_COMPLEMENT = str.maketrans('ACGTURYKMBVDHacgturykmbvdh', 'TGCAAYRMKVBHDtgcaayrmkvbhd')
+
+
+def sequence_digest(seq):
+    """
+    Returns the digest identifying an upper case sequence, two sequences are treated as identical if their digests are
+    :param str seq: the sequence
+    :return: a hex string
+    """
+    return hashlib.blake2b(seq.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def reverse_complement(seq):
+    """
+    Returns the reverse complement of a sequence, IUPAC codes are complemented and the case is kept
+    :param str seq: the sequence
+    :return: a string
+    """
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def _record(header, parts):
+    return header.decode('utf-8'), b''.join(parts).decode('utf-8')
+
+
+def read_fasta(fasta_file, chunk_size=CHUNK_SIZE):
+    """
+    Read the sequences of a FASTA file
+    :param fasta_file: a string path or a file object
+    :param int chunk_size: the number of bytes read at a time
+    :return: a generator of (header, seq), header is the stripped header line starting with '>',
+        seq is the sequence without whitespace, in its original case, only a '>' at the start of a line starts a header
+    """
+    fasta_file_f = fasta_file
+    if isinstance(fasta_file, str):
+        fasta_file_f = open(fasta_file, 'rb')
+    else:
+        # read text file objects through their binary buffer
+        fasta_file_f = getattr(fasta_file, 'buffer', fasta_file)
+
+    try:
+        header, parts, pending = None, [], b''
+        # whether the first byte of data starts a line
+        line_start = True
+        while True:
+            chunk = fasta_file_f.read(chunk_size)
+            data = pending + chunk if pending else chunk
+            pending = b''
+            pos = 0
+            while pos < len(data):
+                if data[pos:pos + 1] == b'>' and (data[pos - 1:pos] == b'\n' if pos else line_start):
+                    i = pos
+                else:
+                    i = data.find(b'\n>', pos)
+                    if i != -1:
+                        i += 1
+                if i == -1:
+                    parts.append(data[pos:].translate(None, _WHITESPACE))
+                    break
+                parts.append(data[pos:i].translate(None, _WHITESPACE))
+                eol = data.find(b'\n', i)
+                if eol == -1:
+                    if chunk:
+                        # the header line continues in the next chunk
+                        pending = data[i:]
+                        break
+                    eol = len(data)
+                if header is not None:
+                    yield _record(header, parts)
+                header, parts = data[i:eol].strip(), []
+                pos = eol + 1
+            if pending:
+                line_start = True
+            elif data:
+                line_start = data[-1:] == b'\n'
+            if not chunk:
+                break
+        if header is not None:
+            yield _record(header, parts)
+    finally:
+        if isinstance(fasta_file, str):
+            fasta_file_f.close()
+
+
+def read_sequence_lengths(fasta_file):
+    """
+    Read the sequence lengths of a FASTA file, from FASTA_FILE.fai if it is not older than the FASTA file, otherwise
+    from the sequences, the lines of a sequence can have any length
+    :param fasta_file: a string path or a file object
+    :return: an OrderedDict of sequence id: length, the lengths of the sequences sharing an id are added
+    """
+    if isinstance(fasta_file, str):
+        fai_file = fasta_file + '.fai'
+        if isfile(fai_file) and getmtime(fai_file) >= getmtime(fasta_file):
+            logging.info('  Reading sequence lengths from FASTA index (%s)', fai_file)
+            return OrderedDict((name, record[0]) for name, record in read_fai(fai_file).items())
+    lengths = OrderedDict()
+    for header, seq in read_fasta(fasta_file):
+        seq_id = header[1:].split(' ')[0]
+        if seq_id in lengths:
+            logging.warning('Duplicate ID found! %s', seq_id)
+            lengths[seq_id] += len(seq)
+        else:
+            lengths[seq_id] = len(seq)
+    return lengths
+
+
+def read_fai(fai_file):
+    """
+    Parse a .fai index
+    :param str fai_file: the index path
+    :return: an OrderedDict of name: [length, offset, line_bases, line_width]
+    """
+    fai = OrderedDict()
+    with open(fai_file, 'r') as fai_file_f:
+        for line in fai_file_f:
+            tokens = line.rstrip('\n').split('\t')
+            if len(tokens) >= 5:
+                fai[tokens[0]] = [int(t) for t in tokens[1:5]]
+    return fai
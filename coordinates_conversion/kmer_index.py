@@ -0,0 +1,201 @@
+"""
+Sparse k-mer index used by fasta_diff to find candidate old sequences for a new sequence
+
+Every old sequence contributes the k-mers that start at multiples of step. Any query that occurs as an exact
+substring of an old sequence and is at least k + step - 1 long overlaps one of those sampled k-mers at every
+possible offset, so looking up one k-mer of the query for each residue modulo step returns every old sequence
+that can contain the query. The candidates still have to be verified, but the index never misses a true match.
+
+A canonical index stores every k-mer as the smaller of itself and its reverse complement, so it also returns the
+sequences holding the reverse complement of the query: the k-mers of the reverse complement of the query are the
+reverse complements of the k-mers of the query, at mirrored offsets that cover every residue modulo step.
+
+The index holds the 64-bit keys of the sampled k-mers (see kmer_key) in a sorted array, the offset of the postings
+of each key in a second array and the ordinals of the postings in a third one, 12 bytes per sampled k-mer and key.
+The sorted keys of each sequence are built on their own and merged, so building the index never holds more than the
+arrays and the keys of one sequence. An index can be saved with write_kmer_index, which writes the same arrays, and
+loaded by memory-mapping it with MappedKmerIndex.
+"""
+
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from itertools import repeat
+import hashlib
+import json
+import mmap
+import struct
+import sys
+
+from coordinates_conversion.fasta import reverse_complement
+
+DEFAULT_K = 32
+DEFAULT_STEP = 16
+# number of query k-mers examined per residue when choosing the most selective seed
+SEED_TRIALS = 8
+
+MAGIC = b'CCKMER\x00\x01'
+# number of keys, number of postings, byte offset of the JSON table
+_FOOTER = struct.Struct('<QQQ')
+
+
+def canonical_kmer(kmer):
+    """
+    Returns the strand independent form of a k-mer, the smaller of the k-mer and its reverse complement
+    :param str kmer: the k-mer
+    :return: a string
+    """
+    return min(kmer, reverse_complement(kmer))
+
+
+def kmer_key(kmer):
+    """
+    Returns the 64-bit key of a k-mer in a saved index, different k-mers may share a key
+    :param str kmer: the k-mer
+    :return: an int
+    """
+    return int.from_bytes(hashlib.blake2b(kmer.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class KmerIndex(object):
+    """
+    Initialize a KmerIndex instance with a list of sequences
+    kmer_index = KmerIndex(sequences)
+    Find the ordinals of the sequences that may contain query as a substring
+    kmer_index.candidate_ordinals(query)
+    """
+
+    def __init__(self, sequences, k=DEFAULT_K, step=DEFAULT_STEP, canonical=False):
+        """
+        :param sequences: an iterable of sequence strings, the ordinal of each sequence is its position in this iterable
+        :param int k: the k-mer length
+        :param int step: the distance between two sampled k-mers of the same sequence
+        :param bool canonical: if True, the sequences holding the reverse complement of a query are returned as well
+        """
+        self.k = k
+        self.step = step
+        self.canonical = canonical
+        self.size = 0
+        runs = []
+        for seq in sequences:
+            runs.append(self._sequence_keys(seq))
+            self.size += 1
+        self._keys, self._starts, self._ordinals = array('Q'), array('Q', [0]), array('I')
+        # the (key, ordinal) pairs in sorted order, the ordinals of a key are sorted as well
+        for key, ordinal in merge(*[zip(run, repeat(ordinal)) for ordinal, run in enumerate(runs)]):
+            if not self._keys or self._keys[-1] != key:
+                if self._keys:
+                    self._starts.append(len(self._ordinals))
+                self._keys.append(key)
+            self._ordinals.append(ordinal)
+        if self._keys:
+            self._starts.append(len(self._ordinals))
+
+    def __len__(self):
+        return self.size
+
+    def _sequence_keys(self, seq):
+        # the sorted keys of the sampled k-mers of seq, a key shared by several k-mers of seq is only kept once
+        k = self.k
+        keys = set()
+        for pos in range(0, len(seq) - k + 1, self.step):
+            kmer = seq[pos:pos + k]
+            keys.add(kmer_key(canonical_kmer(kmer) if self.canonical else kmer))
+        return array('Q', sorted(keys))
+
+    def lookup(self, kmer):
+        """
+        :param str kmer: a k-mer
+        :return: the sorted ordinals of the sequences holding kmer (or its reverse complement if the index is
+            canonical) at a sampled position, different k-mers may share a key so more ordinals can be returned
+        """
+        key = kmer_key(canonical_kmer(kmer) if self.canonical else kmer)
+        i = bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            return ()
+        return self._ordinals[self._starts[i]:self._starts[i + 1]]
+
+    def seeds(self, query):
+        """
+        Select one query k-mer for each residue modulo step, preferring the k-mers with the shortest posting lists
+        :param str query: the sequence to look up
+        :return: a list of the posting lists of the selected k-mers, or None if query is too short to be looked up
+        """
+        k, step = self.k, self.step
+        last = len(query) - k
+        if last + 1 < step:
+            return None
+        seeds = []
+        for residue in range(step):
+            best = None
+            for pos in range(residue, min(last, residue + step * SEED_TRIALS) + 1, step):
+                ordinals = self.lookup(query[pos:pos + k])
+                if best is None or len(ordinals) < len(best):
+                    best = ordinals
+                    if not ordinals:
+                        # no old sequence can hold the query at an offset with this residue
+                        break
+            seeds.append(best)
+        return seeds
+
+    def candidate_ordinals(self, query):
+        """
+        Find the ordinals of the sequences that may contain query as a substring
+        :param str query: the sequence to look up
+        :return: a sorted list of ordinals, or None if query is too short to be looked up in the index
+        """
+        seeds = self.seeds(query)
+        if seeds is None:
+            return None
+        ordinals = set()
+        for seed in seeds:
+            ordinals.update(seed)
+        return sorted(ordinals)
+
+
+def write_kmer_index(kmer_index, index_file, table=None):
+    """
+    Save a KmerIndex so it can be loaded with MappedKmerIndex
+    :param KmerIndex kmer_index: the index
+    :param str index_file: the output path
+    :param dict table: extra JSON serializable information stored with the index
+    """
+    if sys.byteorder != 'little':
+        raise ValueError('k-mer indexes can only be saved on little-endian machines')
+    with open(index_file, 'wb') as index_f:
+        index_f.write(MAGIC)
+        index_f.write(kmer_index._keys.tobytes())
+        index_f.write(kmer_index._starts.tobytes())
+        index_f.write(kmer_index._ordinals.tobytes())
+        table_offset = index_f.tell()
+        index_f.write(json.dumps({'k': kmer_index.k, 'step': kmer_index.step, 'size': kmer_index.size,
+                                  'canonical': kmer_index.canonical, 'table': table or {}}).encode('utf-8'))
+        index_f.write(_FOOTER.pack(len(kmer_index._keys), len(kmer_index._ordinals), table_offset))
+
+
+class MappedKmerIndex(KmerIndex):
+    """
+    Initialize a MappedKmerIndex instance with a file written by write_kmer_index, the index is memory-mapped
+    kmer_index = MappedKmerIndex(index_file)
+    kmer_index.candidate_ordinals(query)
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        with open(index_file, 'rb') as index_f:
+            self._mm = mmap.mmap(index_f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a k-mer index' % index_file)
+        if sys.byteorder != 'little':
+            raise ValueError('k-mer indexes can only be loaded on little-endian machines')
+        key_count, posting_count, table_offset = _FOOTER.unpack(self._mm[-_FOOTER.size:])
+        info = json.loads(self._mm[table_offset:-_FOOTER.size].decode('utf-8'))
+        self.k, self.step, self.size, self.table = info['k'], info['step'], info['size'], info['table']
+        self.canonical = info.get('canonical', False)
+        view = memoryview(self._mm)
+        offset = len(MAGIC)
+        self._keys = view[offset:offset + 8 * key_count].cast('Q')
+        offset += 8 * key_count
+        self._starts = view[offset:offset + 8 * (key_count + 1)].cast('Q')
+        offset += 8 * (key_count + 1)
+        self._ordinals = view[offset:offset + 4 * posting_count].cast('I')
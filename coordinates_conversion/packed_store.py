@@ -0,0 +1,174 @@
+"""
+Compact on-disk store of the sequences of a FASTA file, queried by slice through a memory map
+
+Bases are packed 2 bits each (A=0, C=1, G=2, T=3, 4 bases per byte). Every other character, such as N or an IUPAC
+code, is recorded in a per-sequence table of runs and written as A in the packed bases. Sequences are stored in
+upper case. Several processes opening the same store share the pages of the packed bases.
+
+File layout:
+* 8 bytes magic
+* packed bases of every sequence, one after another
+* JSON table of the sequences: id, header, length, byte offset, digest and runs of other characters
+* 8 bytes little-endian byte offset of the JSON table
+"""
+
+from bisect import bisect_right
+from os.path import getmtime, isfile
+import json
+import logging
+import mmap
+import re
+import struct
+import sys
+
+from coordinates_conversion.fasta import read_fasta, sequence_digest
+
+MAGIC = b'CCPACK\x00\x01'
+_FOOTER = struct.Struct('<Q')
+_ENCODE = str.maketrans('ACGT', '0123')
+_OTHER_RE = re.compile(r'[^ACGT]')
+_OTHER_RUN_RE = re.compile(r'([^ACGT])\1*')
+# maps a native uint16 of two packed bytes to its 8 bases, built on first use
+_DECODE = None
+
+
+def _decode_table():
+    global _DECODE
+    if _DECODE is None:
+        bases = [b'ACGT'[i >> 6] + b'ACGT'[(i >> 4) & 3] * 256 + b'ACGT'[(i >> 2) & 3] * 65536 + b'ACGT'[i & 3] * 16777216
+                 for i in range(256)]
+        quads = [b.to_bytes(4, 'little') for b in bases]
+        _DECODE = [None] * 65536
+        for b0 in range(256):
+            for b1 in range(256):
+                _DECODE[int.from_bytes(bytes((b0, b1)), sys.byteorder)] = quads[b0] + quads[b1]
+    return _DECODE
+
+
+def _pack(seq):
+    # 2-bit pack the bases of seq, any other character is packed as A
+    codes = _OTHER_RE.sub('A', seq).translate(_ENCODE)
+    codes += '0' * (-len(codes) % 4)
+    if not codes:
+        return b''
+    return int(codes, 4).to_bytes(len(codes) // 4, 'big')
+
+
+def write_packed_store(fasta_file, store_file):
+    """
+    Write the sequences of fasta_file to a packed store
+    :param str fasta_file: the FASTA file path
+    :param str store_file: the packed store path
+    :return: the number of sequences written
+    """
+    records = []
+    with open(store_file, 'wb') as store_f:
+        store_f.write(MAGIC)
+        offset = len(MAGIC)
+        for header, seq in read_fasta(fasta_file):
+            seq = seq.upper()
+            packed = _pack(seq)
+            store_f.write(packed)
+            records.append({
+                'id': header.split()[0][1:],
+                'header': header,
+                'length': len(seq),
+                'offset': offset,
+                'digest': sequence_digest(seq),
+                'other': [[m.start(), m.end(), m.group(1)] for m in _OTHER_RUN_RE.finditer(seq)]
+            })
+            offset += len(packed)
+        store_f.write(json.dumps({'records': records}).encode('utf-8'))
+        store_f.write(_FOOTER.pack(offset))
+    return len(records)
+
+
+def open_packed_store(fasta_file):
+    """
+    Open the packed store of fasta_file (fasta_file + '.pack'), it is (re)built if it is missing or older than fasta_file
+    :param str fasta_file: the FASTA file path
+    :return: a PackedSequenceStore
+    """
+    store_file = fasta_file + '.pack'
+    if not isfile(store_file) or getmtime(store_file) < getmtime(fasta_file):
+        logging.info('  Writing packed store (%s)...', store_file)
+        write_packed_store(fasta_file, store_file)
+    return PackedSequenceStore(store_file)
+
+
+class PackedSequenceStore(object):
+    """
+    Initialize a PackedSequenceStore instance with a store file written by write_packed_store
+    store = PackedSequenceStore(store_file)
+    Sequences are addressed by their position in the FASTA file
+    store.fetch(store.ordinal['scaffold_1'], 100, 200)
+    """
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self._open()
+
+    def _open(self):
+        with open(self.store_file, 'rb') as store_f:
+            self._mm = mmap.mmap(store_f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a packed sequence store' % self.store_file)
+        table_offset = _FOOTER.unpack(self._mm[-_FOOTER.size:])[0]
+        self.records = json.loads(self._mm[table_offset:-_FOOTER.size].decode('utf-8'))['records']
+        self.ordinal = dict((r['id'], i) for i, r in enumerate(self.records))
+        self._other_ends = [[run[1] for run in r['other']] for r in self.records]
+
+    def __getstate__(self):
+        # only the path is pickled, the store is mapped again when unpickled
+        return {'store_file': self.store_file}
+
+    def __setstate__(self, state):
+        self.store_file = state['store_file']
+        self._open()
+
+    def __len__(self):
+        return len(self.records)
+
+    def close(self):
+        self._mm.close()
+
+    def length(self, record):
+        """
+        :param int record: the position of the sequence in the store
+        :return: the length of the sequence
+        """
+        return self.records[record]['length']
+
+    def fetch(self, record, start=0, end=None):
+        """
+        Returns the slice [start, end) of a sequence, 0-based coordinates
+        :param int record: the position of the sequence in the store
+        :param int start: the slice start
+        :param int end: the slice end, None for the end of the sequence
+        :return: an upper case string
+        """
+        r = self.records[record]
+        if end is None or end > r['length']:
+            end = r['length']
+        if start >= end:
+            return ''
+        byte_start, byte_end = start // 4, (end + 3) // 4
+        data = self._mm[r['offset'] + byte_start:r['offset'] + byte_end]
+        if len(data) % 2:
+            data += b'\x00'
+        text = b''.join(map(_decode_table().__getitem__, memoryview(data).cast('H')))
+        text = text[start - byte_start * 4:end - byte_start * 4].decode('ascii')
+        other, ends = r['other'], self._other_ends[record]
+        i = bisect_right(ends, start)
+        if i == len(other) or other[i][0] >= end:
+            return text
+        pieces = []
+        pos = start
+        while i < len(other) and other[i][0] < end:
+            run_start, run_end, c = max(other[i][0], start), min(other[i][1], end), other[i][2]
+            pieces.append(text[pos - start:run_start - start])
+            pieces.append(c * (run_end - run_start))
+            pos = run_end
+            i += 1
+        pieces.append(text[pos - start:])
+        return ''.join(pieces)
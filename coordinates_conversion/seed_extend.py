@@ -0,0 +1,55 @@
+"""
+Gapless alignment blocks between two near-identical sequences with small edits (substitutions and short indels)
+
+The new sequence is scanned for exact k-mer seeds. The first seed, and any seed after a long unaligned stretch, is
+looked up in a sparse table of the k-mers of the old sequence at multiples of step. Once a diagonal is known, the next
+seed after an edit is only searched within band bases of it, so substitutions keep the diagonal and indels shorter
+than band shift it. Every seed is extended in both directions with block-wise comparisons to a maximal exact block.
+"""
+
+from coordinates_conversion.seq_compare import match_length, match_length_backward
+
+DEFAULT_K = 32
+DEFAULT_STEP = 16
+DEFAULT_BAND = 16
+
+
+def gapless_blocks(old_seq, new_seq, k=DEFAULT_K, step=DEFAULT_STEP, band=DEFAULT_BAND):
+    """
+    Find the exact blocks shared by two sequences in the same order, between small edits
+    :param str old_seq: the old sequence
+    :param str new_seq: the new sequence
+    :param int k: the seed length, blocks are at least k long
+    :param int step: the distance between two sampled k-mers of the old sequence
+    :param int band: the largest shift of the diagonal between two blocks searched around the previous block
+    :return: a list of [old_start, old_end, new_start, new_end], 0-based, increasing in both sequences
+    """
+    samples = dict()
+    for pos in range(0, len(old_seq) - k + 1, step):
+        samples.setdefault(old_seq[pos:pos + k], pos)
+
+    blocks = []
+    old_floor, new_floor = 0, 0
+    diagonal = None
+    n = 0
+    while n <= len(new_seq) - k:
+        seed = new_seq[n:n + k]
+        pos = -1
+        if diagonal is not None:
+            pos = old_seq.find(seed, max(old_floor, n + diagonal - band), n + diagonal + band + k)
+        if pos == -1 and (diagonal is None or n - new_floor > band + k):
+            # no block nearby, anchor on a sampled k-mer after the previous block
+            pos = samples.get(seed, -1)
+            if pos < old_floor:
+                pos = -1
+        if pos == -1:
+            masked = seed.rfind('N')
+            n += masked + 1 if masked != -1 else 1
+            continue
+        back = match_length_backward(old_seq, pos, new_seq, n, min(pos - old_floor, n - new_floor))
+        forward = match_length(old_seq, pos + k, new_seq, n + k)
+        blocks.append([pos - back, pos + k + forward, n - back, n + k + forward])
+        diagonal = pos - n
+        old_floor, new_floor = pos + k + forward, n + k + forward
+        n = new_floor + 1
+    return blocks
@@ -0,0 +1,142 @@
+"""
+Block-wise comparison of sequence regions
+
+Comparing two regions one character at a time in Python is slow on long scaffolds, and comparing two full slices
+copies both regions. match_length compares blocks that start small and double in size, so the work is proportional
+to the length of the match instead of the length of the sequences, and only locates the first mismatch inside the
+mismatching block with a binary search. The sequences can be str, bytes or memoryview objects, slicing a memoryview
+does not copy.
+
+masked_match_runs finds the regions shared by a sequence and a copy of it of the same length with some bases masked,
+it compares every unmasked segment once and only scans the masked regions of the old sequence.
+"""
+
+import re
+
+MIN_BLOCK = 64
+MAX_BLOCK = 1 << 16
+
+
+def match_length(a, a_start, b, b_start, limit=None):
+    """
+    Returns the length of the longest common prefix of a[a_start:] and b[b_start:]
+    :param a: the first sequence
+    :param int a_start: the start of the region of a, 0-based
+    :param b: the second sequence
+    :param int b_start: the start of the region of b, 0-based
+    :param int limit: the maximum length returned, None for no limit
+    :return: an int
+    """
+    end = max(0, min(len(a) - a_start, len(b) - b_start))
+    if limit is not None:
+        end = min(end, limit)
+    pos = 0
+    block = MIN_BLOCK
+    while pos < end:
+        size = min(block, end - pos)
+        if a[a_start + pos:a_start + pos + size] != b[b_start + pos:b_start + pos + size]:
+            # the first mismatch is in [pos, pos + size)
+            lo, hi = pos, pos + size - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if a[a_start + lo:a_start + mid + 1] == b[b_start + lo:b_start + mid + 1]:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+        pos += size
+        block = min(block * 2, MAX_BLOCK)
+    return end
+
+
+def regions_equal(a, a_start, a_end, b, b_start, b_end):
+    """
+    Returns a[a_start:a_end] == b[b_start:b_end] without copying the full regions
+    :param a: the first sequence
+    :param int a_start: the start of the region of a, 0-based
+    :param int a_end: the end of the region of a, exclusive
+    :param b: the second sequence
+    :param int b_start: the start of the region of b, 0-based
+    :param int b_end: the end of the region of b, exclusive
+    :return: a bool
+    """
+    a_end, b_end = min(a_end, len(a)), min(b_end, len(b))
+    length = max(0, a_end - a_start)
+    if length != max(0, b_end - b_start):
+        return False
+    return match_length(a, a_start, b, b_start, length) == length
+
+
+def masked_match_runs(old_seq, new_seq, mask='N'):
+    """
+    Compare two sequences of the same length where new_seq is old_seq with some bases replaced by mask
+    :param str old_seq: the old sequence
+    :param str new_seq: the new sequence
+    :param str mask: the masking character
+    :return: None if new_seq is not old_seq with masked bases, otherwise a list of (start, end) of the maximal regions
+        where both sequences are equal, each region starts at a base of new_seq that is not masked and regions
+        holding only masked bases are left out
+    """
+    if len(old_seq) != len(new_seq):
+        return None
+    unmasked = re.compile('[^%s]+' % re.escape(mask))
+    # every unmasked base of new_seq has to be equal, only the masked ones can differ
+    masked = []
+    pos = 0
+    for m in unmasked.finditer(new_seq):
+        if not regions_equal(old_seq, m.start(), m.end(), new_seq, m.start(), m.end()):
+            return None
+        if pos < m.start():
+            masked.append((pos, m.start()))
+        pos = m.end()
+    if pos < len(new_seq):
+        masked.append((pos, len(new_seq)))
+
+    runs = []
+    start = 0
+    for masked_start, masked_end in masked:
+        # the bases of old_seq masked in new_seq break the equal regions
+        for m in unmasked.finditer(old_seq, masked_start, masked_end):
+            runs.append((start, m.start()))
+            start = m.end()
+    runs.append((start, len(new_seq)))
+
+    regions = []
+    for run_start, run_end in runs:
+        m = unmasked.search(new_seq, run_start, run_end)
+        if m is not None:
+            regions.append((m.start(), run_end))
+    return regions
+
+
+def match_length_backward(a, a_end, b, b_end, limit=None):
+    """
+    Returns the length of the longest common suffix of a[:a_end] and b[:b_end]
+    :param a: the first sequence
+    :param int a_end: the end of the region of a, exclusive
+    :param b: the second sequence
+    :param int b_end: the end of the region of b, exclusive
+    :param int limit: the maximum length returned, None for no limit
+    :return: an int
+    """
+    end = max(0, min(a_end, b_end, len(a), len(b)))
+    if limit is not None:
+        end = min(end, limit)
+    a_end, b_end = min(a_end, len(a)), min(b_end, len(b))
+    pos = 0
+    block = MIN_BLOCK
+    while pos < end:
+        size = min(block, end - pos)
+        if a[a_end - pos - size:a_end - pos] != b[b_end - pos - size:b_end - pos]:
+            # the first mismatch from the end is in [pos, pos + size)
+            lo, hi = pos, pos + size - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if a[a_end - mid - 1:a_end - lo] == b[b_end - mid - 1:b_end - lo]:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+        pos += size
+        block = min(block * 2, MAX_BLOCK)
+    return end
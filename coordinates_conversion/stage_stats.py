@@ -0,0 +1,122 @@
+"""
+Per-stage performance counters of a multi stage run, saved as a JSON report
+
+Every stage records its wall time, CPU time (of the process and of the worker processes it waited for), the peak
+resident memory of the process at the end of the stage, and the work counters reported by the stage: the number of
+candidate comparisons and the number of sequence bytes scanned.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is not reported
+    resource = None
+
+
+def peak_memory():
+    """
+    Returns the peak resident memory of the process and of its terminated child processes
+    :return: a tuple of (self, children) in bytes, or (None, None) if it can not be measured on this platform
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def _cpu_time():
+    # process_time has a finer resolution than os.times, which is only needed for the terminated child processes
+    t = os.times()
+    return time.process_time(), t.children_user + t.children_system
+
+
+class StageStats(object):
+    """
+    Initialize a StageStats instance, then wrap every stage in start and stop
+    stats = StageStats()
+    stats.start(1, 'match_identical_sequence')
+    stats.count(comparisons=10, scanned=1000)
+    stats.stop(matched=5)
+    stats.write(json_file, version='1.1')
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._current = None
+        self._wall = None
+        self._cpu = None
+
+    def start(self, stage, name):
+        """
+        :param int stage: the stage number
+        :param str name: the stage name
+        """
+        self._current = {'stage': stage, 'name': name, 'candidate_comparisons': 0, 'bytes_scanned': 0}
+        self._wall = time.perf_counter()
+        self._cpu = _cpu_time()
+
+    def count(self, comparisons=0, scanned=0):
+        """
+        Add to the work counters of the running stage
+        :param int comparisons: the number of candidate comparisons
+        :param int scanned: the number of sequence bytes scanned
+        """
+        self._current['candidate_comparisons'] += comparisons
+        self._current['bytes_scanned'] += scanned
+
+    def stop(self, **extra):
+        """
+        Finish the running stage
+        :param extra: additional JSON serializable values saved with the stage
+        :return: the dict of the stage
+        """
+        cpu_self, cpu_children = _cpu_time()
+        peak_self, peak_children = peak_memory()
+        stage = self._current
+        stage.update({
+            'wall_time': round(time.perf_counter() - self._wall, 6),
+            'cpu_time': round(cpu_self - self._cpu[0], 6),
+            'children_cpu_time': round(cpu_children - self._cpu[1], 6),
+            'peak_memory': peak_self,
+            'children_peak_memory': peak_children,
+        })
+        stage.update(extra)
+        self.stages.append(stage)
+        self._current = None
+        logging.debug('  Wall time: %.3fs, CPU time: %.3fs, candidate comparisons: %d, bytes scanned: %d',
+                      stage['wall_time'], stage['cpu_time'] + stage['children_cpu_time'],
+                      stage['candidate_comparisons'], stage['bytes_scanned'])
+        return stage
+
+    def to_dict(self, **info):
+        """
+        :param info: additional JSON serializable values describing the run
+        :return: a dict with the run information, the stages and their totals
+        """
+        total = dict((key, sum(s[key] for s in self.stages)) for key in
+                     ['wall_time', 'cpu_time', 'children_cpu_time', 'candidate_comparisons', 'bytes_scanned'])
+        total['wall_time'] = round(total['wall_time'], 6)
+        total['cpu_time'] = round(total['cpu_time'], 6)
+        total['children_cpu_time'] = round(total['children_cpu_time'], 6)
+        total['peak_memory'], total['children_peak_memory'] = peak_memory()
+        report = dict(info)
+        report.update({'stages': self.stages, 'total': total})
+        return report
+
+    def write(self, json_file, **info):
+        """
+        Save the report
+        :param str json_file: the output path
+        :param info: additional JSON serializable values describing the run
+        """
+        with open(json_file, 'w') as json_file_f:
+            json.dump(self.to_dict(**info), json_file_f, indent=2)
+            json_file_f.write('\n')
@@ -0,0 +1,76 @@
+"""
+Shared helpers of the coordinates_conversion tests: random sequences, FASTA files and fasta_diff runs
+"""
+
+from os.path import abspath, dirname
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+REPO_ROOT = dirname(dirname(abspath(__file__)))
+
+
+def random_sequence(rng, length, alphabet='ACGT'):
+    """
+    :param random.Random rng: the random generator
+    :param int length: the sequence length
+    :param str alphabet: the characters of the sequence
+    :return: a random string
+    """
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+def write_fasta(fasta_file, records, width=60):
+    """
+    Write a FASTA file
+    :param str fasta_file: the output path
+    :param records: a list of (id or header without '>', sequence)
+    :param int width: the length of the sequence lines, 0 for a single line per sequence
+    """
+    with open(fasta_file, 'w') as fasta_f:
+        for header, seq in records:
+            fasta_f.write('>%s\n' % header)
+            if width:
+                for start in range(0, len(seq), width):
+                    fasta_f.write(seq[start:start + width] + '\n')
+            else:
+                fasta_f.write(seq + '\n')
+
+
+def run_module(module, args, cwd):
+    """
+    Run a coordinates_conversion command as a script
+    :param str module: the module name, such as 'coordinates_conversion.bin.fasta_diff'
+    :param args: the command line arguments
+    :param cwd: the working directory
+    :return: the subprocess.CompletedProcess, with the log in stderr
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    result = subprocess.run([sys.executable, '-m', module] + [str(a) for a in args], cwd=str(cwd), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+    return result
+
+
+def run_fasta_diff(args, cwd):
+    """
+    Run fasta_diff
+    :param args: the command line arguments
+    :param cwd: the working directory
+    :return: the log of the run
+    """
+    return run_module('coordinates_conversion.bin.fasta_diff', args, cwd).stderr
+
+
+def read_text(path):
+    with open(str(path)) as f:
+        return f.read()
+
+
+@pytest.fixture
+def rng():
+    return random.Random(20200501)
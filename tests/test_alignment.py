@@ -0,0 +1,144 @@
+import shutil
+
+from conftest import REPO_ROOT, run_fasta_diff
+from coordinates_conversion.alignment import (STREAM_BEGIN, STREAM_END, AlignmentIndex, MappedAlignmentIndex,
+                                              convert_boundary, convert_position, open_alignment_index,
+                                              read_alignment_list_tsv, write_compiled_alignments)
+
+import pytest
+
+OLD_IDS = ['chr1', 'chr2', 'scaffold_3']
+
+
+def _random_alignments(rng, count=80, strands=True):
+    # overlapping alignments of a few old sequences, in no particular order
+    alignments = []
+    for _ in range(count):
+        old_start = rng.randint(0, 900)
+        old_end = old_start + rng.choice([1, 2, 5, 40, 300])
+        new_start = rng.randint(0, 500)
+        alignment = [rng.choice(OLD_IDS), old_start, old_end, 'new%d' % rng.randint(1, 4), new_start,
+                     new_start + old_end - old_start]
+        if strands:
+            alignment.append(rng.choice('+-'))
+        alignments.append(alignment)
+    return alignments
+
+
+def _scan(alignments, old_id, position, boundary):
+    # linear scan reference of position_mappings and boundary_mappings
+    if boundary:
+        return [a for a in alignments if a[0] == old_id and a[1] <= position <= a[2]]
+    return [a for a in alignments if a[0] == old_id and a[1] < position <= a[2]]
+
+
+@pytest.mark.parametrize('strands', [False, True])
+def test_index_matches_linear_scan(rng, strands):
+    alignments = _random_alignments(rng, strands=strands)
+    alignment_index = AlignmentIndex(alignments)
+    assert sorted(alignment_index) == OLD_IDS
+    assert 'missing' not in alignment_index
+    assert alignment_index.position_mappings('missing', 10) == []
+    for old_id in OLD_IDS:
+        assert alignment_index[old_id] == [a for a in alignments if a[0] == old_id]
+        for position in range(0, 1300):
+            assert alignment_index.position_mappings(old_id, position) == _scan(alignments, old_id, position, False)
+            assert alignment_index.boundary_mappings(old_id, position) == _scan(alignments, old_id, position, True)
+
+
+def test_convert_on_both_strands():
+    forward = ['old', 10, 20, 'new', 100, 110, '+']
+    reverse = ['old', 10, 20, 'new', 100, 110, '-']
+    # the first and last bases, 1-based
+    assert (convert_position(forward, 11), convert_position(forward, 20)) == (101, 110)
+    assert (convert_position(reverse, 11), convert_position(reverse, 20)) == (110, 101)
+    # the boundaries, 0-based
+    assert (convert_boundary(forward, 10), convert_boundary(forward, 20)) == (100, 110)
+    assert (convert_boundary(reverse, 10), convert_boundary(reverse, 20)) == (110, 100)
+
+
+def _lookups(rng):
+    # sorted positions along each sequence, with repeats, then positions in random order and on missing sequences
+    lookups = []
+    for old_id in OLD_IDS + ['missing']:
+        lookups.extend((old_id, position) for position in sorted(rng.randint(0, 1300) for _ in range(300)))
+    lookups.extend((rng.choice(OLD_IDS), rng.randint(0, 1300)) for _ in range(300))
+    return lookups
+
+
+def test_cursors_match_the_index(rng):
+    alignments = _random_alignments(rng)
+    alignment_index = AlignmentIndex(alignments)
+    position_cursor = alignment_index.position_cursor()
+    boundary_cursor = alignment_index.boundary_cursor()
+    for old_id, position in _lookups(rng):
+        assert position_cursor.mappings(old_id, position) == _scan(alignments, old_id, position, False)
+        assert boundary_cursor.mappings(old_id, position) == _scan(alignments, old_id, position, True)
+    assert position_cursor.out_of_order > 0
+
+
+def test_cursor_on_sorted_input(rng):
+    alignments = _random_alignments(rng)
+    cursor = AlignmentIndex(alignments).boundary_cursor()
+    for old_id in OLD_IDS:
+        for position in range(0, 1300):
+            assert cursor.mappings(old_id, position) == _scan(alignments, old_id, position, True)
+    assert cursor.out_of_order == 0
+
+
+@pytest.mark.parametrize('strands', [False, True])
+def test_compiled_round_trip(tmp_path, rng, strands):
+    alignments = _random_alignments(rng, strands=strands)
+    # a mix of 6 and 7 column alignments
+    alignments[0] = alignments[0][:6]
+    compiled_file = str(tmp_path / 'match.cca')
+    write_compiled_alignments(alignments, compiled_file)
+    mapped = MappedAlignmentIndex(compiled_file)
+    assert mapped.alignments() == alignments
+    assert sorted(mapped) == OLD_IDS and len(mapped) == len(OLD_IDS)
+    assert 'missing' not in mapped
+    for old_id in OLD_IDS:
+        assert mapped[old_id] == [a for a in alignments if a[0] == old_id]
+        for position in range(0, 1300, 7):
+            assert mapped.position_mappings(old_id, position) == _scan(alignments, old_id, position, False)
+            assert mapped.boundary_mappings(old_id, position) == _scan(alignments, old_id, position, True)
+    cursor = mapped.position_cursor()
+    for old_id, position in _lookups(rng):
+        assert cursor.mappings(old_id, position) == _scan(alignments, old_id, position, False)
+
+
+def test_open_alignment_index(tmp_path, rng):
+    alignments = _random_alignments(rng)
+    tsv_file = str(tmp_path / 'match.tsv')
+    with open(tsv_file, 'w') as tsv_f:
+        tsv_f.write('#comment\n')
+        for alignment in alignments:
+            tsv_f.write('\t'.join(str(a) for a in alignment) + '\n')
+    compiled_file = str(tmp_path / 'match.cca')
+    write_compiled_alignments(alignments, compiled_file)
+    assert type(open_alignment_index(tsv_file)) is AlignmentIndex
+    assert isinstance(open_alignment_index(compiled_file), MappedAlignmentIndex)
+    for path in (tsv_file, compiled_file):
+        with open(path, 'rb') as alignment_f:
+            assert open_alignment_index(alignment_f).alignments() == alignments
+
+
+def test_truncated_stream(tmp_path):
+    for name in ('old.fa', 'new.fa'):
+        shutil.copy(REPO_ROOT + '/example_file/' + name, str(tmp_path))
+    run_fasta_diff(['old.fa', 'new.fa', '-o', 'match.tsv'], tmp_path)
+    run_fasta_diff(['old.fa', 'new.fa', '-o', 'stream.tsv', '--stream'], tmp_path)
+    with open(str(tmp_path / 'stream.tsv'), 'rb') as stream_f:
+        lines = stream_f.read().decode('utf-8').splitlines(True)
+    assert lines[0] == STREAM_BEGIN + '\n' and lines[-1] == STREAM_END + '\n' and len(lines) > 3
+    expected = read_alignment_list_tsv(str(tmp_path / 'match.tsv'))
+    assert read_alignment_list_tsv(str(tmp_path / 'stream.tsv')) == expected
+    # a stream cut after an alignment line, or right before its end line
+    for end in (2, len(lines) - 1):
+        truncated_file = str(tmp_path / ('truncated_%d.tsv' % end))
+        with open(truncated_file, 'wb') as truncated_f:
+            truncated_f.write(''.join(lines[:end]).encode('utf-8'))
+        with pytest.raises(ValueError, match='ended before its last line, fasta_diff did not finish'):
+            read_alignment_list_tsv(truncated_file)
+        with pytest.raises(ValueError, match='ended before its last line'):
+            open_alignment_index(truncated_file)
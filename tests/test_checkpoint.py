@@ -0,0 +1,83 @@
+"""
+fasta_diff checkpoints: an interrupted run resumes after the last saved stage, a change of the FASTA files or of the
+version never reuses a saved stage
+"""
+
+import logging
+import os
+import random
+
+from conftest import random_sequence, write_fasta
+from coordinates_conversion.bin import fasta_diff as fasta_diff_module
+from coordinates_conversion.checkpoint import StageCheckpoint
+from coordinates_conversion.fasta import read_fasta
+
+import pytest
+
+
+@pytest.fixture
+def assemblies(tmp_path, monkeypatch):
+    # a case for each of the stages 1 to 4
+    rng = random.Random(8)
+    old = [('old%d' % n, random_sequence(rng, 400)) for n in range(5)]
+    new = [('new0', old[0][1]), ('old1', old[1][1][20:-20]), ('old2', old[2][1][:100] + 'N' * 20 + old[2][1][120:]),
+           ('old3_a', old[3][1][:150]), ('old3_b', old[3][1][200:])]
+    write_fasta(str(tmp_path / 'old.fa'), old)
+    write_fasta(str(tmp_path / 'new.fa'), new)
+    monkeypatch.chdir(str(tmp_path))
+    return tmp_path
+
+
+def _run(caplog, **options):
+    # returns the alignments and the stages resumed from a checkpoint
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        alignment_list = fasta_diff_module.fasta_diff('old.fa', 'new.fa', debug=False, checkpoint_dir='ckpt', **options)[0]
+    resumed = [r.getMessage().split(' - ')[0] for r in caplog.records if r.getMessage().endswith('resumed from checkpoint')]
+    return alignment_list, resumed
+
+
+def test_round_trip(tmp_path):
+    input_file = str(tmp_path / 'in.txt')
+    with open(input_file, 'w') as input_f:
+        input_f.write('a')
+    checkpoint = StageCheckpoint(str(tmp_path / 'ckpt'), [input_file], '1.0')
+    assert checkpoint.load(1) is None
+    checkpoint.save(1, {'alignments': [['a', 0, 1, 'b', 0, 1]]})
+    assert StageCheckpoint(str(tmp_path / 'ckpt'), [input_file], '1.0').load(1) == {'alignments': [['a', 0, 1, 'b', 0, 1]]}
+    assert not [name for name in os.listdir(checkpoint.directory) if name.endswith('.tmp')]
+    # the directory is keyed on the content of the inputs and the version
+    assert StageCheckpoint(str(tmp_path / 'ckpt'), [input_file], '1.1').load(1) is None
+    with open(input_file, 'w') as input_f:
+        input_f.write('b')
+    assert StageCheckpoint(str(tmp_path / 'ckpt'), [input_file], '1.0').load(1) is None
+
+
+def test_interrupted_run_resumes(assemblies, caplog):
+    expected, resumed = _run(caplog)
+    assert resumed == [] and len(set(a[3] for a in expected)) == 5
+    assert _run(caplog) == (expected, ['Stage 1', 'Stage 2', 'Stage 3', 'Stage 4'])
+    # a run interrupted during stage 3
+    directory = os.path.join('ckpt', os.listdir('ckpt')[0])
+    for stage in (3, 4):
+        os.remove(os.path.join(directory, 'stage_%d.json' % stage))
+    assert _run(caplog) == (expected, ['Stage 1', 'Stage 2'])
+
+
+def test_edited_input_is_not_resumed(assemblies, caplog):
+    _run(caplog)
+    # the truncated sequence is now longer than the old one
+    new = [(header[1:], 'ACGT' + seq if header == '>old1' else seq) for header, seq in read_fasta('new.fa')]
+    write_fasta('new.fa', new)
+    alignment_list, resumed = _run(caplog)
+    assert resumed == []
+    assert 'old1' not in [a[3] for a in alignment_list]
+    assert alignment_list == fasta_diff_module.fasta_diff('old.fa', 'new.fa', debug=False)[0]
+    assert len(os.listdir('ckpt')) == 2
+
+
+def test_version_change_is_not_resumed(assemblies, caplog, monkeypatch):
+    expected, resumed = _run(caplog)
+    monkeypatch.setattr(fasta_diff_module, '__version__', fasta_diff_module.__version__ + '.1')
+    assert _run(caplog) == (expected, [])
+    assert _run(caplog) == (expected, ['Stage 1', 'Stage 2', 'Stage 3', 'Stage 4'])
@@ -0,0 +1,85 @@
+import io
+import os
+
+from conftest import random_sequence, write_fasta
+from coordinates_conversion.fasta import CHUNK_SIZE, read_fasta, read_sequence_lengths
+
+import pytest
+
+
+def _parse(text):
+    # line by line reference parser
+    records = []
+    for line in text.splitlines():
+        if line.startswith('>'):
+            records.append([line.strip(), ''])
+        elif records:
+            records[-1][1] += ''.join(line.split())
+    return [tuple(record) for record in records]
+
+
+UNEVEN = (
+    '>seq1 first\nACGTAC\nGT\nACGTACGTAC\n'
+    '>seq2\r\nAC>GT\r\nNNNN\r\n\r\n'
+    '>seq3 empty\n'
+    '>seq4\nA C G T\nacgt\n\n'
+    '>seq5 long header ' + 'x' * 23 + '\nTTTT'
+)
+
+
+@pytest.mark.parametrize('chunk_size', range(1, 41))
+def test_small_chunks(chunk_size):
+    expected = _parse(UNEVEN)
+    assert [r[0] for r in expected] == ['>seq1 first', '>seq2', '>seq3 empty', '>seq4', '>seq5 long header ' + 'x' * 23]
+    assert list(read_fasta(io.BytesIO(UNEVEN.encode('utf-8')), chunk_size)) == expected
+
+
+@pytest.mark.parametrize('shift', [-3, -2, -1, 0, 1, 4])
+def test_records_across_the_default_chunk_boundary(tmp_path, shift):
+    # the second header starts shift bytes after the first 4 MB chunk, the first sequence is on one line
+    first = 'ACGT' * ((CHUNK_SIZE + shift - len('>r1\n') - 1) // 4)
+    first += 'A' * ((CHUNK_SIZE + shift - len('>r1\n') - 1) % 4)
+    records = [('r1', first), ('r2 split header', 'GATTACA' * 40), ('r3', 'C' * 61)]
+    fasta_file = str(tmp_path / 'big.fa')
+    with open(fasta_file, 'w') as fasta_f:
+        fasta_f.write('>r1\n%s\n' % first)
+        assert fasta_f.tell() == CHUNK_SIZE + shift
+    with open(fasta_file, 'a') as fasta_f:
+        for header, seq in records[1:]:
+            fasta_f.write('>%s\n' % header)
+            for start in range(0, len(seq), 60):
+                fasta_f.write(seq[start:start + 60] + '\n')
+    assert list(read_fasta(fasta_file)) == [('>' + header, seq) for header, seq in records]
+
+
+def test_sequence_spanning_chunks(tmp_path, rng):
+    records = [('s%d' % i, random_sequence(rng, rng.randint(0, 3000))) for i in range(30)]
+    fasta_file = str(tmp_path / 'many.fa')
+    write_fasta(fasta_file, records, width=73)
+    expected = [('>' + header, seq) for header, seq in records]
+    for chunk_size in (64, 1000, 4099):
+        assert list(read_fasta(fasta_file, chunk_size)) == expected
+
+
+def test_read_sequence_lengths(tmp_path):
+    fasta_file = str(tmp_path / 'uneven.fa')
+    with open(fasta_file, 'w') as fasta_f:
+        fasta_f.write('>a desc\nACG\nTACGTAC\nA\n>b\nNNNNN\n>a\nAC\n')
+    lengths = read_sequence_lengths(fasta_file)
+    assert list(lengths.items()) == [('a', 13), ('b', 5)]
+
+
+def test_read_sequence_lengths_from_fai(tmp_path):
+    fasta_file = str(tmp_path / 'indexed.fa')
+    with open(fasta_file, 'w') as fasta_f:
+        fasta_f.write('>a\nACGT\nAC\n>b desc\nNNN\n')
+    # the lengths of the index differ from the sequences to tell which one is read
+    with open(fasta_file + '.fai', 'w') as fai_f:
+        fai_f.write('a\t60\t3\t4\t5\nb\t70\t19\t3\t4\n')
+    mtime = os.path.getmtime(fasta_file)
+    os.utime(fasta_file + '.fai', (mtime + 10, mtime + 10))
+    assert list(read_sequence_lengths(fasta_file).items()) == [('a', 60), ('b', 70)]
+    # an index older than the FASTA file is not used or rewritten
+    os.utime(fasta_file + '.fai', (mtime - 10, mtime - 10))
+    assert list(read_sequence_lengths(fasta_file).items()) == [('a', 6), ('b', 3)]
+    assert os.path.getmtime(fasta_file + '.fai') == mtime - 10
@@ -0,0 +1,215 @@
+"""
+fasta_diff runs on a synthetic pair of assemblies with a case for every stage: the sharded, incremental and masked fast
+path runs have to give the output of a plain run
+"""
+
+import logging
+import random
+import re
+
+from conftest import random_sequence, read_text, run_fasta_diff, write_fasta
+from coordinates_conversion.bin import fasta_diff as fasta_diff_module
+from coordinates_conversion.fasta import read_fasta, reverse_complement
+
+import pytest
+
+
+def _mask(rng, seq, runs):
+    # replace runs of bases by N
+    seq = list(seq)
+    for _ in range(runs):
+        start = rng.randint(1, len(seq) - 40)
+        seq[start:start + 20] = 'N' * 20
+    return ''.join(seq)
+
+
+def _assemblies(rng):
+    """
+    :return: the old and the new records, as lists of (id, sequence)
+    """
+    old, new = [], []
+    for n in range(40):
+        seq = random_sequence(rng, rng.randint(300, 1500))
+        old_id = 'old%d' % n
+        old.append((old_id, seq))
+        case = n % 10
+        if case == 0:
+            # identical, renamed
+            new.append(('new%d' % n, seq))
+        elif case == 1:
+            # truncated
+            new.append((old_id, seq[rng.randint(1, 100):-rng.randint(1, 100)]))
+        elif case == 2:
+            # masked, same length
+            new.append((old_id, _mask(rng, seq, 2)))
+        elif case == 3:
+            # split in two around an N region, the second part masked
+            cut = len(seq) // 2
+            new.append((old_id + '_a', seq[:cut]))
+            new.append((old_id + '_b', 'NNNNN' + _mask(rng, seq[cut + 50:], 1)))
+        elif case == 4:
+            # split in three masked parts, with some bases removed between them
+            third = len(seq) // 3
+            new.append((old_id + '_a', _mask(rng, seq[:third - 10], 1)))
+            new.append((old_id + '_b', _mask(rng, seq[third + 10:2 * third - 10], 1)))
+            new.append((old_id + '_c', _mask(rng, seq[2 * third + 10:], 1)))
+        elif case == 5:
+            # reverse complemented, and a reverse complemented part
+            new.append((old_id, reverse_complement(seq)))
+            new.append((old_id + '_rc', reverse_complement(seq[50:250])))
+        elif case == 6:
+            # a longer old sequence holding the same bases makes a masked sequence ambiguous
+            old.append((old_id + '_long', seq + random_sequence(rng, 200)))
+            new.append((old_id, _mask(rng, seq, 1)))
+        elif case == 7:
+            # not found
+            new.append(('novel%d' % n, random_sequence(rng, 500)))
+        elif case == 8:
+            # two old sequences differing in the masked bases only make the masked sequence ambiguous
+            other = seq[:100] + random_sequence(rng, 20) + seq[120:]
+            old.append((old_id + '_other', other))
+            new.append((old_id, seq[:100] + 'N' * 20 + seq[120:]))
+        else:
+            # removed
+            pass
+    rng.shuffle(new)
+    return old, new
+
+
+@pytest.fixture(scope='module')
+def assemblies(tmp_path_factory):
+    """
+    :return: the directory holding old.fa and new.fa, with the output of a plain run for each strand option
+    """
+    directory = tmp_path_factory.mktemp('fasta_diff')
+    old, new = _assemblies(random.Random(15))
+    write_fasta(str(directory / 'old.fa'), old)
+    write_fasta(str(directory / 'new.fa'), new, width=70)
+    for name, options in (('plain', []), ('both', ['-b'])):
+        log = run_fasta_diff(['old.fa', 'new.fa', '-o', name + '.tsv', '-r', name + '_report.txt'] + options, directory)
+        (directory / (name + '.log')).write_text(log)
+    return directory
+
+
+def test_plain_run(assemblies):
+    alignments = [line.split('\t') for line in read_text(assemblies / 'plain.tsv').splitlines()]
+    new_ids = set(a[3] for a in alignments)
+    # stage 1, 2, 3 and 4
+    assert ['old0', 'new0'] in [[a[0], a[3]] for a in alignments]
+    assert ['old1', 'old1'] in [[a[0], a[3]] for a in alignments]
+    assert len([a for a in alignments if a[0] == a[3] == 'old2']) == 3
+    assert set(['old14_a', 'old14_b', 'old14_c']) <= new_ids
+    # the masked sequences also found in another old sequence are ambiguous
+    log = read_text(assemblies / 'plain.log')
+    for n in (6, 8):
+        assert 'old%d' % n not in new_ids
+        assert 'Failed one to one mapping: old%d has 2 matches' % n in log
+    assert 'old5' not in new_ids and 'novel7' not in new_ids
+    both = [line.split('\t') for line in read_text(assemblies / 'both.tsv').splitlines()]
+    assert ['old5', 'old5', '-'] in [[a[0], a[3], a[6]] for a in both]
+
+
+@pytest.mark.parametrize('shards', [1, 2, 3])
+@pytest.mark.parametrize('name, options', [('plain', []), ('both', ['-b'])])
+def test_shard_merge(assemblies, tmp_path, shards, name, options):
+    for shard in range(shards):
+        run_fasta_diff(['shard', assemblies / 'old.fa', assemblies / 'new.fa', '-n', shards, '-k', shard,
+                        '-o', tmp_path / ('shard_%d.json' % shard)] + options, tmp_path)
+    run_fasta_diff(['merge', assemblies / 'old.fa'] + [tmp_path / ('shard_%d.json' % shard) for shard in range(shards)]
+                   + ['-o', tmp_path / 'merged.tsv', '-r', tmp_path / 'report.txt'], tmp_path)
+    assert read_text(tmp_path / 'merged.tsv') == read_text(assemblies / (name + '.tsv'))
+    assert read_text(tmp_path / 'report.txt') == read_text(assemblies / (name + '_report.txt'))
+
+
+def test_previous(assemblies, tmp_path):
+    run_fasta_diff([assemblies / 'old.fa', assemblies / 'new.fa', '-o', 'v1.tsv', '--digests', 'v1_digests.tsv'], tmp_path)
+    assert read_text(tmp_path / 'v1.tsv') == read_text(assemblies / 'plain.tsv')
+    # the next version changes a base of a truncated sequence, removes a split part and adds a sequence
+    rng = random.Random(16)
+    new = []
+    for header, seq in read_fasta(str(assemblies / 'new.fa')):
+        seq_id = header[1:]
+        if seq_id == 'old11':
+            seq = seq[:50] + ('A' if seq[50] != 'A' else 'C') + seq[51:]
+        elif seq_id == 'old24_b':
+            continue
+        new.append((seq_id, seq))
+    new.append(('novel_v2', random_sequence(rng, 400)))
+    write_fasta(str(tmp_path / 'new_v2.fa'), new)
+    run_fasta_diff([assemblies / 'old.fa', 'new_v2.fa', '-o', 'plain_v2.tsv'], tmp_path)
+    log = run_fasta_diff([assemblies / 'old.fa', 'new_v2.fa', '-o', 'v2.tsv', '--previous', 'v1.tsv', 'v1_digests.tsv'],
+                         tmp_path)
+    assert re.search(r'Carried forward alignments: [1-9]', log)
+    # the carried alignments are written first, the rows are the same as a full run
+    assert sorted(read_text(tmp_path / 'v2.tsv').splitlines()) == sorted(read_text(tmp_path / 'plain_v2.tsv').splitlines())
+    assert sorted(read_text(tmp_path / 'v2.tsv').splitlines()) != sorted(read_text(assemblies / 'plain.tsv').splitlines())
+
+
+def test_one_to_multiple(tmp_path):
+    rng = random.Random(3)
+    seq = random_sequence(rng, 600)
+    write_fasta(str(tmp_path / 'old.fa'), [('chrA', seq), ('chrB', random_sequence(rng, 300))])
+    # chrA is split in three parts, the old region of the last one overlaps the region of a fourth part
+    write_fasta(str(tmp_path / 'new.fa'), [('partA1', seq[:200]), ('partA2', seq[210:400]), ('partA3', seq[410:]),
+                                           ('partA4', seq[450:550]), ('novel', random_sequence(rng, 50))])
+    run_fasta_diff(['old.fa', 'new.fa', '-o', 'match.tsv', '-r', 'report.txt'], tmp_path)
+    assert [line.split('\t') for line in read_text(tmp_path / 'match.tsv').splitlines()] == [
+        ['chrA', '0', '200', 'partA1', '0', '200'], ['chrA', '210', '400', 'partA2', '0', '190']]
+    assert [line.split('\t') for line in read_text(tmp_path / 'report.txt').splitlines() if line.endswith('Stage 4')] == [
+        ['partA3', '190', 'Stage 4'], ['partA4', '100', 'Stage 4'], ['novel', '50', 'Stage 4']]
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_edits(tmp_path, reverse):
+    rng = random.Random(5)
+    seq = random_sequence(rng, 1000)
+    write_fasta(str(tmp_path / 'old.fa'), [('chrE', seq), ('chrF', random_sequence(rng, 500))])
+    # 5 bases inserted at 300 and 10 bases deleted at 600
+    edited = seq[:300] + 'TTTTT' + seq[300:600] + seq[610:]
+    write_fasta(str(tmp_path / 'new.fa'), [('chrE_v2', reverse_complement(edited) if reverse else edited)])
+    run_fasta_diff(['old.fa', 'new.fa', '-o', 'plain.tsv', '-b'], tmp_path)
+    assert read_text(tmp_path / 'plain.tsv') == ''
+    run_fasta_diff(['old.fa', 'new.fa', '-o', 'match.tsv', '-b', '-e'], tmp_path)
+    blocks = [[0, 300, 0, 300], [300, 600, 305, 605], [610, 1000, 605, 995]]
+    if reverse:
+        expected = [['chrE', str(o_start), str(o_end), 'chrE_v2', str(995 - n_end), str(995 - n_start), '-']
+                    for o_start, o_end, n_start, n_end in blocks]
+    else:
+        expected = [['chrE', str(o_start), str(o_end), 'chrE_v2', str(n_start), str(n_end), '+']
+                    for o_start, o_end, n_start, n_end in blocks]
+    assert [line.split('\t') for line in read_text(tmp_path / 'match.tsv').splitlines()] == expected
+
+
+@pytest.mark.parametrize('options', [[], ['-b'], ['--packed']])
+def test_masked_fast_path(tmp_path, monkeypatch, options):
+    # the last segment G of the new sequence is also the first masked base of the old sequence
+    prefix = random_sequence(random.Random(13), 34)
+    write_fasta(str(tmp_path / 'old.fa'), [('A', prefix + 'GACGGGTG'), ('B', random_sequence(random.Random(14), 300))])
+    write_fasta(str(tmp_path / 'new.fa'), [('A', prefix + 'GACGGNNG')])
+    run_fasta_diff(['old.fa', 'new.fa', '-o', 'match.tsv'] + options, tmp_path)
+    strand = ['+'] if options == ['-b'] else []
+    # the segments are aligned at the same positions
+    expected = [['A', '0', '39', 'A', '0', '39'] + strand, ['A', '41', '42', 'A', '41', '42'] + strand]
+    assert [line.split('\t') for line in read_text(tmp_path / 'match.tsv').splitlines()] == expected
+    run_fasta_diff(['shard', 'old.fa', 'new.fa', '-n', '1', '-k', '0', '-o', 'shard.json'] + [o for o in options if o == '-b'], tmp_path)
+    run_fasta_diff(['merge', 'old.fa', 'shard.json', '-o', 'merged.tsv'], tmp_path)
+    assert read_text(tmp_path / 'merged.tsv') == read_text(tmp_path / 'match.tsv')
+    # the stage 3 search aligns the last segment to the first G after the previous segment
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(fasta_diff_module, '_match_masked_sequence', lambda new_entry, new_seq, candidates: (None, None, 0, 0))
+    logging.disable(logging.CRITICAL)
+    try:
+        search = fasta_diff_module.fasta_diff('old.fa', 'new.fa', debug=False)[0]
+    finally:
+        logging.disable(logging.NOTSET)
+    assert search == [['A', 0, 39, 'A', 0, 39], ['A', 39, 40, 'A', 41, 42]]
+
+
+def test_masked_sequence_in_a_longer_old_sequence(tmp_path):
+    rng = random.Random(12)
+    seq = random_sequence(rng, 300)
+    write_fasta(str(tmp_path / 'old.fa'), [('A', seq), ('B', seq + random_sequence(rng, 200))])
+    write_fasta(str(tmp_path / 'new.fa'), [('A', seq[:100] + 'N' * 20 + seq[120:])])
+    log = run_fasta_diff(['old.fa', 'new.fa', '-o', 'match.tsv'], tmp_path)
+    assert 'Failed one to one mapping: A has 2 matches: A,B' in log
+    assert read_text(tmp_path / 'match.tsv') == ''
@@ -0,0 +1,78 @@
+from conftest import random_sequence
+from coordinates_conversion.fasta import reverse_complement
+from coordinates_conversion.kmer_index import KmerIndex, MappedKmerIndex, write_kmer_index
+
+import pytest
+
+
+def _old_sequences(rng, count=6, length=150):
+    return [random_sequence(rng, length) for _ in range(count)]
+
+
+@pytest.mark.parametrize('k, step', [(8, 1), (8, 4), (5, 7), (12, 5)])
+def test_no_miss_at_every_offset(rng, k, step):
+    sequences = _old_sequences(rng)
+    kmer_index = KmerIndex(sequences, k=k, step=step)
+    shortest = k + step - 1
+    for ordinal, seq in enumerate(sequences):
+        for length in (shortest, shortest + 1, shortest + step):
+            for start in range(len(seq) - length + 1):
+                assert ordinal in kmer_index.candidate_ordinals(seq[start:start + length])
+
+
+@pytest.mark.parametrize('k, step', [(8, 4), (5, 7)])
+def test_too_short_query(rng, k, step):
+    kmer_index = KmerIndex(_old_sequences(rng), k=k, step=step)
+    assert kmer_index.candidate_ordinals('A' * (k + step - 2)) is None
+    assert kmer_index.candidate_ordinals('A' * (k + step - 1)) is not None
+
+
+def test_query_at_the_end_of_a_sequence(rng):
+    # the last sampled k-mer starts before len(seq) - k when len(seq) - k is not a multiple of step
+    k, step = 8, 4
+    sequences = [random_sequence(rng, length) for length in (k, k + 1, k + step - 1, k + step, 2 * k + 3)]
+    kmer_index = KmerIndex(sequences, k=k, step=step)
+    for ordinal, seq in enumerate(sequences):
+        if len(seq) >= k + step - 1:
+            assert ordinal in kmer_index.candidate_ordinals(seq[-(k + step - 1):])
+
+
+def test_canonical_finds_the_reverse_complement(rng):
+    k, step = 8, 4
+    sequences = _old_sequences(rng)
+    kmer_index = KmerIndex(sequences, k=k, step=step, canonical=True)
+    for ordinal, seq in enumerate(sequences):
+        for start in range(len(seq) - k - step + 2):
+            query = reverse_complement(seq[start:start + k + step - 1])
+            assert ordinal in kmer_index.candidate_ordinals(query)
+
+
+@pytest.mark.parametrize('canonical', [False, True])
+def test_mapped_index_matches(tmp_path, rng, canonical):
+    k, step = 8, 4
+    sequences = _old_sequences(rng)
+    kmer_index = KmerIndex(sequences, k=k, step=step, canonical=canonical)
+    index_file = str(tmp_path / 'old.kmi')
+    write_kmer_index(kmer_index, index_file, {'note': 'test'})
+    mapped = MappedKmerIndex(index_file)
+    assert (mapped.k, mapped.step, len(mapped), mapped.canonical) == (k, step, len(sequences), canonical)
+    assert mapped.table == {'note': 'test'}
+    for ordinal, seq in enumerate(sequences):
+        for start in range(0, len(seq) - 20, 3):
+            query = seq[start:start + 20]
+            assert ordinal in mapped.candidate_ordinals(query)
+            assert mapped.candidate_ordinals(query) == kmer_index.candidate_ordinals(query)
+            assert list(mapped.lookup(query[:k])) == list(kmer_index.lookup(query[:k]))
+
+
+def test_shared_kmers(tmp_path):
+    # a k-mer repeated in a sequence and held by several sequences, a sequence too short to hold a k-mer
+    sequences = ['ACGTACGT' * 4, 'TTTT', 'GGGGACGTACGTCCCC', 'ACGTACGTAAAA']
+    kmer_index = KmerIndex(sequences, k=8, step=4)
+    assert list(kmer_index.lookup('ACGTACGT')) == [0, 2, 3]
+    assert list(kmer_index.lookup('TTTTTTTT')) == []
+    write_kmer_index(kmer_index, str(tmp_path / 'old.kmi'))
+    assert list(MappedKmerIndex(str(tmp_path / 'old.kmi')).lookup('ACGTACGT')) == [0, 2, 3]
+    empty = KmerIndex(['ACG'], k=8, step=4)
+    write_kmer_index(empty, str(tmp_path / 'empty.kmi'))
+    assert list(MappedKmerIndex(str(tmp_path / 'empty.kmi')).lookup('ACGTACGT')) == []
@@ -0,0 +1,57 @@
+import pickle
+
+from conftest import random_sequence, write_fasta
+from coordinates_conversion.fasta import sequence_digest
+from coordinates_conversion.packed_store import PackedSequenceStore, open_packed_store, write_packed_store
+
+
+def _records(rng):
+    return [
+        ('seq1 first sequence', random_sequence(rng, 1)),
+        ('seq2', random_sequence(rng, 7)),
+        ('seq3', 'N' * 10),
+        ('seq4', random_sequence(rng, 40) + 'N' * 13 + random_sequence(rng, 21) + 'NN' + random_sequence(rng, 9)),
+        ('seq5', 'NNN' + random_sequence(rng, 33, 'ACGTRYKMacgtn') + 'N'),
+        ('seq6', random_sequence(rng, 257)),
+    ]
+
+
+def test_fetch_round_trip(tmp_path, rng):
+    records = _records(rng)
+    fasta_file = str(tmp_path / 'old.fa')
+    write_fasta(fasta_file, records)
+    assert write_packed_store(fasta_file, str(tmp_path / 'old.fa.pack')) == len(records)
+    store = PackedSequenceStore(str(tmp_path / 'old.fa.pack'))
+    assert len(store) == len(records)
+    for record, (header, seq) in enumerate(records):
+        seq = seq.upper()
+        assert store.ordinal[header.split()[0]] == record
+        assert store.records[record]['header'] == '>' + header
+        assert store.records[record]['digest'] == sequence_digest(seq)
+        assert store.length(record) == len(seq)
+        assert store.fetch(record) == seq
+        for start in range(len(seq) + 1):
+            for end in range(start, min(len(seq), start + 11) + 1):
+                assert store.fetch(record, start, end) == seq[start:end]
+        assert store.fetch(record, 0, len(seq) + 5) == seq
+    store.close()
+
+
+def test_n_runs(tmp_path, rng):
+    seq = random_sequence(rng, 30) + 'N' * 17 + random_sequence(rng, 5) + 'N' + random_sequence(rng, 30)
+    fasta_file = str(tmp_path / 'old.fa')
+    write_fasta(fasta_file, [('masked', seq)])
+    store = open_packed_store(fasta_file)
+    assert store.records[0]['other'] == [[30, 47, 'N'], [52, 53, 'N']]
+    # slices starting, ending and lying inside the runs
+    for start, end in [(28, 33), (30, 47), (35, 40), (45, 53), (46, 60), (52, 53)]:
+        assert store.fetch(0, start, end) == seq[start:end]
+
+
+def test_pickled_store(tmp_path, rng):
+    records = _records(rng)
+    fasta_file = str(tmp_path / 'old.fa')
+    write_fasta(fasta_file, records)
+    store = open_packed_store(fasta_file)
+    copy = pickle.loads(pickle.dumps(store))
+    assert [copy.fetch(record) for record in range(len(copy))] == [seq.upper() for header, seq in records]
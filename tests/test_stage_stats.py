@@ -0,0 +1,56 @@
+import json
+import os
+import random
+
+from conftest import random_sequence, run_fasta_diff, write_fasta
+from coordinates_conversion.stage_stats import StageStats
+
+STAGE_KEYS = {'stage', 'name', 'candidate_comparisons', 'bytes_scanned', 'wall_time', 'cpu_time', 'children_cpu_time',
+              'peak_memory', 'children_peak_memory'}
+TOTAL_KEYS = {'candidate_comparisons', 'bytes_scanned', 'wall_time', 'cpu_time', 'children_cpu_time', 'peak_memory',
+              'children_peak_memory'}
+
+
+def test_counters():
+    stats = StageStats()
+    stats.start(1, 'first')
+    stats.count(comparisons=2, scanned=100)
+    stats.count(scanned=50)
+    first = stats.stop(matched=3)
+    stats.start(2, 'second')
+    stats.count(comparisons=5)
+    stats.stop()
+    assert set(first) == STAGE_KEYS | {'matched'}
+    assert (first['candidate_comparisons'], first['bytes_scanned'], first['matched']) == (2, 150, 3)
+    report = stats.to_dict(version='x')
+    assert report['version'] == 'x' and [s['name'] for s in report['stages']] == ['first', 'second']
+    assert (report['total']['candidate_comparisons'], report['total']['bytes_scanned']) == (7, 150)
+
+
+def test_fasta_diff_stats(tmp_path):
+    rng = random.Random(3)
+    seq = random_sequence(rng, 600)
+    write_fasta(str(tmp_path / 'old.fa'), [('chrA', seq), ('chrB', random_sequence(rng, 300))])
+    # chrA is split in two parts, a third part is masked
+    write_fasta(str(tmp_path / 'new.fa'), [('chrB', random_sequence(rng, 100)), ('partA1', seq[:200]),
+                                           ('partA2', seq[210:400]), ('partA3', seq[410:450] + 'NNNN' + seq[454:])])
+    run_fasta_diff(['old.fa', 'new.fa', '-o', 'match.tsv', '-s', 'stats.json'], tmp_path)
+    with open(str(tmp_path / 'stats.json')) as stats_f:
+        report = json.load(stats_f)
+    assert (report['old_fasta'], report['new_fasta'], report['jobs'], report['alignments']) == ('old.fa', 'new.fa', 1, 4)
+    stages = report['stages']
+    assert [(s['stage'], s['name']) for s in stages] == [
+        (0, 'read_fasta_files'), (1, 'match_identical_sequence'), (2, 'match_truncated_sequence'),
+        (3, 'match_split_subsequence'), (4, 'one_to_multiple_match')]
+    for s in stages:
+        assert set(s) >= STAGE_KEYS
+        assert s['wall_time'] >= 0 and s['cpu_time'] >= 0 and s['peak_memory'] > 0
+    assert stages[0]['bytes_scanned'] == os.path.getsize(str(tmp_path / 'old.fa')) + os.path.getsize(str(tmp_path / 'new.fa'))
+    assert (stages[0]['old_sequences'], stages[0]['new_sequences']) == (2, 4)
+    assert [(s['matched_sequences'], s['unmatched_old'], s['unmatched_new']) for s in stages[1:]] == [
+        (0, 2, 4), (0, 2, 4), (0, 2, 4), (1, 1, 1)]
+    # the k-mer index only returns chrA, for the parts without Ns in stage 2 and for every part in stage 3
+    assert [(s['candidate_comparisons'], s['bytes_scanned']) for s in stages[2:4]] == [(2, 1200), (3, 1800)]
+    assert set(report['total']) == TOTAL_KEYS
+    for key in ('candidate_comparisons', 'bytes_scanned'):
+        assert report['total'][key] == sum(s[key] for s in stages)
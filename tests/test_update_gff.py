@@ -0,0 +1,181 @@
+import logging
+import shutil
+
+from conftest import REPO_ROOT, read_text, run_fasta_diff
+from coordinates_conversion.bin.update_gff import GffUpdater
+
+import pytest
+
+# chr1 is kept, chr2 is split in a reverse and a forward part around an N region, chr3 is removed
+ALIGNMENTS = [
+    ['chr1', 0, 1000, 'new1', 0, 1000, '+'],
+    ['chr2', 0, 500, 'new2', 100, 600, '-'],
+    ['chr2', 600, 1000, 'new3', 0, 400, '+'],
+]
+MODES = [{}, {'streaming': True}, {'spill_dir': None}]
+MODE_IDS = ['memory', 'streaming', 'spill']
+
+
+@pytest.fixture
+def alignment_file(tmp_path):
+    path = tmp_path / 'match.tsv'
+    path.write_text(''.join('\t'.join(str(a) for a in alignment) + '\n' for alignment in ALIGNMENTS))
+    return str(path)
+
+
+def _update(tmp_path, alignment_file, name, lines, mode):
+    # write lines to tmp_path/name.gff3, update it and return the updated and removed files
+    directory = tmp_path / name
+    directory.mkdir()
+    gff_file = directory / 'x.gff3'
+    gff_file.write_text(''.join(lines))
+    if 'spill_dir' in mode:
+        mode = {'spill_dir': str(directory)}
+    GffUpdater(alignment_file, '_updated', '_removed', **mode).update(str(gff_file))
+    return read_text(directory / 'x_updated.gff3'), read_text(directory / 'x_removed.gff3')
+
+
+def _feature(seqid, start, end, attributes, strand='+'):
+    return '\t'.join([seqid, 'test', 'gene', str(start), str(end), '.', strand, '.', attributes]) + '\n'
+
+
+def _random_gff(rng):
+    # returns the lines and the (ID, parents, line) of each feature, the children are on the seqid of their parents
+    lines, features, group_ids, seqid = ['##gff-version 3\n'], [], [], None
+    for n in range(rng.randint(1, 60)):
+        x = rng.random()
+        if x < 0.05:
+            lines.append('###\n')
+            # a Parent can be before the directive, streaming falls back to the spill database
+            if rng.random() < 0.5:
+                group_ids = []
+        elif x < 0.08:
+            lines.append('# comment\n')
+        elif x < 0.1:
+            lines.append('\n')
+        else:
+            if seqid is None or rng.random() < 0.2:
+                seqid = rng.choice(['chr1', 'chr2', 'chr3'])
+                group_ids = []
+            start = rng.randint(1, 1000)
+            end = min(1000, start + rng.randint(0, 300))
+            parents = rng.sample(group_ids, min(len(group_ids), rng.choice([1, 1, 2, 3]))) if group_ids and rng.random() < 0.6 else []
+            attributes = 'ID=f%d' % n + (';Parent=' + ','.join(parents) if parents else '') + ';Note=x'
+            line = _feature(seqid, start, end, attributes, rng.choice('+-.'))
+            group_ids.append('f%d' % n)
+            lines.append(line)
+            features.append(('f%d' % n, parents, line))
+    return lines, features
+
+
+def test_modes_match_on_random_files(tmp_path, alignment_file, rng):
+    logging.disable(logging.CRITICAL)
+    try:
+        reference = GffUpdater(alignment_file, '_updated', '_removed')
+        for t in range(60):
+            lines, features = _random_gff(rng)
+            # a removed feature removes every feature connected to it through Parent attributes
+            group = {}
+
+            def find(feature_id):
+                while group.get(feature_id, feature_id) != feature_id:
+                    feature_id = group[feature_id]
+                return feature_id
+            for feature_id, parents, line in features:
+                for parent in parents:
+                    group[find(parent)] = find(feature_id)
+            removed = {find(feature_id) for feature_id, parents, line in features
+                       if reference._convert_feature(line)[0] != GffUpdater.KEEP}
+            expected_removed = ''.join(line for feature_id, parents, line in features if find(feature_id) in removed)
+            outputs = [_update(tmp_path, alignment_file, '%d_%s' % (t, mode_id), lines, mode)
+                       for mode, mode_id in zip(MODES, MODE_IDS)]
+            assert outputs[0] == outputs[1] == outputs[2]
+            assert outputs[0][1] == expected_removed
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+@pytest.mark.parametrize('mode', MODES, ids=MODE_IDS)
+def test_multiple_parents(tmp_path, alignment_file, mode):
+    lines = [
+        '##gff-version 3\n',
+        _feature('chr2', 10, 100, 'ID=gene1'),
+        _feature('chr2', 400, 700, 'ID=gene2'),
+        _feature('chr2', 650, 700, 'ID=exon2;Parent=gene2'),
+        _feature('chr2', 20, 30, 'ID=shared;Parent=gene1,gene2'),
+        _feature('chr2', 20, 30, 'Parent=shared'),
+        _feature('chr1', 1, 10, 'ID=gene3'),
+        _feature('chr1', 5, 10, 'Parent=gene3'),
+    ]
+    updated, removed = _update(tmp_path, alignment_file, 'x', lines, mode)
+    # gene2 crosses the N region of chr2, the features joined to it by 'shared' are removed with it
+    assert removed == ''.join(lines[1:6])
+    assert updated == ''.join([
+        '##gff-version 3\n',
+        '##sequence-region new1 1 1000\n',
+        _feature('new1', 1, 10, 'ID=gene3'),
+        _feature('new1', 5, 10, 'Parent=gene3'),
+    ])
+
+
+@pytest.mark.parametrize('mode', MODES, ids=MODE_IDS)
+def test_reverse_strand(tmp_path, alignment_file, mode):
+    lines = ['##gff-version 3\n', _feature('chr2', 11, 20, 'ID=gene1', '+'), _feature('chr2', 491, 500, 'ID=gene2', '-')]
+    updated, removed = _update(tmp_path, alignment_file, 'x', lines, mode)
+    assert removed == ''
+    assert updated.splitlines(True)[2:] == [_feature('new2', 581, 590, 'ID=gene1', '-'),
+                                             _feature('new2', 101, 110, 'ID=gene2', '+')]
+
+
+@pytest.mark.parametrize('mode', MODES, ids=MODE_IDS)
+def test_parent_across_directive(tmp_path, alignment_file, mode):
+    lines = [
+        '##gff-version 3\n',
+        _feature('chr1', 1, 10, 'ID=gene1'),
+        _feature('chr2', 400, 450, 'ID=gene2'),
+        '###\n',
+        _feature('chr1', 1, 10, 'ID=mRNA1;Parent=gene1'),
+        # gene2 is removed by a child crossing the N region of chr2, after the directive and a change of seqid
+        _feature('chr2', 450, 700, 'ID=exon2;Parent=gene2'),
+    ]
+    updated, removed = _update(tmp_path, alignment_file, 'x', lines, mode)
+    assert removed == lines[2] + lines[5]
+    assert updated == ''.join([
+        '##gff-version 3\n',
+        '##sequence-region new1 1 1000\n',
+        _feature('new1', 1, 10, 'ID=gene1'),
+        '###\n',
+        _feature('new1', 1, 10, 'ID=mRNA1;Parent=gene1'),
+    ])
+
+
+def test_attribute_value():
+    assert GffUpdater._attribute_value('ID=a;Note=x', 'ID=') == 'a'
+    assert GffUpdater._attribute_value('Note=x;ID=a', 'ID=') == 'a'
+    # a repeated tag takes its last value, an empty value is skipped
+    assert GffUpdater._attribute_value('ID=a;Note=x;ID=b', 'ID=') == 'b'
+    assert GffUpdater._attribute_value('ID=a;ID=', 'ID=') == 'a'
+    assert GffUpdater._attribute_value('XID=a;Note=ID=b', 'ID=') is None
+    assert GffUpdater._feature_id_parents(_feature('chr1', 1, 2, 'ID=a;Parent=p,q;Parent=r')) == ('a', ['r'])
+
+
+def test_example_files(tmp_path):
+    for name in ('old.fa', 'new.fa', 'example1.gff3', 'example2.gff3'):
+        shutil.copy(REPO_ROOT + '/example_file/' + name, str(tmp_path))
+    run_fasta_diff(['old.fa', 'new.fa', '-o', 'match.tsv'], tmp_path)
+    outputs = []
+    for mode, mode_id in zip(MODES, MODE_IDS):
+        directory = tmp_path / mode_id
+        directory.mkdir()
+        if 'spill_dir' in mode:
+            mode = {'spill_dir': str(directory)}
+        for name in ('example1.gff3', 'example2.gff3'):
+            shutil.copy(str(tmp_path / name), str(directory))
+        updater = GffUpdater(str(tmp_path / 'match.tsv'), '_updated', '_removed', **mode)
+        output = []
+        for name in ('example1', 'example2'):
+            updater.update(str(directory / (name + '.gff3')))
+            output.append((read_text(directory / (name + '_updated.gff3')), read_text(directory / (name + '_removed.gff3'))))
+        outputs.append(output)
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert all(updated.count('\n') > 10 for updated, removed in outputs[0])
@@ -0,0 +1,238 @@
+"""
+BED, VCF and BAM conversion checked against the sequences: a converted feature has to cover the same bases in the new
+sequence, reverse complemented when its alignment is on the reverse strand
+"""
+
+import logging
+import random
+
+from conftest import random_sequence, read_text, run_fasta_diff, write_fasta
+from coordinates_conversion.bin.update_bam import BamUpdater
+from coordinates_conversion.bin.update_bed import BedUpdater
+from coordinates_conversion.bin.update_vcf import VCFUpdater
+from coordinates_conversion.fasta import reverse_complement
+
+import pysam
+import pytest
+
+# chr2[:700] is reverse complemented in chr2_rc, chr2[700:800] is removed, chr2[800:] is chr2_b and chr3 is removed
+EXPECTED_ALIGNMENTS = [
+    ['chr1', '0', '2000', 'chr1', '0', '2000', '+'],
+    ['chr2', '0', '700', 'chr2_rc', '0', '700', '-'],
+    ['chr2', '800', '1500', 'chr2_b', '0', '700', '+'],
+]
+
+
+@pytest.fixture(scope='module')
+def assemblies(tmp_path_factory):
+    """
+    :return: the working directory holding old.fa, new.fa and the fasta_diff -b output match.tsv, the old sequences and
+        the new sequences by id
+    """
+    directory = tmp_path_factory.mktemp('assemblies')
+    rng = random.Random(14)
+    chr1, chr2, chr3 = [random_sequence(rng, length) for length in (2000, 1500, 800)]
+    old = {'chr1': chr1, 'chr2': chr2, 'chr3': chr3}
+    new = {'chr1': chr1, 'chr2_rc': reverse_complement(chr2[:700]), 'chr2_b': chr2[800:]}
+    write_fasta(str(directory / 'old.fa'), list(old.items()))
+    write_fasta(str(directory / 'new.fa'), list(new.items()))
+    run_fasta_diff(['old.fa', 'new.fa', '-b', '-o', 'match.tsv'], directory)
+    assert [line.split('\t') for line in read_text(directory / 'match.tsv').splitlines()] == EXPECTED_ALIGNMENTS
+    return directory, old, new
+
+
+def _converted(old_id, start, end):
+    # the new id, 0-based start and end and strand of old_id[start:end] from EXPECTED_ALIGNMENTS, None if removed
+    for a in EXPECTED_ALIGNMENTS:
+        if a[0] == old_id and int(a[1]) <= start and end <= int(a[2]):
+            if a[6] == '-':
+                return a[3], int(a[4]) + int(a[2]) - end, int(a[4]) + int(a[2]) - start, '-'
+            return a[3], start - int(a[1]) + int(a[4]), end - int(a[1]) + int(a[4]), '+'
+    return None
+
+
+def _random_intervals(rng, old, count):
+    intervals = []
+    for _ in range(count):
+        old_id = rng.choice(sorted(old))
+        start = rng.randint(0, len(old[old_id]) - 60)
+        intervals.append((old_id, start, start + rng.randint(10, 60)))
+    return sorted(intervals)
+
+
+def test_bed(assemblies, tmp_path):
+    directory, old, new = assemblies
+    rng = random.Random(1)
+    lines, expected = [], {}
+    for n, (old_id, start, end) in enumerate(_random_intervals(rng, old, 300)):
+        # two blocks, at the start and at the end of the interval
+        sizes = [3, 4]
+        starts = [0, end - start - 4]
+        lines.append('\t'.join([old_id, str(start), str(end), 'f%d' % n, '0', rng.choice('+-'), str(start + 2),
+                                str(end - 1), '0', '2', ','.join(map(str, sizes)) + ',', ','.join(map(str, starts)) + ',']) + '\n')
+        expected['f%d' % n] = _converted(old_id, start, end)
+    bed_file = tmp_path / 'x.bed'
+    bed_file.write_text('track name=test\n' + ''.join(lines))
+    BedUpdater(str(directory / 'match.tsv'), '_updated', '_removed').update(str(bed_file))
+    updated = read_text(tmp_path / 'x_updated.bed').splitlines()
+    removed = read_text(tmp_path / 'x_removed.bed').splitlines()
+    assert updated[0] == removed[0] == 'track name=test'
+    assert sorted(line.split('\t')[3] for line in removed[1:]) == sorted(name for name, c in expected.items() if c is None)
+    assert len(updated) - 1 == sum(1 for c in expected.values() if c is not None)
+    input_lines = dict((line.split('\t')[3], line.rstrip('\n').split('\t')) for line in lines)
+    for line in updated[1:]:
+        tokens = line.split('\t')
+        old_tokens = input_lines[tokens[3]]
+        new_id, new_start, new_end, strand = expected[tokens[3]]
+        assert (tokens[0], int(tokens[1]), int(tokens[2])) == (new_id, new_start, new_end)
+        old_seq, new_seq = old[old_tokens[0]], new[new_id]
+        start, end = int(old_tokens[1]), int(old_tokens[2])
+        flip = reverse_complement if strand == '-' else str
+        assert new_seq[new_start:new_end] == flip(old_seq[start:end])
+        assert tokens[5] == ({'+': '-', '-': '+'}[old_tokens[5]] if strand == '-' else old_tokens[5])
+        assert new_seq[int(tokens[6]):int(tokens[7])] == flip(old_seq[int(old_tokens[6]):int(old_tokens[7])])
+        # the blocks cover the same bases, listed from the new start
+        old_blocks = [old_seq[start + s:start + s + size]
+                      for s, size in zip(map(int, old_tokens[11].rstrip(',').split(',')), map(int, old_tokens[10].rstrip(',').split(',')))]
+        new_blocks = [new_seq[new_start + s:new_start + s + size]
+                      for s, size in zip(map(int, tokens[11].rstrip(',').split(',')), map(int, tokens[10].rstrip(',').split(',')))]
+        assert new_blocks == ([reverse_complement(b) for b in reversed(old_blocks)] if strand == '-' else old_blocks)
+
+
+def test_vcf(assemblies, tmp_path):
+    directory, old, new = assemblies
+    rng = random.Random(2)
+    lines, expected = [], {}
+    for n, (old_id, start, end) in enumerate(_random_intervals(rng, old, 300)):
+        ref = old[old_id][start:start + rng.choice([1, 1, 2, 3])]
+        alt = rng.choice(['A', 'C', 'G', 'T', 'AC', 'GT', 'ACG', '.'])
+        lines.append('\t'.join([old_id, str(start + 1), 'v%d' % n, ref, alt, '50', 'PASS', '.']) + '\n')
+        converted = _converted(old_id, start, start + len(ref))
+        # an indel can not be moved to the reverse strand
+        if converted is not None and converted[3] == '-' and alt != '.' and len(alt) != len(ref):
+            converted = None
+        expected['v%d' % n] = converted
+    vcf_file = tmp_path / 'x.vcf'
+    vcf_file.write_text('##fileformat=VCFv4.2\n##contig=<ID=chr1,length=2000>\n##contig=<ID=chr2,length=1500>\n'
+                        '##contig=<ID=chr3,length=800>\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n' + ''.join(lines))
+    VCFUpdater(str(directory / 'match.tsv'), '_updated', '_removed').update(str(vcf_file), str(directory / 'new.fa'))
+    updated = read_text(tmp_path / 'x_updated.vcf').splitlines()
+    removed = read_text(tmp_path / 'x_removed.vcf').splitlines()
+    assert [line for line in updated if line.startswith('##contig')][:3] == [
+        '##contig=<ID=chr1,length=2000>', '##contig=<ID=chr2_rc,length=700>', '##contig=<ID=chr2_b,length=700>']
+    assert sorted(line.split('\t')[2] for line in removed if not line.startswith('#')) == sorted(
+        name for name, c in expected.items() if c is None)
+    input_lines = dict((line.split('\t')[2], line.rstrip('\n').split('\t')) for line in lines)
+    records = [line.split('\t') for line in updated if not line.startswith('#')]
+    assert len(records) == sum(1 for c in expected.values() if c is not None)
+    for tokens in records:
+        old_tokens = input_lines[tokens[2]]
+        new_id, new_start, new_end, strand = expected[tokens[2]]
+        assert (tokens[0], int(tokens[1])) == (new_id, new_start + 1)
+        # REF is the base of the new sequence at the new position
+        assert new[new_id][new_start:new_end] == tokens[3]
+        if strand == '-':
+            assert tokens[3] == reverse_complement(old_tokens[3])
+            assert tokens[4] == (old_tokens[4] if old_tokens[4] == '.' else reverse_complement(old_tokens[4]))
+        else:
+            assert tokens[3:5] == old_tokens[3:5]
+
+
+def _md(ref, query, cigartuples):
+    # the MD tag of query aligned to ref with soft clips, matches and deletions
+    md, count, r, q = '', 0, 0, 0
+    for op, length in cigartuples:
+        if op == 4:
+            q += length
+        elif op == 0:
+            for _ in range(length):
+                if ref[r] == query[q]:
+                    count += 1
+                else:
+                    md, count = md + str(count) + ref[r], 0
+                r, q = r + 1, q + 1
+        elif op == 2:
+            md, count = md + str(count) + '^' + ref[r:r + length], 0
+            r += length
+    return md + str(count)
+
+
+def test_bam(assemblies, tmp_path, caplog):
+    directory, old, new = assemblies
+    rng = random.Random(3)
+    # chr3 is not in the header, so the new header has more references than the old one
+    header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.0', 'SO': 'unsorted'},
+                                              'SQ': [{'SN': 'chr1', 'LN': 2000}, {'SN': 'chr2', 'LN': 1500}]})
+    bam_file = str(tmp_path / 'x.bam')
+    pairs = []
+    with pysam.AlignmentFile(bam_file, 'wb', header=header) as bam_f:
+        for n in range(150):
+            old_id = rng.choice(['chr1', 'chr2'])
+            starts = [rng.randint(0, len(old[old_id]) - 50) for _ in range(2)]
+            # both cigars span 48 bases of the reference, the second one with a deletion
+            cigars = [rng.choice([[(4, 2), (0, 48)], [(4, 2), (0, 20), (2, 2), (0, 26)]]) for _ in range(2)]
+            reads = []
+            for i in range(2):
+                ref = old[old_id][starts[i]:starts[i] + 48]
+                aligned = ref if len(cigars[i]) == 2 else ref[:20] + ref[22:]
+                # a mismatch
+                aligned = aligned[:10] + {'A': 'C', 'C': 'G', 'G': 'T', 'T': 'A'}[aligned[10]] + aligned[11:]
+                read = pysam.AlignedSegment(header)
+                read.query_name = 'r%d' % n
+                read.reference_id = header.get_tid(old_id)
+                read.reference_start = starts[i]
+                read.next_reference_id = header.get_tid(old_id)
+                read.next_reference_start = starts[1 - i]
+                read.flag = 0x1 | (0x40 if i == 0 else 0x80) | (0x20 if i == 0 else 0x10)
+                read.mapping_quality = 60
+                read.cigartuples = cigars[i]
+                read.query_sequence = 'GG' + aligned
+                read.query_qualities = pysam.qualitystring_to_array(''.join(rng.choice('#+5?I') for _ in range(len(aligned) + 2)))
+                read.template_length = starts[1 - i] - starts[i]
+                read.set_tag('MC', ''.join('%d%s' % (length, 'MIDNS'[op]) for op, length in cigars[1 - i]))
+                read.set_tag('MD', _md(ref, read.query_sequence, cigars[i]))
+                read.set_tag('NM', 1 + (2 if len(cigars[i]) > 2 else 0))
+                read.set_tag('XY', 'r%d_%d' % (n, i))
+                reads.append(read)
+                bam_f.write(read)
+            pairs.append((old_id, starts, reads))
+    with caplog.at_level(logging.INFO):
+        BamUpdater(str(directory / 'match.tsv'), '_updated', '_removed').update(bam_file)
+    with pysam.AlignmentFile(str(tmp_path / 'x_updated.bam')) as updated_f:
+        assert updated_f.references == ('chr1', 'chr2_b', 'chr2_rc')
+        updated = dict(((read.query_name, read.is_read1), read) for read in updated_f.fetch(until_eof=True))
+    with pysam.AlignmentFile(str(tmp_path / 'x_removed.bam')) as removed_f:
+        removed = set((read.query_name, read.is_read1) for read in removed_f.fetch(until_eof=True))
+    # the reads moved to chr2_rc, past the 2 references of the input header, are copied to new records
+    copied = [read for read in updated.values() if read.reference_id >= 2 or read.next_reference_id >= 2]
+    assert copied and 'Alignments copied to new records: %d ' % len(copied) in caplog.text
+    for old_id, starts, reads in pairs:
+        converted = [_converted(old_id, start, start + 48) for start in starts]
+        for i, read in enumerate(reads):
+            key = (read.query_name, read.is_read1)
+            if converted[i] is None or converted[1 - i] is None:
+                assert key in removed
+                continue
+            new_id, new_start, new_end, strand = converted[i]
+            new_read = updated[key]
+            assert (new_read.reference_name, new_read.reference_start) == (new_id, new_start)
+            assert (new_read.query_name, new_read.mapping_quality, new_read.is_read1) == (read.query_name, 60, read.is_read1)
+            assert (new_read.get_tag('NM'), new_read.get_tag('XY')) == (read.get_tag('NM'), read.get_tag('XY'))
+            # the mismatches and deletions are the ones of the new sequence
+            assert new_read.get_tag('MD') == _md(new[new_id][new_start:new_end], new_read.query_sequence, new_read.cigartuples)
+            if strand == '-':
+                assert new_read.is_reverse != read.is_reverse
+                assert new_read.query_sequence == reverse_complement(read.query_sequence)
+                assert list(new_read.query_qualities) == list(read.query_qualities)[::-1]
+                assert new_read.cigartuples == read.cigartuples[::-1]
+                assert new_read.template_length == -read.template_length
+            else:
+                assert new_read.is_reverse == read.is_reverse
+                assert new_read.query_sequence == read.query_sequence
+                assert new_read.cigartuples == read.cigartuples
+            # the mate fields point to the converted mate
+            mate_id, mate_start, mate_end, mate_strand = converted[1 - i]
+            mate = updated[(read.query_name, not read.is_read1)]
+            assert (new_read.next_reference_name, new_read.next_reference_start) == (mate_id, mate_start)
+            assert new_read.mate_is_reverse == (read.mate_is_reverse != (mate_strand == '-'))
+            assert new_read.get_tag('MC') == mate.cigarstring